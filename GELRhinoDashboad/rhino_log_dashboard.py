@@ -1,48 +1,268 @@
 # rhino_log_dashboard.py
 import streamlit as st
 import pandas as pd
+import hashlib
+import io
 import json
 import os
+import sqlite3
+import sys
+from contextlib import closing
+from itertools import islice
+import urllib.parse
+import urllib.request
 import plotly.express as px
+from pandas.api.types import union_categoricals
 
 st.set_page_config(page_title="Rhino Training Log Dashboard", layout="wide")
 st.title("📊 Rhino Training Log Dashboard")
 
-# --- ファイルアップロード ---
-log_file = st.file_uploader("Upload Log CSV", type="csv")
-meta_file = st.file_uploader("Upload Meta JSON", type="json")
+LOG_COLUMNS = ['Timestamp', 'UserID', 'Action', 'Detail', 'DocumentName']
+CATEGORY_COLUMNS = ['UserID', 'Action', 'DocumentName']
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+CSV_CHUNK_ROWS = 200_000
+DB_CHUNK_ROWS = 200_000
+DEFAULT_SERVER = os.environ.get('RHINOLOG_SERVER', 'http://127.0.0.1:5000')
+DEFAULT_DB_PATH = os.environ.get('RHINOLOG_DB_PATH', '/home/rhinologs/rhinolog.db')
+WATERMARK_TTL_SECONDS = 30  # サーバー/DB の更新確認の間隔（この間は同じデータを表示する）
+# SQLite DB を直接読むとき、アーカイブ済みの月は server_v2 の読み出し関数で読む
+SERVER_DIR = os.environ.get('RHINOLOG_SERVER_DIR',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
 
-if log_file and meta_file:
-    # --- CSV 読み込み ---
-    log_df = pd.read_csv(log_file)
-    log_df['Timestamp'] = pd.to_datetime(log_df['Timestamp'])
+# スコアリング: スキル -> 数えるアクション名
+SCORE_ACTIONS = {
+    "Modeling": ['Object Added'],
+    "Cleaning": ['Object Deleted'],
+    "Command": ['Command Started'],
+    "Saving": ['File Saved'],
+}
+SCORE_ACTION_PATTERNS = {
+    "ViewOps": 'View',
+}
 
-    # --- JSON 読み込み ---
-    meta = json.load(meta_file)
 
-    st.subheader("📁 Meta Information")
-    st.json(meta, expanded=False)
+# --- 読み込み（どの入力も LOG_COLUMNS の DataFrame にそろえる） ---
+def finalize_frame(chunks):
+    """Concatenate chunks whose category columns were converted per chunk, keeping them categorical"""
+    if not chunks:
+        return pd.DataFrame({column: pd.Series(dtype='category' if column in CATEGORY_COLUMNS else 'object')
+                             for column in LOG_COLUMNS}).astype({'Timestamp': 'datetime64[ns]'})
+    frame = pd.concat([chunk.drop(columns=CATEGORY_COLUMNS) for chunk in chunks], ignore_index=True)
+    for column in CATEGORY_COLUMNS:
+        frame[column] = union_categoricals([chunk[column] for chunk in chunks], ignore_order=True)
+    return frame[LOG_COLUMNS]
+
+
+def combine_frames(frames):
+    """One chronological frame from several sources (files, users, archived months)"""
+    return finalize_frame(frames).sort_values('Timestamp', kind='stable', ignore_index=True)
+
+
+def normalize_chunk(chunk, document_name=None):
+    if 'DocumentName' not in chunk:
+        chunk['DocumentName'] = document_name or ''
+    chunk = chunk.reindex(columns=LOG_COLUMNS)
+    chunk['Timestamp'] = pd.to_datetime(chunk['Timestamp'], format=TIMESTAMP_FORMAT, errors='coerce')
+    for column in CATEGORY_COLUMNS:
+        chunk[column] = chunk[column].fillna('').astype('category')
+    return chunk
+
+
+@st.cache_data(show_spinner="Reading CSV ...", max_entries=8)
+def load_csv(digest, name, _data):
+    """Read an uploaded log CSV in chunks (cached by content hash; _data is not hashed again)"""
+    # <user>_<doc>_Log.csv の <doc> を DocumentName にする（ユーザー名にも _ が入るので先頭行の UserID で切る）
+    document_name = name[:-len('_Log.csv')] if name.endswith('_Log.csv') else os.path.splitext(name)[0]
+    chunks = []
+    for chunk in pd.read_csv(io.BytesIO(_data), chunksize=CSV_CHUNK_ROWS, dtype=str,
+                             keep_default_na=False, encoding='utf-8-sig'):
+        if not chunks and len(chunk) and document_name.startswith(f"{chunk['UserID'].iloc[0]}_"):
+            document_name = document_name[len(chunk['UserID'].iloc[0]) + 1:]
+        chunks.append(normalize_chunk(chunk, document_name))
+    return finalize_frame(chunks)
+
+
+def http_get(url):
+    with urllib.request.urlopen(url, timeout=120) as response:
+        return response.headers, response.read()
+
+
+@st.cache_data(ttl=WATERMARK_TTL_SECONDS, show_spinner=False)
+def server_watermark(server, username):
+    """The server's ETag for the user's classified logs changes whenever new logs arrive"""
+    query = urllib.parse.urlencode({'username': username, 'limit': 1} if username else {'limit': 1})
+    headers, _ = http_get(f'{server}/api/logs/classified?{query}')
+    return headers.get('ETag')
+
+
+@st.cache_data(show_spinner=False, ttl=WATERMARK_TTL_SECONDS)
+def server_usernames(server):
+    _, body = http_get(f'{server}/api/users?fields=username&sort=username')
+    return [user['username'] for user in json.loads(body)]
+
+
+@st.cache_data(show_spinner="Downloading logs ...", max_entries=32)
+def load_server_logs(server, username, watermark):
+    """All of one user's logs from /api/logs/classified (NDJSON), cached per watermark"""
+    query = urllib.parse.urlencode({'username': username, 'format': 'ndjson'})
+    request = urllib.request.Request(f'{server}/api/logs/classified?{query}')
+    chunks, records = [], []
+    with urllib.request.urlopen(request, timeout=600) as response:
+        for line in response:
+            entry = json.loads(line)
+            if 'timestamp' not in entry:
+                continue  # 最終行の next_cursor
+            records.append((entry['timestamp'], entry['username'], entry['action'],
+                            entry['detail'], entry['document_name']))
+            if len(records) >= CSV_CHUNK_ROWS:
+                chunks.append(normalize_chunk(pd.DataFrame.from_records(records, columns=LOG_COLUMNS)))
+                records = []
+    if records:
+        chunks.append(normalize_chunk(pd.DataFrame.from_records(records, columns=LOG_COLUMNS)))
+    return combine_frames(chunks)  # API は新しいもの順
+
+
+@st.cache_data(ttl=WATERMARK_TTL_SECONDS, show_spinner=False)
+def db_watermark(db_path):
+    """(max log id, data generation) from the server's bookkeeping tables"""
+    with closing(sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)) as conn:
+        max_log_id = conn.execute('SELECT MAX(max_log_id) FROM user_watermarks').fetchone()[0]
+        generation = conn.execute("SELECT value FROM app_meta WHERE key = 'data_generation'").fetchone()
+    return max_log_id, generation[0] if generation else None
+
+
+@st.cache_data(show_spinner=False, ttl=WATERMARK_TTL_SECONDS)
+def db_usernames(db_path):
+    with closing(sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)) as conn:
+        return [row[0] for row in conn.execute('SELECT username FROM users ORDER BY username')]
+
+
+def import_server_module(db_path):
+    """server_v2, reading the archive directory next to db_path (the archive format is defined there)"""
+    if SERVER_DIR not in sys.path:
+        sys.path.insert(0, SERVER_DIR)
+    import server_v2
+    server_v2.LOG_BASE_DIR = os.path.dirname(db_path)
+    return server_v2
+
+
+def read_db_archives(conn, db_path, usernames):
+    """Rows of archived months (server_v2 --archive) as DataFrames; empty before the first archive run"""
+    server_v2 = import_server_module(db_path)
+    columns = ('timestamp', 'username', 'action', 'detail', 'document_name')
+    frames = []
+    for username in usernames:
+        rows = server_v2.iter_archived_rows(conn, columns, username)
+        if rows is None:
+            continue
+        while chunk := list(islice(rows, DB_CHUNK_ROWS)):
+            frames.append(normalize_chunk(pd.DataFrame.from_records(chunk, columns=LOG_COLUMNS)))
+    return frames
+
+
+@st.cache_data(show_spinner="Reading database ...", max_entries=16)
+def load_db_logs(db_path, usernames, watermark):
+    """Selected users' logs straight from rhinolog.db (read-only, chunked), cached per watermark"""
+    with closing(sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)) as conn:
+        placeholders = ','.join('?' * len(usernames))
+        chunks = read_db_archives(conn, db_path, list(usernames))
+        chunks += [normalize_chunk(chunk) for chunk in pd.read_sql_query(
+            f'''SELECT timestamp AS Timestamp, username AS UserID, action AS Action,
+                       detail AS Detail, document_name AS DocumentName
+                FROM logs WHERE username IN ({placeholders})''',
+            conn, params=list(usernames), chunksize=DB_CHUNK_ROWS)]
+    return combine_frames(chunks)
+
+
+# --- 集計（入力データのキーごとにキャッシュ） ---
+@st.cache_data(show_spinner=False, max_entries=32)
+def action_counts(data_key, _log_df):
+    """UserID x Action count matrix"""
+    counts = _log_df.groupby(['UserID', 'Action'], observed=True).size().unstack(fill_value=0)
+    counts.columns = counts.columns.astype(str)
+    counts.index = counts.index.astype(str)
+    return counts
+
+
+def skill_scores(counts):
+    """Scores of every user at once from the count matrix (one row per user)"""
+    scores = pd.DataFrame(index=counts.index)
+    for skill, actions in SCORE_ACTIONS.items():
+        scores[skill] = counts.reindex(columns=actions, fill_value=0).sum(axis=1)
+    for skill, pattern in SCORE_ACTION_PATTERNS.items():
+        scores[skill] = counts.loc[:, counts.columns.str.contains(pattern)].sum(axis=1).astype(int)
+    return scores
+
+
+# --- データソース ---
+source = st.sidebar.radio("Data source", ["Upload CSV", "Server API", "SQLite DB"])
+log_df = None
+data_key = None
+meta = None
+
+if source == "Upload CSV":
+    log_files = st.file_uploader("Upload Log CSV", type="csv", accept_multiple_files=True)
+    meta_file = st.file_uploader("Upload Meta JSON (optional)", type="json")
+    if meta_file:
+        meta = json.load(meta_file)
+    if log_files:
+        frames, digests = [], []
+        for log_file in log_files:
+            data = log_file.getvalue()
+            digest = hashlib.sha1(data).hexdigest()
+            frames.append(load_csv(digest, log_file.name, data))
+            digests.append(digest)
+        log_df = frames[0] if len(frames) == 1 else combine_frames(frames)
+        data_key = ('csv', tuple(digests))
+
+elif source == "Server API":
+    server = st.sidebar.text_input("Server URL", DEFAULT_SERVER).rstrip('/')
+    try:
+        usernames = st.sidebar.multiselect("Users", server_usernames(server))
+        if usernames:
+            frames = [load_server_logs(server, username, server_watermark(server, username))
+                      for username in usernames]
+            log_df = frames[0] if len(frames) == 1 else combine_frames(frames)
+            data_key = ('api', server, tuple((u, server_watermark(server, u)) for u in usernames))
+    except OSError as e:
+        st.error(f"Could not reach {server}: {e}")
+
+else:
+    db_path = st.sidebar.text_input("Database path", DEFAULT_DB_PATH)
+    if os.path.exists(db_path):
+        usernames = st.sidebar.multiselect("Users", db_usernames(db_path))
+        if usernames:
+            watermark = db_watermark(db_path)
+            log_df = load_db_logs(db_path, tuple(sorted(usernames)), watermark)
+            data_key = ('db', db_path, tuple(sorted(usernames)), watermark)
+    else:
+        st.sidebar.error("Database file not found")
+
+if log_df is not None:
+    if meta is not None:
+        st.subheader("📁 Meta Information")
+        st.json(meta, expanded=False)
 
     st.subheader("🧠 Operation Log")
+    st.caption(f"{len(log_df):,} events, {log_df['UserID'].nunique()} users, "
+               f"{log_df.memory_usage(deep=True).sum() / 1e6:.1f} MB in memory")
     st.dataframe(log_df.tail(20), use_container_width=True)
 
+    counts = action_counts(data_key, log_df)
+
     # --- イベントの頻度 ---
-    freq = log_df['Action'].value_counts().reset_index()
-    freq.columns = ['Action', 'Count']
+    freq = counts.sum(axis=0).sort_values(ascending=False).rename_axis('Action').reset_index(name='Count')
     fig_bar = px.bar(freq, x='Action', y='Count', title="Event Frequency", text='Count')
     st.plotly_chart(fig_bar, use_container_width=True)
 
-    # --- 簡易スコアリング（例） ---
-    score = {
-        "Modeling": freq.query("Action == 'Object Added'")['Count'].sum(),
-        "Cleaning": freq.query("Action == 'Object Deleted'")['Count'].sum(),
-        "Command": freq.query("Action == 'Command Started'")['Count'].sum(),
-        "Saving": freq.query("Action == 'File Saved'")['Count'].sum(),
-        "ViewOps": freq.query("Action.str.contains('View')", engine='python')['Count'].sum()
-    }
-    radar_df = pd.DataFrame({"Skill": list(score.keys()), "Score": list(score.values())})
-    fig_radar = px.line_polar(radar_df, r='Score', theta='Skill', line_close=True, title="Skill Radar")
+    # --- 簡易スコアリング（ユーザーごと） ---
+    scores = skill_scores(counts)
+    radar_df = scores.rename_axis('UserID').reset_index().melt(id_vars='UserID', var_name='Skill', value_name='Score')
+    fig_radar = px.line_polar(radar_df, r='Score', theta='Skill', color='UserID', line_close=True,
+                              title="Skill Radar")
     st.plotly_chart(fig_radar, use_container_width=True)
+    if len(scores) > 1:
+        st.dataframe(scores, use_container_width=True)
 
 else:
-    st.info("Please upload both a log CSV and a meta JSON file to begin.")
+    st.info("Upload log CSV files, or pick users from the server or the database, to begin.")
@@ -2,6 +2,7 @@
 using System.Collections.Generic;
 using System.Data;
 using System.IO;
+using System.Linq;
 using System.Net.Http;
 using System.Text;
 using System.Text.Json;
@@ -47,6 +48,17 @@ namespace GELTrainingLog
             public bool registered { get; set; }
         }
 
+        private class LogEvent
+        {
+            public string Timestamp { get; set; }
+            public string UserID { get; set; }
+            public string Action { get; set; }
+            public string Detail { get; set; }
+            public string DocumentName { get; set; }
+            // サーバーはユーザーごとに EventId で重複を弾くので、送信済みか分からないバッチも再送してよい
+            public string EventId { get; set; }
+        }
+
         private DateTime? _periodStart;
         private DateTime? _periodEnd;
         private bool _isRegisteredUser = false;
@@ -54,13 +66,25 @@ namespace GELTrainingLog
         private static string _userID;
         private static  string _logFolder;
         private static string _sessionLogFile;
+        private static string _spoolFile;
         private const string SERVER_URL = "http://136.111.186.176:5000";
         private static readonly HttpClient _httpClient = new HttpClient();
 
         public override PlugInLoadTime LoadTime => PlugInLoadTime.AtStartup;
 
+        // バッチ送信の設定（件数 or 経過時間のどちらかに達したらフラッシュ）
+        private const int BATCH_MAX_EVENTS = 200;
+        private static readonly TimeSpan BATCH_MAX_WAIT = TimeSpan.FromSeconds(2);
+        private const int UPLOAD_CHUNK_EVENTS = 500;
+        private static readonly TimeSpan RETRY_INITIAL_DELAY = TimeSpan.FromSeconds(2);
+        private static readonly TimeSpan RETRY_MAX_DELAY = TimeSpan.FromMinutes(5);
+
         private readonly object _logLock = new();
-        private readonly Queue<string> _logQueue = new();
+        private readonly Queue<LogEvent> _logQueue = new();
+        private DateTime? _oldestQueuedAt;
+
+        private readonly object _flushLock = new();
+        private readonly object _spoolLock = new();
         
         public GELTrainingLogPlugin()
         {
@@ -85,10 +109,30 @@ namespace GELTrainingLog
             //         return; // ログを記録しない
             // }
 
-            var logLine = $"{DateTime.Now:yyyy-MM-dd HH:mm:ss},{_userID},{action},\"{detail}\"\n";
+            string docName = "Untitled";
+            var doc = RhinoDoc.ActiveDoc;
+            if (doc != null && !string.IsNullOrEmpty(doc.Name))
+            {
+                docName = Path.GetFileNameWithoutExtension(doc.Name);
+            }
+
+            var logEvent = new LogEvent
+            {
+                Timestamp = now.ToString("yyyy-MM-dd HH:mm:ss"),
+                UserID = _userID,
+                Action = action,
+                Detail = detail ?? "",
+                DocumentName = docName,
+                EventId = Guid.NewGuid().ToString("N")
+            };
+
             lock (_logLock)
             {
-                _logQueue.Enqueue(logLine);
+                if (_logQueue.Count == 0)
+                {
+                    _oldestQueuedAt = DateTime.UtcNow;
+                }
+                _logQueue.Enqueue(logEvent);
             }
         }
 
@@ -113,6 +157,9 @@ namespace GELTrainingLog
                 Directory.CreateDirectory(_logFolder);
             }
 
+            // サーバー未送信のログを保持するスプールファイル（再起動後も再送する）
+            _spoolFile = Path.Combine(_logFolder, "pending_upload.ndjson");
+
             LoadUserInfoFromServer();
 
             RhinoApp.WriteLine("GEL Rhino Operation Logger Loaded");
@@ -255,6 +302,19 @@ namespace GELTrainingLog
 
             RhinoDoc.LayerTableEvent -= OnLayerTableEvent;
             RhinoDoc.GroupTableEvent -= OnGroupTableEvent;
+
+            // キューに残っているログをローカルCSVとスプールに書き出す（次回起動時に送信）
+            if (_isRegisteredUser)
+            {
+                try
+                {
+                    FlushQueueToDisk();
+                }
+                catch (Exception e)
+                {
+                    RhinoApp.WriteLine("⚠ ログ書き込み中にエラー: " + e.Message);
+                }
+            }
         }
 
         private void OnCommandBegin(object sender, CommandEventArgs e)
@@ -327,90 +387,174 @@ namespace GELTrainingLog
             }
         }
 
-        private async Task SendLogToServerAsync(string timestamp, string action, string detail)
+        private static string ToCsvLine(LogEvent logEvent)
         {
-            if (!_isRegisteredUser)
-                return;
+            // Detail にはカンマや引用符を含むパスが入るため、CSVのルールどおりにエスケープする
+            string detail = (logEvent.Detail ?? "").Replace("\"", "\"\"");
+            return $"{logEvent.Timestamp},{logEvent.UserID},{logEvent.Action},\"{detail}\"\n";
+        }
 
-            try
+        private void FlushQueueToDisk()
+        {
+            lock (_flushLock)
             {
-                var doc = RhinoDoc.ActiveDoc;
-                string docName = "Untitled";
-                if (doc != null && !string.IsNullOrEmpty(doc.Name))
+                List<LogEvent> batch;
+                lock (_logLock)
+                {
+                    if (_logQueue.Count == 0)
+                        return;
+
+                    batch = new List<LogEvent>(_logQueue);
+                    _logQueue.Clear();
+                    _oldestQueuedAt = null;
+                }
+
+                // ローカルCSVにまとめて1回で書き込み
+                var csv = new StringBuilder();
+                foreach (var logEvent in batch)
                 {
-                    docName = Path.GetFileNameWithoutExtension(doc.Name);
+                    csv.Append(ToCsvLine(logEvent));
                 }
+                File.AppendAllText(_sessionLogFile, csv.ToString());
 
-                var logData = new
+                // 送信待ちとしてスプールに追記（送信に成功したら取り除く）
+                var spool = new StringBuilder();
+                foreach (var logEvent in batch)
                 {
-                    Timestamp = timestamp,
-                    UserID = _userID,
-                    Action = action,
-                    Detail = detail,
-                    DocumentName = docName
-                };
+                    spool.Append(JsonSerializer.Serialize(logEvent)).Append('\n');
+                }
+                lock (_spoolLock)
+                {
+                    File.AppendAllText(_spoolFile, spool.ToString());
+                }
+            }
+        }
+
+        private async Task<bool> UploadSpoolAsync()
+        {
+            string[] pending;
+            lock (_spoolLock)
+            {
+                if (!File.Exists(_spoolFile))
+                    return true;
+                pending = File.ReadAllLines(_spoolFile);
+            }
+
+            int sent = 0;
+            bool success = true;
+            while (sent < pending.Length)
+            {
+                int count = Math.Min(UPLOAD_CHUNK_EVENTS, pending.Length - sent);
+                var body = string.Join("\n", pending, sent, count);
+                var content = new StringContent(body, Encoding.UTF8, "application/x-ndjson");
 
-                var jsonContent = JsonSerializer.Serialize(logData);
-                var content = new StringContent(jsonContent, Encoding.UTF8, "application/json");
+                try
+                {
+                    var response = await _httpClient.PostAsync($"{SERVER_URL}/api/log/upload/batch", content);
+                    int status = (int)response.StatusCode;
 
-                var response = await _httpClient.PostAsync($"{SERVER_URL}/api/log/upload", content);
+                    if (!response.IsSuccessStatusCode && status != 400 && status != 413)
+                    {
+                        RhinoApp.WriteLine($"⚠ Server log failed: {response.StatusCode}");
+                        success = false;
+                        break;
+                    }
 
-                if (!response.IsSuccessStatusCode)
+                    // 400/413 は再送しても通らないので破棄する（ローカルCSVには残っている）
+                    if (!response.IsSuccessStatusCode)
+                    {
+                        RhinoApp.WriteLine($"⚠ Server rejected log batch: {response.StatusCode}");
+                    }
+                }
+                catch (Exception ex)
                 {
-                    RhinoApp.WriteLine($"⚠ Server log failed: {response.StatusCode}");
+                    // サーバーへの送信が失敗してもローカルログとスプールは残る
+                    RhinoApp.WriteLine($"⚠ Server connection error: {ex.Message}");
+                    success = false;
+                    break;
                 }
+
+                sent += count;
             }
-            catch (Exception ex)
+
+            if (sent > 0)
             {
-                // サーバーへの送信が失敗してもローカルログは残る
-                RhinoApp.WriteLine($"⚠ Server connection error: {ex.Message}");
+                lock (_spoolLock)
+                {
+                    // 送信中に追記された行は残したまま、送信済みの先頭行だけを取り除く
+                    var current = File.ReadAllLines(_spoolFile);
+                    var remaining = current.Skip(sent).ToArray();
+                    if (remaining.Length == 0)
+                    {
+                        File.Delete(_spoolFile);
+                    }
+                    else
+                    {
+                        var tempFile = _spoolFile + ".tmp";
+                        File.WriteAllLines(tempFile, remaining);
+                        File.Move(tempFile, _spoolFile, true);
+                    }
+                }
             }
+
+            return success;
         }
 
         private void StartLogWriter()
         {
             Task.Run((async () =>
             {
+                var retryDelay = RETRY_INITIAL_DELAY;
+                var nextUploadAt = DateTime.MinValue;
+
                 while (true)
                 {
-                    string logLine = null;
+                    bool flushDue;
                     lock (_logLock)
                     {
-                        if (_logQueue.Count > 0)
-                        {
-                            logLine = _logQueue.Dequeue();
-                        }
+                        flushDue = _logQueue.Count >= BATCH_MAX_EVENTS ||
+                                   (_oldestQueuedAt.HasValue && DateTime.UtcNow - _oldestQueuedAt.Value >= BATCH_MAX_WAIT);
                     }
 
-                    if(logLine != null)
+                    if (flushDue)
                     {
                         try
                         {
-                            // ローカルCSVに書き込み
-                            File.AppendAllText(_sessionLogFile, logLine);
-
-                            // CSVログから情報を抽出してサーバーに送信
-                            var parts = logLine.Split(',');
-                            if (parts.Length >= 3)
-                            {
-                                string timestamp = parts[0];
-                                string userId = parts[1];
-                                string action = parts[2];
-                                string detail = parts.Length > 3 ? parts[3].Trim().Trim('"') : "";
-
-                                // サーバーに非同期送信（awaitせずに fire-and-forget）
-                                _ = SendLogToServerAsync(timestamp, action, detail);
-                            }
+                            FlushQueueToDisk();
                         }
                         catch (Exception e)
                         {
                             RhinoApp.WriteLine("⚠ ログ書き込み中にエラー: " + e.Message);
                         }
                     }
-                    else
+
+                    // スプールに溜まったログをバッチ送信（失敗時は指数バックオフで再試行）
+                    if (_isRegisteredUser && DateTime.UtcNow >= nextUploadAt && File.Exists(_spoolFile))
                     {
-                        await Task.Delay(100); // Sleep for a short time to avoid busy waiting
+                        bool uploaded;
+                        try
+                        {
+                            uploaded = await UploadSpoolAsync();
+                        }
+                        catch (Exception e)
+                        {
+                            RhinoApp.WriteLine("⚠ ログ送信中にエラー: " + e.Message);
+                            uploaded = false;
+                        }
+
+                        if (uploaded)
+                        {
+                            retryDelay = RETRY_INITIAL_DELAY;
+                            nextUploadAt = DateTime.MinValue;
+                        }
+                        else
+                        {
+                            nextUploadAt = DateTime.UtcNow + retryDelay;
+                            retryDelay = TimeSpan.FromTicks(Math.Min(retryDelay.Ticks * 2, RETRY_MAX_DELAY.Ticks));
+                        }
                     }
+
+                    await Task.Delay(100); // Sleep for a short time to avoid busy waiting
                 }
             }));
         }
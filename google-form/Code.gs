@@ -8,6 +8,11 @@ const SERVER_URL = "http://136.111.186.176:5000/api/user/register";
 const TRAINING_START_DATE = "2025-05-01";
 const TRAINING_END_DATE = "2025-05-31";
 
+// 一括登録（registerCohortFromSheet）の設定
+const BULK_REGISTER_URL = SERVER_URL.replace("/api/user/register", "/api/users/bulk");
+const BULK_CHUNK_SIZE = 200;  // 1リクエストあたりの人数（サーバーの上限は2000）
+const USERNAME_COLUMN_HEADER = "登録ユーザー名";  // 発行したユーザー名を回答シートに書き戻す列
+
 /**
  * フォーム送信時のトリガー関数
  * Googleフォームで「送信時」トリガーを設定してください
@@ -23,86 +28,8 @@ function onFormSubmit(e) {
     // ヘッダー行を取得（列名）
     const headers = sheet.getRange(1, 1, 1, sheet.getLastColumn()).getValues()[0];
 
-    // 列名から値を取得するヘルパー関数
-    function getColumnValue(columnName) {
-      const index = headers.findIndex(h =>
-        h.includes(columnName) ||
-        h.toLowerCase().includes(columnName.toLowerCase())
-      );
-      return index >= 0 ? rowData[index] : null;
-    }
-
     // ユーザーデータを構築
-    let userData = {
-      username: "",
-      full_name: "",
-      email: "",
-      rhino_experience: "未経験",
-      grasshopper_experience: "未経験",
-      self_learning_score: 60,
-      learning_group: "",
-      cad_tools: "",
-      modeling_tools: "",
-      programming_languages: ""
-    };
-
-    // 基本情報
-    userData.full_name = getColumnValue("お名前") || getColumnValue("氏名") || getColumnValue("名前") || "";
-    userData.email = getColumnValue("メールアドレス") || getColumnValue("メール") || getColumnValue("Email") || "";
-
-    // Rhino経験レベル
-    const rhinoExp = getColumnValue("Rhino") || getColumnValue("rhino");
-    if (rhinoExp) {
-      userData.rhino_experience = rhinoExp;
-    }
-
-    // Grasshopper経験レベル
-    const ghExp = getColumnValue("Grasshopper") || getColumnValue("grasshopper");
-    if (ghExp) {
-      userData.grasshopper_experience = ghExp;
-    }
-
-    // CAD/BIM経験
-    const cadTools = getColumnValue("CAD") || getColumnValue("BIM") || getColumnValue("モデリングツール");
-    if (cadTools) {
-      userData.cad_tools = String(cadTools);
-    }
-
-    // 3Dモデリング/レンダリング経験
-    const modelingTools = getColumnValue("3Dモデリング") || getColumnValue("レンダリング");
-    if (modelingTools) {
-      userData.modeling_tools = String(modelingTools);
-    }
-
-    // プログラミング言語経験
-    const progLangs = getColumnValue("プログラミング言語") || getColumnValue("プログラミング");
-    if (progLangs) {
-      userData.programming_languages = String(progLangs);
-    }
-
-    // 自己学習能力
-    const selfLearning = getColumnValue("新しいソフトウェア") || getColumnValue("自己学習");
-    if (selfLearning) {
-      if (typeof selfLearning === 'number') {
-        userData.self_learning_score = selfLearning * 20; // 1-5 → 20-100
-      } else if (String(selfLearning).includes("⭐")) {
-        const starCount = (String(selfLearning).match(/⭐/g) || []).length;
-        userData.self_learning_score = starCount * 20;
-      } else {
-        const numbers = String(selfLearning).match(/\d+/);
-        if (numbers) {
-          userData.self_learning_score = parseInt(numbers[0]) * 20;
-        }
-      }
-    }
-
-    // 学習グループを生成（送信日ベース: YYYYMMDD）
-    const timestamp = rowData[0]; // 最初の列はタイムスタンプ
-    const submitDate = new Date(timestamp);
-    const year = submitDate.getFullYear();
-    const month = String(submitDate.getMonth() + 1).padStart(2, '0');
-    const day = String(submitDate.getDate()).padStart(2, '0');
-    userData.learning_group = `${year}${month}${day}`;
+    const userData = buildUserData(headers, rowData);
 
     // 必須フィールドのチェック
     if (!userData.full_name || !userData.email) {
@@ -111,8 +38,9 @@ function onFormSubmit(e) {
       return;
     }
 
-    // ユニークなユーザーIDを自動生成
+    // ユニークなユーザーIDを自動生成（一括登録で再登録しても同じユーザーになるようシートに残す）
     userData.username = generateUniqueUserId();
+    sheet.getRange(lastRow, getUsernameColumn(sheet, headers)).setValue(userData.username);
 
     // デフォルト期間を取得（管理者が設定した期間）
     const defaultPeriod = getDefaultPeriod();
@@ -159,6 +87,193 @@ function onFormSubmit(e) {
   }
 }
 
+/**
+ * 回答シートの全行をまとめて登録（受講者名簿の取り込み・期間変更後の再登録用）
+ * スクリプトエディタで直接実行してください。
+ * 「登録ユーザー名」列に値がある行はそのユーザーを更新し、ない行は新しいユーザー名を発行します。
+ * 設定ファイルのメールは新規登録したユーザーにだけ送ります
+ */
+function registerCohortFromSheet() {
+  const form = FormApp.getActiveForm();
+  const sheet = SpreadsheetApp.openById(form.getDestinationId()).getSheets()[0];
+  const lastRow = sheet.getLastRow();
+  if (lastRow < 2) {
+    Logger.log("No responses to register");
+    return;
+  }
+
+  const headers = sheet.getRange(1, 1, 1, sheet.getLastColumn()).getValues()[0];
+  const usernameColumn = getUsernameColumn(sheet, headers);
+  const rows = sheet.getRange(2, 1, lastRow - 1, usernameColumn).getValues();
+  const defaultPeriod = getDefaultPeriod();
+
+  // シートの行からユーザーデータを構築（users[i] はシートの sheetRows[i] 行目）
+  const users = [];
+  const sheetRows = [];
+  const usedNames = new Set(rows.map(rowData => rowData[usernameColumn - 1]).filter(name => name));
+  rows.forEach((rowData, i) => {
+    const userData = buildUserData(headers, rowData);
+    if (!userData.full_name || !userData.email) {
+      Logger.log(`Row ${i + 2}: missing name or email, skipped`);
+      return;
+    }
+
+    let username = rowData[usernameColumn - 1];
+    if (!username) {
+      do {
+        username = generateUniqueUserId();
+      } while (usedNames.has(username));
+      usedNames.add(username);
+      rowData[usernameColumn - 1] = username;
+    }
+
+    userData.username = String(username);
+    userData.start_date = defaultPeriod.start_date;
+    userData.end_date = defaultPeriod.end_date;
+    users.push(userData);
+    sheetRows.push(i + 2);
+  });
+
+  // 送信前にユーザー名を書き戻す（途中で失敗しても再実行で同じユーザー名を使う）
+  sheet.getRange(2, usernameColumn, rows.length, 1)
+    .setValues(rows.map(rowData => [rowData[usernameColumn - 1]]));
+
+  const counts = { created: 0, updated: 0, rejected: 0 };
+  const createdUsers = [];
+  for (let start = 0; start < users.length; start += BULK_CHUNK_SIZE) {
+    const chunk = users.slice(start, start + BULK_CHUNK_SIZE);
+    const options = {
+      "method": "post",
+      "contentType": "application/json",
+      "payload": JSON.stringify({ users: chunk }),
+      "muteHttpExceptions": true
+    };
+
+    const response = UrlFetchApp.fetch(BULK_REGISTER_URL, options);
+    if (response.getResponseCode() !== 200) {
+      Logger.log(`\n✗ Error: Server returned ${response.getResponseCode()} for rows ${sheetRows[start]}-${sheetRows[start + chunk.length - 1]}`);
+      Logger.log(response.getContentText());
+      break;
+    }
+
+    const responseData = JSON.parse(response.getContentText());
+    responseData.results.forEach(result => {
+      counts[result.status]++;
+      if (result.status === "rejected") {
+        Logger.log(`✗ Row ${sheetRows[start + result.index]}: ${result.error}`);
+      } else if (result.status === "created") {
+        createdUsers.push(chunk[result.index]);
+      }
+    });
+  }
+
+  Logger.log(`\n✓ Cohort registered: ${counts.created} created, ${counts.updated} updated, ${counts.rejected} rejected`);
+
+  // 設定ファイルを生成してメール送信（新規登録のみ）
+  createdUsers.forEach(userData => sendConfigFile(userData));
+}
+
+/**
+ * 回答シートの「登録ユーザー名」列の番号（1始まり）。なければ右端に追加する
+ */
+function getUsernameColumn(sheet, headers) {
+  const index = headers.indexOf(USERNAME_COLUMN_HEADER);
+  if (index >= 0) {
+    return index + 1;
+  }
+  const column = sheet.getLastColumn() + 1;
+  sheet.getRange(1, column).setValue(USERNAME_COLUMN_HEADER);
+  return column;
+}
+
+/**
+ * 回答シートの1行からユーザーデータを構築（username・研修期間は呼び出し側で設定）
+ */
+function buildUserData(headers, rowData) {
+  // 列名から値を取得するヘルパー関数
+  function getColumnValue(columnName) {
+    const index = headers.findIndex(h =>
+      h.includes(columnName) ||
+      h.toLowerCase().includes(columnName.toLowerCase())
+    );
+    return index >= 0 ? rowData[index] : null;
+  }
+
+  // ユーザーデータを構築
+  let userData = {
+    username: "",
+    full_name: "",
+    email: "",
+    rhino_experience: "未経験",
+    grasshopper_experience: "未経験",
+    self_learning_score: 60,
+    learning_group: "",
+    cad_tools: "",
+    modeling_tools: "",
+    programming_languages: ""
+  };
+
+  // 基本情報
+  userData.full_name = getColumnValue("お名前") || getColumnValue("氏名") || getColumnValue("名前") || "";
+  userData.email = getColumnValue("メールアドレス") || getColumnValue("メール") || getColumnValue("Email") || "";
+
+  // Rhino経験レベル
+  const rhinoExp = getColumnValue("Rhino") || getColumnValue("rhino");
+  if (rhinoExp) {
+    userData.rhino_experience = rhinoExp;
+  }
+
+  // Grasshopper経験レベル
+  const ghExp = getColumnValue("Grasshopper") || getColumnValue("grasshopper");
+  if (ghExp) {
+    userData.grasshopper_experience = ghExp;
+  }
+
+  // CAD/BIM経験
+  const cadTools = getColumnValue("CAD") || getColumnValue("BIM") || getColumnValue("モデリングツール");
+  if (cadTools) {
+    userData.cad_tools = String(cadTools);
+  }
+
+  // 3Dモデリング/レンダリング経験
+  const modelingTools = getColumnValue("3Dモデリング") || getColumnValue("レンダリング");
+  if (modelingTools) {
+    userData.modeling_tools = String(modelingTools);
+  }
+
+  // プログラミング言語経験
+  const progLangs = getColumnValue("プログラミング言語") || getColumnValue("プログラミング");
+  if (progLangs) {
+    userData.programming_languages = String(progLangs);
+  }
+
+  // 自己学習能力
+  const selfLearning = getColumnValue("新しいソフトウェア") || getColumnValue("自己学習");
+  if (selfLearning) {
+    if (typeof selfLearning === 'number') {
+      userData.self_learning_score = selfLearning * 20; // 1-5 → 20-100
+    } else if (String(selfLearning).includes("⭐")) {
+      const starCount = (String(selfLearning).match(/⭐/g) || []).length;
+      userData.self_learning_score = starCount * 20;
+    } else {
+      const numbers = String(selfLearning).match(/\d+/);
+      if (numbers) {
+        userData.self_learning_score = parseInt(numbers[0]) * 20;
+      }
+    }
+  }
+
+  // 学習グループを生成（送信日ベース: YYYYMMDD）
+  const timestamp = rowData[0]; // 最初の列はタイムスタンプ
+  const submitDate = new Date(timestamp);
+  const year = submitDate.getFullYear();
+  const month = String(submitDate.getMonth() + 1).padStart(2, '0');
+  const day = String(submitDate.getDate()).padStart(2, '0');
+  userData.learning_group = `${year}${month}${day}`;
+
+  return userData;
+}
+
 /**
  * 設定ファイルを生成してメール送信
  */
@@ -0,0 +1,251 @@
+"""
+Load test: a classroom of synthetic Rhino clients against a running server.
+
+1. registers the synthetic users
+2. replays their event streams through /api/log/upload/batch at the given concurrency
+   (NDJSON, like the plugin; 429 answers are retried after Retry-After)
+3. hits each dashboard read endpoint and reports p50/p95/p99 latency
+
+Usage:
+    python3 benchmarks/load_test.py --spawn                       # temporary DB + local server
+    python3 benchmarks/load_test.py --server http://127.0.0.1:5000 --db /home/rhinologs/rhinolog.db
+
+Only the standard library is used so it runs anywhere the server runs.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from synthetic import EventProfile, SERVER_DIR, generate_user_events, registration_payload, synthetic_usernames
+
+READ_ENDPOINTS = [
+    ('users', '/api/users'),
+    ('dashboard', '/api/dashboard/{username}'),
+    ('logs', '/api/logs?username={username}&limit=100'),
+    ('logs_classified', '/api/logs/classified?username={username}&limit=1000'),
+    ('stats', '/api/stats/{username}'),
+    ('stats_workflow', '/api/stats/workflow/{username}'),
+    ('action_groups', '/api/action-groups/{username}'),
+]
+
+SPAWN_CODE = '''
+import sys, logging
+import server_v2
+server_v2.DB_PATH = sys.argv[1]
+server_v2.init_db()
+server_v2.load_command_classification()
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
+server_v2.app.run(host='127.0.0.1', port=int(sys.argv[2]), threaded=True)
+'''
+
+
+def http_request(method, url, body=None, content_type='application/json', timeout=60):
+    """Returns (status, headers, elapsed_seconds)"""
+    data = body.encode('utf-8') if isinstance(body, str) else body
+    req = urllib.request.Request(url, data=data, method=method)
+    if data is not None:
+        req.add_header('Content-Type', content_type)
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            response.read()
+            return response.status, response.headers, time.perf_counter() - started
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code, e.headers, time.perf_counter() - started
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # nearest-rank
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def latency_summary(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(max(latencies) * 1000, 2) if latencies else 0.0
+    }
+
+
+def db_size(db_path):
+    if not db_path:
+        return None
+    return sum(os.path.getsize(db_path + suffix) for suffix in ('', '-wal', '-shm')
+               if os.path.exists(db_path + suffix))
+
+
+def spawn_server(port):
+    """Start server_v2 on a temporary database; returns (process, db_path)"""
+    workdir = tempfile.mkdtemp(prefix='rhinolog-bench-')
+    db_path = os.path.join(workdir, 'rhinolog.db')
+    log_file = open(os.path.join(workdir, 'server.log'), 'w')
+    process = subprocess.Popen([sys.executable, '-c', SPAWN_CODE, db_path, str(port)],
+                               cwd=SERVER_DIR, stdout=log_file, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            if http_request('GET', url + '/api/health', timeout=1)[0] == 200:
+                return process, db_path
+        except OSError:
+            pass
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'Server did not start, see {log_file.name}')
+
+
+def register_users(server, usernames, concurrency, seed):
+    rng = random.Random(seed)
+    payloads = [json.dumps(registration_payload(username, rng)) for username in usernames]
+    with ThreadPoolExecutor(concurrency) as pool:
+        statuses = list(pool.map(lambda body: http_request('POST', server + '/api/user/register', body)[0], payloads))
+    failed = [u for u, status in zip(usernames, statuses) if status != 200]
+    if failed:
+        raise RuntimeError(f'Registration failed for {len(failed)} users: {failed[:5]}')
+
+
+def ingest(server, streams, batch_size, concurrency):
+    """Upload every stream in plugin-sized NDJSON batches; returns ingestion metrics"""
+    batches = []
+    for events in streams:
+        for i in range(0, len(events), batch_size):
+            chunk = events[i:i + batch_size]
+            batches.append((len(chunk), '\n'.join(json.dumps(e, ensure_ascii=False) for e in chunk)))
+
+    latencies = []
+    counters = {'accepted_events': 0, 'throttled': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def upload(batch):
+        count, body = batch
+        while True:
+            status, headers, elapsed = http_request('POST', server + '/api/log/upload/batch', body,
+                                                    content_type='application/x-ndjson')
+            with lock:
+                latencies.append(elapsed)
+                if status == 429:
+                    counters['throttled'] += 1
+                elif status in (200, 202):
+                    counters['accepted_events'] += count
+                else:
+                    counters['errors'] += 1
+            if status != 429:
+                return
+            time.sleep(float(headers.get('Retry-After', 1)))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(upload, batches))
+    elapsed = time.perf_counter() - started
+
+    return dict(counters, batches=len(batches), seconds=round(elapsed, 2),
+                events_per_second=round(counters['accepted_events'] / elapsed, 1) if elapsed else 0.0,
+                latency=latency_summary(latencies))
+
+
+def read_load(server, usernames, requests_per_endpoint, concurrency, seed):
+    rng = random.Random(seed)
+    results = {}
+    for name, template in READ_ENDPOINTS:
+        urls = [server + template.format(username=rng.choice(usernames)) for _ in range(requests_per_endpoint)]
+        with ThreadPoolExecutor(concurrency) as pool:
+            responses = list(pool.map(lambda url: http_request('GET', url), urls))
+        summary = latency_summary([elapsed for _, _, elapsed in responses])
+        summary['errors'] = sum(1 for status, _, _ in responses if status >= 400)
+        results[name] = summary
+    return results
+
+
+def print_report(report):
+    ingest_result = report['ingest']
+    print(f"\nIngestion: {ingest_result['accepted_events']} events in {ingest_result['batches']} batches, "
+          f"{ingest_result['seconds']} s -> {ingest_result['events_per_second']} events/s "
+          f"(throttled {ingest_result['throttled']}, errors {ingest_result['errors']})")
+    latency = ingest_result['latency']
+    print(f"  batch latency p50={latency['p50_ms']} ms p95={latency['p95_ms']} ms p99={latency['p99_ms']} ms")
+
+    print(f"\n{'endpoint':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for name, summary in report['reads'].items():
+        print(f"{name:<18}{summary['p50_ms']:>10}{summary['p95_ms']:>10}{summary['p99_ms']:>10}"
+              f"{summary['max_ms']:>10}{summary['errors']:>8}")
+
+    if report['db_size_before'] is not None:
+        growth = report['db_size_after'] - report['db_size_before']
+        print(f"\nDB size: {report['db_size_before'] / 1e6:.2f} MB -> {report['db_size_after'] / 1e6:.2f} MB "
+              f"({growth / max(ingest_result['accepted_events'], 1):.0f} bytes/event)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the GEL Training Log server with synthetic clients')
+    parser.add_argument('--server', default='http://127.0.0.1:5000', help='base URL of a running server')
+    parser.add_argument('--spawn', action='store_true', help='start a local server on a temporary database')
+    parser.add_argument('--port', type=int, default=5055, help='port for --spawn')
+    parser.add_argument('--db', help='database path of the running server (for size growth)')
+    parser.add_argument('--users', type=int, default=30)
+    parser.add_argument('--events-per-user', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=200, help='events per upload (plugin default 200)')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--read-requests', type=int, default=100, help='requests per read endpoint')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    process = None
+    server, db_path = args.server.rstrip('/'), args.db
+    if args.spawn:
+        process, db_path = spawn_server(args.port)
+        server = f'http://127.0.0.1:{args.port}'
+
+    try:
+        profile = EventProfile()
+        usernames = synthetic_usernames(args.users)
+        streams = [generate_user_events(profile, username, args.events_per_user, seed=args.seed * 1000 + i)
+                   for i, username in enumerate(usernames)]
+
+        print(f"Registering {len(usernames)} users on {server} ...")
+        register_users(server, usernames, args.concurrency, args.seed)
+
+        size_before = db_size(db_path)
+        print(f"Uploading {sum(map(len, streams))} events with concurrency {args.concurrency} ...")
+        ingest_result = ingest(server, streams, args.batch_size, args.concurrency)
+        time.sleep(0.5)  # 非同期取り込みモードのキューが空になるのを待つ
+        size_after = db_size(db_path)
+
+        print(f"Reading {args.read_requests} requests per endpoint ...")
+        reads = read_load(server, usernames, args.read_requests, args.concurrency, args.seed)
+
+        report = {
+            'config': vars(args),
+            'ingest': ingest_result,
+            'reads': reads,
+            'db_size_before': size_before,
+            'db_size_after': size_after
+        }
+        print_report(report)
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
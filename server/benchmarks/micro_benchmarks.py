@@ -0,0 +1,123 @@
+"""
+Micro-benchmarks for the per-event hot paths of server_v2.py.
+
+    python3 benchmarks/micro_benchmarks.py                          # print timings
+    python3 benchmarks/micro_benchmarks.py --save baseline.json     # record a baseline
+    python3 benchmarks/micro_benchmarks.py --compare baseline.json  # exit 1 on regressions
+
+Timings are the best of --repeat runs (per-item microseconds), so they are stable enough to
+compare on the same machine before deploying.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+os.environ.setdefault('RHINOLOG_LOG_LEVEL', 'WARNING')
+
+from synthetic import EventProfile, SERVER_DIR, generate_user_events
+
+sys.path.insert(0, SERVER_DIR)
+import server_v2  # noqa: E402
+
+
+def build_inputs(n_events):
+    events = generate_user_events(EventProfile(), 'bench_user', n_events, seed=1)
+    command_names = [e['Detail'] for e in events if e['Action'] == 'Command']
+
+    # /api/logs と同じ形のログ（新しいもの順ではなく時系列順で渡す）
+    logs = []
+    rows = []
+    for i, e in enumerate(events):
+        command, workflow_cat, detail_cat = server_v2.classify_log_event(e['Action'], e['Detail'])
+        logs.append({
+            'timestamp': e['Timestamp'],
+            'action': e['Action'],
+            'detail': e['Detail'],
+            'document_name': e['DocumentName'],
+            'WorkflowCategory': workflow_cat or 'Unknown',
+            'DetailCategory': detail_cat or 'Unknown'
+        })
+        rows.append((i + 1, server_v2.timestamp_to_epoch(e['Timestamp']), e['Timestamp'], e['Action'],
+                     e['Detail'], e['DocumentName'], workflow_cat, detail_cat))
+
+    groups = [(start, end, actions) for start, end, actions
+              in server_v2.iter_action_groups(rows, server_v2.ACTION_GROUP_WINDOW_MINUTES)]
+    return command_names, logs, rows, groups
+
+
+def benchmark_cases(command_names, logs, rows, groups):
+    """name -> (callable, items processed per call)"""
+    def classify_cold():
+        server_v2._lookup_command.cache_clear()
+        for name in command_names:
+            server_v2.classify_command(name)
+
+    def classify_hot():
+        for name in command_names:
+            server_v2.classify_command(name)
+
+    def analyze_groups():
+        for start, end, actions in groups:
+            server_v2.analyze_action_group(actions, start, end)
+
+    return {
+        'classify_command (cold cache)': (classify_cold, len(command_names)),
+        'classify_command (hot cache)': (classify_hot, len(command_names)),
+        'filter_auto_generated_actions': (lambda: server_v2.filter_auto_generated_actions(logs), len(logs)),
+        'iter_action_groups': (lambda: sum(1 for _ in server_v2.iter_action_groups(
+            rows, server_v2.ACTION_GROUP_WINDOW_MINUTES)), len(rows)),
+        'analyze_action_group': (analyze_groups, sum(len(actions) for _, _, actions in groups)),
+    }
+
+
+def run(n_events, repeat):
+    server_v2.load_command_classification()
+    cases = benchmark_cases(*build_inputs(n_events))
+    results = {}
+    for name, (func, items) in cases.items():
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        results[name] = {'items': items, 'us_per_item': round(best / max(items, 1) * 1e6, 4),
+                         'items_per_second': round(items / best) if best else None}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for classification and sessionization')
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON from --save; exit 1 if any case got slower')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown vs baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    results = run(args.events, args.repeat)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    regressions = []
+    print(f"{'benchmark':<34}{'items':>8}{'us/item':>12}{'items/s':>14}{'vs baseline':>14}")
+    for name, result in results.items():
+        change = ''
+        if name in baseline:
+            ratio = result['us_per_item'] / max(baseline[name]['us_per_item'], 1e-9)
+            change = f'{(ratio - 1) * 100:+.1f}%'
+            if ratio > 1 + args.tolerance:
+                regressions.append(name)
+        print(f"{name:<34}{result['items']:>8}{result['us_per_item']:>12}{result['items_per_second']:>14}{change:>14}")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if regressions:
+        print(f"\n⚠ Slower than baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
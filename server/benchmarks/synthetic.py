@@ -0,0 +1,139 @@
+"""
+Synthetic Rhino client event streams for the benchmarks.
+
+Command names come from rhino_commands_actions_classified.json, weighted by their
+priority (priority 1 = everyday commands, used most often). The shape of a session
+(Open -> Document Closed/Opened -> auto-generated layer burst -> commands -> Document
+Closed) and the gaps between commands are taken from the sample plugin CSV.
+"""
+import csv
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLASSIFICATION_PATH = os.path.join(SERVER_DIR, 'rhino_commands_actions_classified.json')
+SAMPLE_LOG_PATH = os.path.join(SERVER_DIR, 'user_20251112_ntatti_Untitled_Log.csv')
+
+UNCLASSIFIED_COMMAND_RATE = 0.03   # 分類ファイルにないコマンド（未分類の経路も通す）
+USER_LAYER_ACTION_RATE = 0.05      # 作業中にユーザーが行うレイヤー操作
+LONG_IDLE_RATE = 0.02              # 休憩など（アクショングループが分かれる）
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class EventProfile:
+    """Command weights and session shape used to generate events"""
+
+    def __init__(self, classification_path=CLASSIFICATION_PATH, sample_log_path=SAMPLE_LOG_PATH):
+        with open(classification_path, 'r', encoding='utf-8') as f:
+            mapping = json.load(f).get('classification_mapping', {})
+        self.commands = list(mapping)
+        self.command_weights = [1.0 / max(info.get('priority', 3), 1) for info in mapping.values()]
+
+        self.layer_names = []
+        self.command_gaps = []
+        self.session_gaps = []
+        self.document_paths = []
+
+        with open(sample_log_path, 'r', encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.DictReader(f))
+
+        previous = None
+        for row in rows:
+            timestamp = datetime.strptime(row['Timestamp'], TIMESTAMP_FORMAT)
+            gap = (timestamp - previous).total_seconds() if previous else 0
+            previous = timestamp
+
+            if row['Action'] == 'Layer Created' and row['Detail'] not in self.layer_names:
+                self.layer_names.append(row['Detail'])
+            elif row['Action'] == 'Document Opened':
+                self.document_paths.append(row['Detail'])
+            elif row['Action'] == 'Command':
+                if row['Detail'] == 'Open':
+                    self.session_gaps.append(gap)
+                elif gap > 0:
+                    self.command_gaps.append(gap)
+
+        self.layer_names = self.layer_names or ['Default']
+        self.command_gaps = self.command_gaps or [2.0]
+        self.session_gaps = [gap for gap in self.session_gaps if gap > 0] or [180.0]
+        self.document_paths = self.document_paths or ['Untitled.3dm']
+
+    def pick_command(self, rng):
+        if rng.random() < UNCLASSIFIED_COMMAND_RATE:
+            return f'BenchUnknown{rng.randint(1, 50)}'
+        return rng.choices(self.commands, self.command_weights)[0]
+
+
+def generate_user_events(profile, username, n_events, start=None, seed=None):
+    """Chronological plugin events (upload JSON shape) for one synthetic user"""
+    rng = random.Random(seed if seed is not None else username)
+    t = start or datetime(2025, 11, 12, 9, 0, 0)
+    events = []
+
+    def emit(action, detail, document_name):
+        events.append({
+            'Timestamp': t.strftime(TIMESTAMP_FORMAT),
+            'UserID': username,
+            'Action': action,
+            'Detail': detail,
+            'DocumentName': document_name
+        })
+
+    while len(events) < n_events:
+        # ドキュメントを開く（プラグインの実ログと同じ並び）
+        path = rng.choice(profile.document_paths)
+        document_name = os.path.basename(path.replace('\\', '/'))
+        emit('Command', 'Open', document_name)
+        emit('Document Closed', '', document_name)
+        t += timedelta(seconds=1)
+        emit('Document Opened', path, document_name)
+
+        # 開いた直後の自動生成レイヤー（サーバー側で除外される）
+        layers = profile.layer_names[:rng.randint(1, len(profile.layer_names))]
+        for layer in layers:
+            emit('Layer Created', layer, document_name)
+        for layer in layers[2:]:
+            emit('Layer Modified', layer, document_name)
+
+        for _ in range(rng.randint(20, 200)):
+            if rng.random() < LONG_IDLE_RATE:
+                t += timedelta(minutes=rng.randint(11, 60))
+            t += timedelta(seconds=rng.choice(profile.command_gaps) * rng.uniform(0.5, 3.0))
+
+            if rng.random() < USER_LAYER_ACTION_RATE:
+                emit(rng.choice(['Layer Created', 'Layer Modified']), rng.choice(profile.layer_names), document_name)
+            else:
+                emit('Command', profile.pick_command(rng), document_name)
+
+        t += timedelta(seconds=rng.randint(1, 5))
+        emit('Document Closed', document_name, document_name)
+        t += timedelta(seconds=rng.choice(profile.session_gaps) * rng.uniform(0.5, 2.0))
+
+    return events[:n_events]
+
+
+def synthetic_usernames(count, prefix='bench_user'):
+    return [f'{prefix}_{i:03d}' for i in range(count)]
+
+
+def registration_payload(username, rng):
+    """Registration body shaped like the Google Form submission"""
+    experiences = ['未経験', '初心者', '中級者', 'エキスパート']
+    return {
+        'username': username,
+        'full_name': username.replace('_', ' ').title(),
+        'email': f'{username}@example.com',
+        'organization': 'Benchmark',
+        'start_date': '2025-11-01',
+        'end_date': '2026-03-31',
+        'learning_group': f'bench_group_{rng.randint(1, 4)}',
+        'rhino_experience': rng.choice(experiences),
+        'grasshopper_experience': rng.choice(experiences),
+        'technical_score': round(rng.uniform(0, 100), 1),
+        'self_learning_score': round(rng.uniform(40, 100), 1),
+        'cad_tools': 'AutoCAD',
+        'modeling_tools': '',
+        'programming_languages': 'Python'
+    }
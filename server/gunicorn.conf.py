@@ -0,0 +1,23 @@
+"""
+gunicorn settings for server_v2 (gunicorn reads this file when started from its directory):
+
+    cd /home/rhinologs && gunicorn -w 4 server_v2:app
+
+The schema migrations run once in the master process before the workers are forked.
+Classifying old logs and building the rollups/action groups then runs in the background
+in one of the workers, as it does when starting with python3 server_v2.py.
+"""
+bind = '0.0.0.0:5000'
+
+
+def on_starting(server):
+    import server_v2
+    server_v2.load_command_classification()
+    server_v2.init_db()
+
+
+def post_worker_init(worker):
+    import server_v2
+    # 未分類の過去ログがあるか分類ルールが前回の起動から変わっていれば、バックグラウンドで
+    # 再分類して集計テーブルとアクショングループを作り直す（複数のワーカーが呼んでも実行は1回）
+    server_v2.start_reclassification_job()
@@ -0,0 +1,287 @@
+"""
+Import legacy <user>_<doc>_Log.csv files into the server_v2 database.
+
+The legacy server (server.py) wrote them under /home/rhinologs/<user>/ and the Rhino
+plugin keeps the same files on each trainee's desktop:
+
+    python3 import_legacy_csv.py /home/rhinologs
+    python3 import_legacy_csv.py --db /home/rhinologs/rhinolog.db --workers 8 ~/Desktop/RhinoLogs
+    python3 import_legacy_csv.py --dry-run /mnt/backup/rhinologs      # parse and count only
+
+Files are parsed and classified in parallel worker processes; the main process drops
+events that are already stored (same user, timestamp, action and detail, counted so that
+repeated identical events are kept) and inserts the rest in large transactions. Logs of
+users that are not registered are skipped, like /api/log/upload does.
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from multiprocessing import Pool
+
+os.environ.setdefault('RHINOLOG_LOG_LEVEL', 'WARNING')
+
+import server_v2  # noqa: E402
+
+CSV_SUFFIX = '_Log.csv'
+CSV_HEADER = ['Timestamp', 'UserID', 'Action', 'Detail']
+CSV_ENCODINGS = ('utf-8-sig', 'cp932')  # プラグインは UTF-8。古い Windows 環境のファイルは Shift_JIS のことがある
+PROGRESS_INTERVAL_SECONDS = 5
+
+
+def find_csv_files(paths):
+    """Every *_Log.csv under the given files/directories, largest first (keeps the workers busy)"""
+    files = set()
+    for path in paths:
+        if os.path.isfile(path):
+            files.add(os.path.abspath(path))
+            continue
+        for root, _, names in os.walk(path):
+            files.update(os.path.join(root, name) for name in names if name.endswith(CSV_SUFFIX))
+    return sorted(files, key=lambda f: (-os.path.getsize(f), f))
+
+
+def document_name_from_path(path, username):
+    """<user>_<doc>_Log.csv -> <doc> (usernames contain underscores, so strip the known user)"""
+    name = os.path.basename(path)[:-len(CSV_SUFFIX)]
+    if username and name.startswith(username + '_'):
+        return name[len(username) + 1:]
+    return name
+
+
+def read_csv_rows(path, encoding):
+    """Yield [Timestamp, UserID, Action, Detail] lists (header lines skipped)
+
+    Rows are read one at a time, but _parse_csv_file collects the whole file before
+    returning it to the main process, so a worker holds one complete file in memory.
+    """
+    with open(path, 'r', encoding=encoding, newline='') as f:
+        for row in csv.reader(f):
+            if row == CSV_HEADER or not row:
+                continue
+            # 引用符なしで書かれていた頃の行は Detail 内のカンマで列が増えている
+            if len(row) > 4:
+                row = row[:3] + [','.join(row[3:])]
+            yield row
+
+
+def parse_csv_file(path):
+    """Worker: (path, size, log rows as build_log_row tuples, malformed row count)"""
+    for encoding in CSV_ENCODINGS:
+        try:
+            return _parse_csv_file(path, encoding)
+        except UnicodeDecodeError:
+            continue
+    raise ValueError('not UTF-8 or CP932')
+
+
+def _parse_csv_file(path, encoding):
+    events = []
+    malformed = 0
+    document_name = None
+    for row in read_csv_rows(path, encoding):
+        if len(row) < 3 or not row[0].strip() or not row[1] or not row[2]:
+            malformed += 1
+            continue
+        timestamp, username, action = row[0].strip(), row[1], row[2]
+        detail = row[3] if len(row) > 3 else ''
+        if document_name is None:
+            document_name = document_name_from_path(path, username)
+        events.append({'Timestamp': timestamp, 'UserID': username, 'Action': action,
+                       'Detail': detail, 'DocumentName': document_name})
+    created_at = datetime.now().isoformat()
+    rows = [server_v2.build_log_row(event, created_at) for event in assign_file_event_ids(events)]
+    return path, os.path.getsize(path), rows, malformed
+
+
+def assign_file_event_ids(events):
+    """Give each event of one file an EventId that is the same every time the file is imported
+
+    The id is (timestamp, action, detail, document, how many identical events came before it
+    in this file), so identical events of the same file stay distinct.
+    """
+    seen = Counter()
+    for event in events:
+        identity = (event['Timestamp'], event['Action'], event['Detail'], event['DocumentName'])
+        event['EventId'] = '\x1f'.join(map(str, identity + (seen[identity],)))
+        seen[identity] += 1
+    return events
+
+
+def init_worker():
+    server_v2.load_command_classification()
+
+
+class Deduplicator:
+    """Per-user multiset of (timestamp, action, detail) already stored or queued for insert"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.known = {}
+
+    def _load(self, username):
+        # hash() だけをキーにすると別のイベントが衝突したときに重複扱いで落ちるので、タプルそのものを数える
+        counts = Counter(tuple(row) for row in self.conn.execute(
+            'SELECT timestamp, action, detail FROM logs WHERE username = ?', (username,)))
+        archived = server_v2.iter_archived_rows(self.conn, 'id, timestamp, action, detail', username)
+        for _, timestamp, action, detail in archived or ():
+            counts[(timestamp, action, detail)] += 1
+        self.known[username] = counts
+        return counts
+
+    def new_rows(self, rows):
+        """Rows of one file that are not stored yet (a file counts an event as often as it contains it)"""
+        by_user = {}
+        for row in rows:
+            by_user.setdefault(row[1], []).append(row)
+
+        fresh = []
+        for username, user_rows in by_user.items():
+            known = self.known.get(username)
+            if known is None:
+                known = self._load(username)
+            seen = Counter()
+            for row in user_rows:
+                key = (row[0], row[2], row[3])
+                seen[key] += 1
+                if seen[key] > known[key]:
+                    known[key] += 1
+                    fresh.append(row)
+        return fresh
+
+
+class Progress:
+    def __init__(self, total_files, total_bytes):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.started = time.perf_counter()
+        self.last_report = self.started
+        self.counts = Counter()
+
+    def add(self, **counts):
+        self.counts.update(counts)
+
+    def report(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last_report < PROGRESS_INTERVAL_SECONDS:
+            return
+        self.last_report = now
+        elapsed = max(now - self.started, 1e-9)
+        done = self.counts['bytes']
+        eta = (self.total_bytes - done) / (done / elapsed) if done else 0
+        print(f"[{elapsed:7.1f}s] files {self.counts['files']}/{self.total_files} "
+              f"({done / max(self.total_bytes, 1):.0%}), rows {self.counts['parsed']} parsed / "
+              f"{self.counts['inserted']} inserted / {self.counts['duplicates']} duplicate / "
+              f"{self.counts['unregistered']} unregistered, "
+              f"{self.counts['parsed'] / elapsed:,.0f} rows/s, {done / elapsed / 1e6:.1f} MB/s, ETA {eta:.0f}s",
+              flush=True)
+
+
+def flush(conn, rows, dry_run, progress):
+    if rows and not dry_run:
+        # Deduplicator をすり抜けた既存イベント（同じ event id）は insert_log_rows が落とす
+        skipped = len(server_v2.insert_log_rows(conn.cursor(), rows, sessionize=False))
+        conn.commit()
+        progress.add(duplicates=skipped, inserted=-skipped)
+
+
+def run_import(files, workers, batch_size, dry_run):
+    progress = Progress(len(files), sum(os.path.getsize(f) for f in files))
+    oldest_epoch = {}
+    unregistered_users = Counter()
+    failed_files = []
+
+    with server_v2.db_connection() as conn:
+        registered = {row[0] for row in conn.execute('SELECT username FROM users')}
+        deduplicator = Deduplicator(conn)
+        pending = []
+
+        with Pool(workers, initializer=init_worker) as pool:
+            for result in pool.imap_unordered(_parse_or_error, files):
+                if isinstance(result, str):
+                    failed_files.append(result)
+                    progress.add(files=1)
+                    continue
+
+                path, size, rows, malformed = result
+                progress.add(files=1, bytes=size, parsed=len(rows), malformed=malformed)
+
+                known_rows = []
+                for row in rows:
+                    if row[1] in registered:
+                        known_rows.append(row)
+                    else:
+                        unregistered_users[row[1]] += 1
+                progress.add(unregistered=len(rows) - len(known_rows))
+
+                fresh = deduplicator.new_rows(known_rows)
+                progress.add(duplicates=len(known_rows) - len(fresh), inserted=len(fresh))
+                for row in fresh:
+                    if row[6] is not None:
+                        oldest_epoch[row[1]] = min(row[6], oldest_epoch.get(row[1], row[6]))
+                pending.extend(fresh)
+
+                if len(pending) >= batch_size:
+                    flush(conn, pending, dry_run, progress)
+                    pending = []
+                progress.report()
+
+        flush(conn, pending, dry_run, progress)
+
+        # 取り込んだ範囲のアクショングループをユーザーごとに1回だけ作り直す
+        if not dry_run:
+            for username, since_epoch in oldest_epoch.items():
+                for window_minutes in server_v2.ACTION_GROUP_WINDOWS:
+                    server_v2.sessionize_user(conn, username, window_minutes, since_epoch)
+                conn.commit()
+
+    progress.report(force=True)
+    return progress.counts, unregistered_users, failed_files
+
+
+def _parse_or_error(path):
+    try:
+        return parse_csv_file(path)
+    except Exception as e:
+        return f'{path}: {e}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import legacy <user>_<doc>_Log.csv files into the server database')
+    parser.add_argument('paths', nargs='+', help='CSV files or directories to search recursively')
+    parser.add_argument('--db', default=server_v2.DB_PATH, help='database path (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='parallel parser processes')
+    parser.add_argument('--batch-size', type=int, default=50000, help='rows per insert transaction')
+    parser.add_argument('--dry-run', action='store_true', help='parse and deduplicate without writing')
+    args = parser.parse_args()
+
+    server_v2.DB_PATH = args.db
+    server_v2.init_db()
+    server_v2.load_command_classification()
+
+    files = find_csv_files(args.paths)
+    if not files:
+        print('No *_Log.csv files found')
+        return
+    print(f"Importing {len(files)} files into {args.db} with {args.workers} workers"
+          f"{' (dry run)' if args.dry_run else ''}", flush=True)
+
+    counts, unregistered_users, failed_files = run_import(files, args.workers, args.batch_size, args.dry_run)
+
+    print(f"\n✓ {counts['inserted']} rows {'would be ' if args.dry_run else ''}inserted, "
+          f"{counts['duplicates']} duplicates skipped, {counts['malformed']} malformed rows")
+    if unregistered_users:
+        print(f"⚠ Skipped {sum(unregistered_users.values())} rows of {len(unregistered_users)} unregistered users: "
+              f"{', '.join(u for u, _ in unregistered_users.most_common(10))}")
+    if failed_files:
+        print(f"⚠ {len(failed_files)} files could not be read:")
+        for message in failed_files:
+            print(f'  {message}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Scoring rules for user registration and screening: experience, CAD and overall scores and
+the 1-5 user level.
+
+Bump SCORING_RULES_VERSION whenever a mapping, weight or threshold in this file changes.
+Each user stores the version their level was computed with, and existing users are
+recomputed with
+
+    python3 server_v2.py --relevel --dry-run   # report how many users would change level
+    python3 server_v2.py --relevel             # apply (same as POST /api/admin/scoring/relevel)
+"""
+
+SCORING_RULES_VERSION = 1
+
+# 経験レベル → スコア（部分一致。上から順に判定）
+EXPERIENCE_SCORES = {
+    '未経験': 0,
+    '初心者': 30,
+    '中級者': 70,
+    'エキスパート': 100,
+    'beginner': 30,
+    'intermediate': 70,
+    'expert': 100
+}
+
+# スクリーニングテスト（google-form/ScreeningTest_Code.gs と同じ定義）
+SCREENING_TOTAL_QUESTIONS = 26
+SCREENING_CATEGORIES = {
+    'geometry': ('ジオメトリ構成力', [1, 2, 3, 4]),
+    'data_structure': ('データ構造力', [5, 6, 7, 8]),
+    'attributes': ('属性・情報付加力', [9, 10]),
+    'parametric': ('パラメトリック操作力', [11, 12]),
+    'programming': ('プログラミング力', [13, 14]),
+    'manufacturing': ('出力・製造適応力', [15, 16]),
+    'visualization': ('ビジュアライゼーション力', [17, 18]),
+    'interaction': ('インタラクション・体験設計力', [19, 20]),
+    'management': ('モデル管理・整理力', [21, 22, 23, 24]),
+    'simulation': ('シミュレーション力', [25, 26])
+}
+
+def get_experience_score(level_str):
+    """経験レベルをスコアに変換"""
+    level_lower = str(level_str).lower()
+    for key, value in EXPERIENCE_SCORES.items():
+        if key.lower() in level_lower:
+            return value
+    return 0
+
+def calculate_cad_experience_score(cad_tools, modeling_tools, programming_langs):
+    """CAD経験スコアを計算"""
+    score = 0
+
+    # Parse tool lists (semicolon or comma separated)
+    cad_list = str(cad_tools).replace(',', ';').split(';') if cad_tools else []
+    modeling_list = str(modeling_tools).replace(',', ';').split(';') if modeling_tools else []
+    prog_list = str(programming_langs).replace(',', ';').split(';') if programming_langs else []
+
+    # Count unique tools: 8 points each
+    unique_tools = set()
+    for tools in [cad_list, modeling_list]:
+        for tool in tools:
+            if tool and tool.strip() and tool.strip() != 'nan':
+                unique_tools.add(tool.strip())
+    score += len(unique_tools) * 8
+
+    # Rhino bonus: +3
+    all_tools = ' '.join([str(cad_tools), str(modeling_tools)])
+    if 'Rhino' in all_tools:
+        score += 3
+
+    # Revit bonus: +3
+    if 'Revit' in all_tools:
+        score += 3
+
+    # Programming experience: 2 points each, Python and C# get extra bonus
+    for prog in prog_list:
+        if prog and prog.strip() and prog.strip() != 'nan':
+            if 'Python' in prog:
+                score += 2 + 3  # Base 2 + Python bonus 3
+            elif 'C#' in prog or 'CSharp' in prog:
+                score += 2 + 2  # Base 2 + C# bonus 2
+            else:
+                score += 2
+
+    return score
+
+def calculate_rhino_gh_composite_score(rhino_score, gh_score):
+    """RhinoGH複合スコアを計算"""
+    if rhino_score == 0 and gh_score == 0:
+        return 0
+    elif rhino_score > 0 and gh_score == 0:
+        return rhino_score * 0.6
+    elif rhino_score == 0 and gh_score > 0:
+        return gh_score * 0.4
+    else:
+        return rhino_score * 0.6 + gh_score * 0.4
+
+def calculate_overall_score(technical_score, cad_score, self_learning_score, rhino_gh_score):
+    """総合スコアを計算"""
+    return (technical_score * 0.25 +
+            cad_score * 0.15 +
+            self_learning_score * 0.20 +
+            rhino_gh_score * 0.40)
+
+def determine_user_level(rhino_score, gh_score, technical_score, self_learning_score, cad_experience_score=0):
+    """ユーザーレベルを判定（1-5）
+
+    CAD経験スコアを含めた総合評価でレベルを判定
+    """
+    # RhinoGH複合スコアを計算
+    rhino_gh_score = calculate_rhino_gh_composite_score(rhino_score, gh_score)
+
+    # 総合スコアを計算
+    overall_score = calculate_overall_score(technical_score, cad_experience_score,
+                                           self_learning_score, rhino_gh_score)
+
+    # Level 5 判定: 最高レベル - 全ての条件を満たす
+    if (rhino_score >= 70 and gh_score >= 70 and
+        technical_score >= 60 and self_learning_score >= 60):
+        return 5
+
+    # Level 4 判定: 上級レベル - 総合スコアと個別条件
+    if ((rhino_score >= 70 and gh_score >= 70 and technical_score >= 50) or
+        (rhino_score >= 30 and gh_score >= 30 and technical_score >= 77) or
+        (rhino_score >= 70 and gh_score >= 30 and technical_score >= 50) or
+        (overall_score >= 65)):  # 総合スコアでの判定を追加
+        return 4
+
+    # Level 3 判定: 中級レベル
+    if ((rhino_score >= 70 and gh_score <= 30) or
+        (rhino_score == 30 and gh_score == 30) or
+        (overall_score >= 45)):  # 総合スコアでの判定を追加
+        return 3
+
+    # Level 2 判定: 初級レベル
+    if (rhino_score == 30 and gh_score == 0) or (overall_score >= 25):
+        return 2
+
+    # Level 1 判定: 入門レベル
+    return 1
+
+def score_user(rhino_experience, grasshopper_experience, technical_score, self_learning_score,
+               cad_tools, modeling_tools, programming_languages):
+    """(cad_experience_score, user_level) from a stored profile (missing answers use the form defaults)"""
+    cad_experience_score = calculate_cad_experience_score(cad_tools or '', modeling_tools or '',
+                                                          programming_languages or '')
+    user_level = determine_user_level(get_experience_score(rhino_experience or '未経験'),
+                                      get_experience_score(grasshopper_experience or '未経験'),
+                                      0 if technical_score is None else technical_score,
+                                      60 if self_learning_score is None else self_learning_score,
+                                      cad_experience_score)
+    return cad_experience_score, user_level
+
+def score_screening(question_scores):
+    """(technical_score, category_scores) from per-question points, or None unless every question is present
+
+    Partial answers keep the score the form reported, since a question missing here may
+    just have had an unexpected title.
+    """
+    correct = {}
+    for number, points in (question_scores or {}).items():
+        try:
+            correct[int(number)] = bool(points and float(points) > 0)
+        except (TypeError, ValueError):
+            continue
+    if any(number not in correct for number in range(1, SCREENING_TOTAL_QUESTIONS + 1)):
+        return None
+
+    technical_score = sum(correct.values()) / SCREENING_TOTAL_QUESTIONS * 100
+    category_scores = {}
+    for key, (name, questions) in SCREENING_CATEGORIES.items():
+        category_correct = sum(1 for number in questions if correct[number])
+        category_scores[key] = {
+            'name': name,
+            'correct': category_correct,
+            'total': len(questions),
+            'percentage': category_correct / len(questions) * 100
+        }
+    return technical_score, category_scores
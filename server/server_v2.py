@@ -1,177 +1,717 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response, has_request_context
 from flask_cors import CORS
 import sqlite3
 import os
-from datetime import datetime
+import sys
+import time
+import atexit
+import logging
+import logging.handlers
+import base64
+import queue
+import threading
+import calendar
+import hashlib
+import re
+import gzip
+import heapq
+import pickle
+try:
+    import fcntl
+except ImportError:  # Windows（開発用）。ワーカーは1プロセスなのでプロセス内のロックだけで足りる
+    fcntl = None
+from functools import lru_cache, wraps
+from operator import itemgetter
+from itertools import chain, islice
+from types import MappingProxyType
+from contextlib import contextmanager
+from datetime import datetime, timezone, date
 import json
-from collections import Counter
+from collections import Counter, OrderedDict, deque
+
+from scoring_rules import (SCORING_RULES_VERSION, SCREENING_CATEGORIES, calculate_cad_experience_score,
+                           determine_user_level, get_experience_score, score_screening, score_user)
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor', 'X-Total-Count', 'X-Rules-Version'])
 
 DB_PATH = "/home/rhinologs/rhinolog.db"
 LOG_BASE_DIR = "/home/rhinologs"
 
+# ログ出力（標準出力への書き込みはリスナースレッドに任せ、リクエスト処理をブロックしない）
+#
+# ロガーはモジュールごとに rhinolog.<name>。行単位の診断は rhinolog.*.rows に出し、
+# RateLimitFilter で同じメッセージを一定時間あたり数件までに間引く。
+# リクエスト中の件数系の診断は count_diagnostic で数えて、リクエスト終了時に1行にまとめる。
+LOG_LEVEL = os.environ.get('RHINOLOG_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(name)s] %(message)s'
+LOG_RATE_LIMIT_BURST = 5
+LOG_RATE_LIMIT_INTERVAL_SECONDS = 60
+DIAGNOSTIC_TOP_N = 10
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most `burst` records per message template per `interval` seconds"""
+
+    def __init__(self, burst=LOG_RATE_LIMIT_BURST, interval=LOG_RATE_LIMIT_INTERVAL_SECONDS):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._windows = {}  # message template -> [window_start, emitted, suppressed]
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(record.msg)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                window = self._windows[record.msg] = [now, 0, 0]
+                if suppressed:
+                    record.msg = f'{record.msg} ({suppressed} similar messages suppressed)'
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+            return True
+
+def configure_logging():
+    """Route the rhinolog.* loggers through a queue so request threads never write to stdout"""
+    root = logging.getLogger('rhinolog')
+    if root.handlers:
+        return
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+def get_row_logger(name):
+    """Logger for per-row diagnostics (rate limited)"""
+    row_logger = logging.getLogger(f'rhinolog.{name}.rows')
+    if not any(isinstance(f, RateLimitFilter) for f in row_logger.filters):
+        row_logger.addFilter(RateLimitFilter())
+    return row_logger
+
+configure_logging()
+logger = logging.getLogger('rhinolog.server')
+db_logger = logging.getLogger('rhinolog.db')
+classification_logger = logging.getLogger('rhinolog.classification')
+classification_row_logger = get_row_logger('classification')
+request_logger = logging.getLogger('rhinolog.request')
+
+def count_diagnostic(name, key=None, amount=1):
+    """Count a diagnostic for the current request; summarized once when the request ends"""
+    if not has_request_context() or amount <= 0:
+        return
+    diagnostics = g.setdefault('diagnostics', {})
+    counter = diagnostics.setdefault(name, Counter())
+    counter[key] += amount
+
+@app.teardown_request
+def log_request_diagnostics(exception):
+    diagnostics = g.pop('diagnostics', None)
+    if not diagnostics or not request_logger.isEnabledFor(logging.INFO):
+        return
+    parts = []
+    for name, counter in diagnostics.items():
+        keyed = [(key, count) for key, count in counter.most_common() if key is not None]
+        part = f'{name}={sum(counter.values())}'
+        if keyed:
+            top = ', '.join(f'{key}:{count}' for key, count in keyed[:DIAGNOSTIC_TOP_N])
+            part += f' (top {min(len(keyed), DIAGNOSTIC_TOP_N)}: {top})'
+        parts.append(part)
+    request_logger.info('%s %s %s', request.method, request.path, '; '.join(parts))
+
+# メトリクス（/metrics、Prometheus テキスト形式）
+#
+# 各ワーカーは自分のプロセス内で集計し、RHINOLOG_METRICS_DIR を指定した場合は
+# METRICS_FLUSH_SECONDS ごとに metrics-<pid>.json へ書き出す。/metrics はディレクトリ内の
+# 全ワーカー分を合算して返す（gunicorn の複数ワーカー用。デプロイ時にディレクトリを空にする）。
+# 終了したワーカーのファイルはカウンターとヒストグラムだけを合算し（合計が減らない）、ゲージは使わない。
+METRICS_DIR = os.environ.get('RHINOLOG_METRICS_DIR')
+METRICS_FLUSH_SECONDS = 5
+METRICS_STALE_SECONDS = 60  # これより長く更新されていないファイルのワーカーは止まっているとみなす
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+SQL_LABEL_LENGTH = 80
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms for one worker process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []  # スクレイプ時に値を読む関数（キャッシュ統計など）
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [list(buckets), [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][i] += 1
+                    break
+            histogram[2] += value
+            histogram[3] += 1
+
+    def collector(self, func):
+        """Register func() -> [(type, name, labels, value)] evaluated at scrape time"""
+        self._collectors.append(func)
+        return func
+
+    def snapshot(self):
+        with self._lock:
+            samples = [('counter', name, list(labels), value) for (name, labels), value in self._counters.items()]
+            histograms = [[name, list(labels), h[0], list(h[1]), h[2], h[3]]
+                          for (name, labels), h in self._histograms.items()]
+        for func in self._collectors:
+            samples.extend((kind, name, list(labels), value) for kind, name, labels, value in func())
+        return {'samples': samples, 'histograms': histograms}
+
+METRICS = Metrics()
+
+def _merge_snapshots(snapshots):
+    samples = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for kind, name, labels, value in snapshot['samples']:
+            key = (kind, name, tuple(map(tuple, labels)))
+            samples[key] = samples.get(key, 0) + value
+        for name, labels, buckets, counts, total, count in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [buckets, [0] * len(buckets), 0.0, 0])
+            merged[1] = [a + b for a, b in zip(merged[1], counts)]
+            merged[2] += total
+            merged[3] += count
+    return samples, histograms
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def render_metrics(snapshots):
+    """Prometheus text exposition of merged worker snapshots"""
+    samples, histograms = _merge_snapshots(snapshots)
+    lines = []
+    declared = set()
+    for (kind, name, labels), value in sorted(samples.items()):
+        if name not in declared:
+            lines.append(f'# TYPE {name} {kind}')
+            declared.add(name)
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+        if name not in declared:
+            lines.append(f'# TYPE {name} histogram')
+            declared.add(name)
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+def flush_metrics():
+    """Write this worker's snapshot into RHINOLOG_METRICS_DIR (atomic replace)"""
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'metrics-{os.getpid()}.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(METRICS.snapshot(), f)
+    os.replace(tmp_path, path)
+
+def _process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # 別ユーザーのプロセス（pid が再利用された）でも mtime で判定する
+    return True
+
+def read_worker_snapshots():
+    """Snapshots of every worker, without the gauges of workers that exited or stopped flushing"""
+    snapshots = []
+    stale_before = time.time() - METRICS_STALE_SECONDS
+    for name in os.listdir(METRICS_DIR):
+        if name.startswith('metrics-') and name.endswith('.json'):
+            path = os.path.join(METRICS_DIR, name)
+            try:
+                modified = os.path.getmtime(path)
+                with open(path, 'r', encoding='utf-8') as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue  # 書き込み途中のワーカーは次回のスクレイプで拾う
+            pid = name[len('metrics-'):-len('.json')]
+            if modified < stale_before or not (pid.isdigit() and _process_running(int(pid))):
+                snapshot['samples'] = [sample for sample in snapshot['samples'] if sample[0] != 'gauge']
+            snapshots.append(snapshot)
+    return snapshots
+
+_metrics_flushers = set()
+
+def start_metrics_flusher():
+    """Periodically flush this worker's metrics (once per process, after gunicorn forks)"""
+    pid = os.getpid()
+    if not METRICS_DIR or pid in _metrics_flushers:
+        return
+    _metrics_flushers.add(pid)
+
+    def run():
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            try:
+                flush_metrics()
+            except OSError as e:
+                logger.warning('Could not write metrics to %s: %s', METRICS_DIR, e)
+
+    threading.Thread(target=run, name='rhinolog-metrics-flusher', daemon=True).start()
+    atexit.register(flush_metrics)
+
+# SQL の計測（文ごとの実行時間、リクエストごとの返却行数・変更行数）
+_sql_request_stats = threading.local()
+
+@lru_cache(maxsize=1024)
+def sql_statement_label(sql):
+    """Stable label for a statement: whitespace collapsed, IN (?, ?, ...) lists folded, truncated"""
+    label = re.sub(r'\s+', ' ', sql).strip()
+    label = re.sub(r'\(\?(?:\s*,\s*\?)+\)', '(?...)', label)
+    return label[:SQL_LABEL_LENGTH]
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def _record(self, sql, started):
+        METRICS.observe('rhinolog_sql_query_duration_seconds', (('statement', sql_statement_label(sql)),),
+                        time.perf_counter() - started, LATENCY_BUCKETS)
+        stats = _sql_request_stats
+        stats.queries = getattr(stats, 'queries', 0) + 1
+        if self.rowcount > 0:
+            stats.rows_written = getattr(stats, 'rows_written', 0) + self.rowcount
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        result = super().execute(sql, parameters)
+        self._record(sql, started)
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        result = super().executemany(sql, seq_of_parameters)
+        self._record(sql, started)
+        return result
+
+    def _count_rows(self, count):
+        _sql_request_stats.rows_returned = getattr(_sql_request_stats, 'rows_returned', 0) + count
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._count_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._count_rows(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self._count_rows(1)
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    pending_dictionary_ids = None  # このトランザクションで引いた辞書 id（コミット後にプロセスで共有）
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        super().commit()
+        publish_dictionary_ids(self)
+
+    def rollback(self):
+        super().rollback()
+        self.pending_dictionary_ids = None
+
+@app.before_request
+def start_request_metrics():
+    start_metrics_flusher()
+    start_classification_watcher()
+    g.request_started = time.perf_counter()
+    _sql_request_stats.queries = 0
+    _sql_request_stats.rows_returned = 0
+    _sql_request_stats.rows_written = 0
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = (('method', request.method), ('route', route))
+    METRICS.inc('rhinolog_http_requests_total', labels + (('status', str(response.status_code)),))
+    METRICS.observe('rhinolog_http_request_duration_seconds', labels, time.perf_counter() - started, LATENCY_BUCKETS)
+    METRICS.observe('rhinolog_sql_queries_per_request', labels, getattr(_sql_request_stats, 'queries', 0), ROW_BUCKETS)
+    METRICS.observe('rhinolog_sql_rows_returned_per_request', labels,
+                    getattr(_sql_request_stats, 'rows_returned', 0), ROW_BUCKETS)
+    METRICS.observe('rhinolog_sql_rows_written_per_request', labels,
+                    getattr(_sql_request_stats, 'rows_written', 0), ROW_BUCKETS)
+    return response
+
+# データベース接続プール（gunicornワーカーごとに接続を使い回す）
+DB_POOL_SIZE = int(os.environ.get('RHINOLOG_DB_POOL_SIZE', '8'))
+DB_BUSY_TIMEOUT_SECONDS = 10
+DB_CACHED_STATEMENTS = 256
+DB_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',        # 読み込みが書き込みにブロックされない
+    'PRAGMA synchronous = NORMAL',      # WALではNORMALでもクラッシュ時の整合性は保たれる
+    'PRAGMA cache_size = -32000',       # 32MB のページキャッシュ
+    'PRAGMA mmap_size = 268435456',     # 256MB までメモリマップ読み込み
+    'PRAGMA temp_store = MEMORY',
+]
+
+class ConnectionPool:
+    """A small pool of tuned SQLite connections shared by the threads of one worker process"""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_SECONDS,
+                               check_same_thread=False,
+                               cached_statements=DB_CACHED_STATEMENTS,
+                               factory=InstrumentedConnection)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+
+        return self._idle.get(timeout=DB_BUSY_TIMEOUT_SECONDS)
+
+    def release(self, conn):
+        # 例外などでコミットされなかった書き込みは破棄してから返却する
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Return the connection pool for this process (recreated after fork or a DB_PATH change)"""
+    global _db_pool
+    pool = _db_pool
+    if pool is None or pool.pid != os.getpid() or pool.path != DB_PATH:
+        with _db_pool_lock:
+            pool = _db_pool
+            if pool is None or pool.pid != os.getpid() or pool.path != DB_PATH:
+                pool = _db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+    return pool
+
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection outside of a request (startup, background jobs, CLI)"""
+    pool = get_db_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+def get_db():
+    """Return the pooled connection bound to the current request"""
+    if 'db' not in g:
+        g.db = get_db_pool().acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_db_pool().release(conn)
+
 # Load command classification data
 COMMAND_CLASSIFICATION = None
 DETAIL_CATEGORY_NAMES = None
+CLASSIFICATION_FINGERPRINT = None  # 分類ルールファイルの内容ハッシュ（変更検知用）
+CLASSIFICATION_RULES = None        # 現在の CompiledRules（再読み込み時はまるごと差し替える）
+
+# コマンド名の正規化ルールを変えたら上げる（保存済みログの再分類が走る）
+CLASSIFIER_VERSION = 2
+COMMAND_PREFIX_CHARS = "_-!' "  # _Move（英語名指定）, -Layer（スクリプト形式）, !Line（コマンド中断）
+COMMAND_LOOKUP = MappingProxyType({})   # 正規化済みコマンド名 -> (workflow_category, detail_category)
+COMMAND_ALIASES = MappingProxyType({})  # 正規化済み別名（ローカライズ名など） -> 正規化済みコマンド名
+UNCLASSIFIED_LOOKUP_CACHE_SIZE = 4096
+UNCLASSIFIED_COMMANDS = Counter()  # 分類できなかったコマンド名と回数
+
+# コンパイル済みの分類ルールは <分類ファイル>.cache.pickle に保存し、分類ファイルの
+# mtime・サイズ（変わっていれば内容ハッシュ）が一致する間はワーカー起動時に再利用する。
+# 分類ファイルは CLASSIFICATION_WATCH_SECONDS ごとに確認し、変わっていれば読み直す（0 で無効）。
+CLASSIFICATION_CACHE_FORMAT = 1
+CLASSIFICATION_CACHE_SUFFIX = '.cache.pickle'
+CLASSIFICATION_WATCH_SECONDS = float(os.environ.get('RHINOLOG_CLASSIFICATION_WATCH_SECONDS', '5'))
+DETAIL_DESCRIPTION_PARENTHESES = re.compile(r'[（(].*?[）)]')
+_classification_lock = threading.Lock()
+_classification_watchers = set()
+
+class CompiledRules:
+    """One version of the classification rules; requests and lookups never see a half-swapped set"""
+    __slots__ = ('classification', 'detail_names', 'fingerprint', 'rules_version', 'lookup', 'aliases',
+                 'source_path', 'source_mtime_ns', 'source_size')
+
+    def __init__(self, classification, detail_names, fingerprint, lookup, aliases,
+                 source_path, source_mtime_ns, source_size):
+        self.classification = classification
+        self.detail_names = detail_names
+        self.fingerprint = fingerprint
+        rules_version = classification.get('classification_info', {}).get('rules_version') or 'unversioned'
+        self.rules_version = f'{rules_version}+{fingerprint[:8]}'
+        self.lookup = lookup
+        self.aliases = aliases
+        self.source_path = source_path
+        self.source_mtime_ns = source_mtime_ns
+        self.source_size = source_size
+
+def normalize_command_name(command_name):
+    """Normalize a command name for lookup: strip _/-/! prefixes and case-fold"""
+    return command_name.strip().lstrip(COMMAND_PREFIX_CHARS).casefold()
+
+def build_command_lookup(classification):
+    """Compile the classification mapping into immutable lookup tables
+
+    Returns (lookup, aliases). Category pairs are shared tuples, so the per-row
+    classification path only does dict lookups.
+    """
+    pairs = {}
+    lookup = {}
+    for cmd_name, cmd_info in classification.get('classification_mapping', {}).items():
+        pair = (cmd_info.get('workflow_category'), cmd_info.get('detail_category'))
+        pair = pairs.setdefault(pair, pair)
+        lookup.setdefault(normalize_command_name(cmd_name), pair)
+
+    # 任意: 分類ファイルの "command_aliases" に {"別名": "英語コマンド名"} を書くと同じ分類になる
+    aliases = {}
+    for alias, target in classification.get('command_aliases', {}).items():
+        aliases[normalize_command_name(alias)] = normalize_command_name(target)
+
+    return MappingProxyType(lookup), MappingProxyType(aliases)
+
+def build_detail_category_names(classification):
+    """detail_category -> Japanese name, from the first detail_description of each category"""
+    names = {}
+    for cmd_info in classification.get('classification_mapping', {}).values():
+        detail_cat = cmd_info.get('detail_category')
+        detail_desc = cmd_info.get('detail_description')
+        if detail_cat and detail_desc and detail_cat not in names:
+            # Remove parentheses and their contents from description
+            names[detail_cat] = DETAIL_DESCRIPTION_PARENTHESES.sub('', detail_desc).strip()
+    return names
+
+def find_classification_file():
+    # Try multiple possible paths (prioritize local server folder)
+    possible_paths = [
+        os.path.join(os.path.dirname(__file__), 'rhino_commands_actions_classified.json'),  # Same folder as server_v2.py
+        '/home/rhinologs/rhino_commands_actions_classified.json',  # Production server path
+        'rhino_commands_actions_classified.json'  # Current directory fallback
+    ]
+    for path in possible_paths:
+        if os.path.exists(path):
+            return path
+    return None
+
+def compile_classification(path):
+    """Parse and compile a classification file, reusing the pickled cache when the file is unchanged"""
+    stat = os.stat(path)
+    cache_path = path + CLASSIFICATION_CACHE_SUFFIX
+    cached = None
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('format') != CLASSIFICATION_CACHE_FORMAT or cached.get('classifier_version') != CLASSIFIER_VERSION:
+            cached = None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        cached = None
+
+    raw = None
+    if not cached or (cached['mtime_ns'], cached['size']) != (stat.st_mtime_ns, stat.st_size):
+        with open(path, 'rb') as f:
+            raw = f.read()
+
+    fingerprint = hashlib.sha1(raw + f'classifier:{CLASSIFIER_VERSION}'.encode()).hexdigest() if raw is not None else None
+    if cached and (raw is None or cached['fingerprint'] == fingerprint):
+        classification_logger.debug('Using compiled classification cache %s', cache_path)
+        return CompiledRules(cached['classification'], cached['detail_names'], cached['fingerprint'],
+                             MappingProxyType(cached['lookup']), MappingProxyType(cached['aliases']),
+                             path, stat.st_mtime_ns, stat.st_size)
+
+    classification = json.loads(raw.decode('utf-8'))
+    lookup, aliases = build_command_lookup(classification)
+    detail_names = build_detail_category_names(classification)
+    try:
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'format': CLASSIFICATION_CACHE_FORMAT, 'classifier_version': CLASSIFIER_VERSION,
+                         'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'fingerprint': fingerprint,
+                         'classification': classification, 'detail_names': detail_names,
+                         'lookup': dict(lookup), 'aliases': dict(aliases)}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        classification_logger.info('Could not write classification cache %s: %s', cache_path, e)
+
+    return CompiledRules(classification, detail_names, fingerprint, lookup, aliases,
+                         path, stat.st_mtime_ns, stat.st_size)
+
+_lookup_cache_cleared = Counter()  # cache_clear で消えた分のヒット・ミス数（メトリクスを減らさない）
+
+def install_classification(rules):
+    """Swap in a compiled rules version (readers see either the old or the new tables)"""
+    global COMMAND_CLASSIFICATION, DETAIL_CATEGORY_NAMES, CLASSIFICATION_FINGERPRINT
+    global COMMAND_LOOKUP, COMMAND_ALIASES, CLASSIFICATION_RULES
+    CLASSIFICATION_RULES = rules
+    COMMAND_CLASSIFICATION = rules.classification
+    DETAIL_CATEGORY_NAMES = rules.detail_names
+    CLASSIFICATION_FINGERPRINT = rules.fingerprint
+    COMMAND_LOOKUP, COMMAND_ALIASES = rules.lookup, rules.aliases
+    # 古い版のキャッシュは版ごとのキーなので使われないが、メモリを空けておく
+    lookup = _lookup_command.cache_info()
+    _lookup_cache_cleared.update(hits=lookup.hits, misses=lookup.misses)
+    _lookup_command.cache_clear()
+    UNCLASSIFIED_COMMANDS.clear()
 
 def load_command_classification():
-    global COMMAND_CLASSIFICATION, DETAIL_CATEGORY_NAMES
     try:
-        # Try multiple possible paths (prioritize local server folder)
-        possible_paths = [
-            os.path.join(os.path.dirname(__file__), 'rhino_commands_actions_classified.json'),  # Same folder as server_v2.py
-            '/home/rhinologs/rhino_commands_actions_classified.json',  # Production server path
-            'rhino_commands_actions_classified.json'  # Current directory fallback
-        ]
-
-        for path in possible_paths:
-            if os.path.exists(path):
-                with open(path, 'r', encoding='utf-8') as f:
-                    COMMAND_CLASSIFICATION = json.load(f)
-                    mapping_count = len(COMMAND_CLASSIFICATION.get('classification_mapping', {}))
-                    print(f"✓ Command classification loaded from: {path}")
-                    print(f"  Total commands in mapping: {mapping_count}")
-
-                    # Extract detail category names from classification file
-                    DETAIL_CATEGORY_NAMES = {}
-
-                    # Build detail category names from detail_description in commands
-                    mapping = COMMAND_CLASSIFICATION.get('classification_mapping', {})
-                    for cmd_name, cmd_info in mapping.items():
-                        detail_cat = cmd_info.get('detail_category')
-                        detail_desc = cmd_info.get('detail_description')
-                        if detail_cat and detail_desc and detail_cat not in DETAIL_CATEGORY_NAMES:
-                            # Remove parentheses and their contents from description
-                            import re
-                            cleaned_desc = re.sub(r'[（(].*?[）)]', '', detail_desc).strip()
-                            # Use the cleaned description as the Japanese name
-                            DETAIL_CATEGORY_NAMES[detail_cat] = cleaned_desc
-
-                    print(f"  Extracted {len(DETAIL_CATEGORY_NAMES)} detail category names from classification file")
-                break
-        else:
-            print("⚠ Warning: Command classification file not found")
+        path = find_classification_file()
+        if path is None:
+            classification_logger.warning('Command classification file not found')
+            return
+
+        with _classification_lock:
+            rules = compile_classification(path)
+            install_classification(rules)
+        classification_logger.info('Command classification %s loaded from: %s (%d commands in mapping, '
+                                   '%d lookup keys, %d aliases, %d detail category names)',
+                                   rules.rules_version, path,
+                                   len(rules.classification.get('classification_mapping', {})),
+                                   len(rules.lookup), len(rules.aliases), len(rules.detail_names))
 
     except Exception as e:
-        print(f"⚠ Warning: Could not load command classification: {e}")
-
-# レベル判定ロジック
-def get_experience_score(level_str):
-    """経験レベルをスコアに変換"""
-    mapping = {
-        '未経験': 0,
-        '初心者': 30,
-        '中級者': 70,
-        'エキスパート': 100,
-        'beginner': 30,
-        'intermediate': 70,
-        'expert': 100
-    }
-    level_lower = str(level_str).lower()
-    for key, value in mapping.items():
-        if key.lower() in level_lower:
-            return value
-    return 0
-
-def calculate_cad_experience_score(cad_tools, modeling_tools, programming_langs):
-    """CAD経験スコアを計算"""
-    score = 0
-
-    # Parse tool lists (semicolon or comma separated)
-    cad_list = str(cad_tools).replace(',', ';').split(';') if cad_tools else []
-    modeling_list = str(modeling_tools).replace(',', ';').split(';') if modeling_tools else []
-    prog_list = str(programming_langs).replace(',', ';').split(';') if programming_langs else []
-
-    # Count unique tools: 8 points each
-    unique_tools = set()
-    for tools in [cad_list, modeling_list]:
-        for tool in tools:
-            if tool and tool.strip() and tool.strip() != 'nan':
-                unique_tools.add(tool.strip())
-    score += len(unique_tools) * 8
-
-    # Rhino bonus: +3
-    all_tools = ' '.join([str(cad_tools), str(modeling_tools)])
-    if 'Rhino' in all_tools:
-        score += 3
-
-    # Revit bonus: +3
-    if 'Revit' in all_tools:
-        score += 3
-
-    # Programming experience: 2 points each, Python and C# get extra bonus
-    for prog in prog_list:
-        if prog and prog.strip() and prog.strip() != 'nan':
-            if 'Python' in prog:
-                score += 2 + 3  # Base 2 + Python bonus 3
-            elif 'C#' in prog or 'CSharp' in prog:
-                score += 2 + 2  # Base 2 + C# bonus 2
-            else:
-                score += 2
-
-    return score
+        classification_logger.warning('Could not load command classification: %s', e)
 
-def calculate_rhino_gh_composite_score(rhino_score, gh_score):
-    """RhinoGH複合スコアを計算"""
-    if rhino_score == 0 and gh_score == 0:
-        return 0
-    elif rhino_score > 0 and gh_score == 0:
-        return rhino_score * 0.6
-    elif rhino_score == 0 and gh_score > 0:
-        return gh_score * 0.4
-    else:
-        return rhino_score * 0.6 + gh_score * 0.4
+def reload_command_classification(force=False):
+    """
+    Re-read the classification file if it changed (or when forced) and swap the rules in.
+    Returns True when a different rules version was installed; errors leave the current
+    rules in place and propagate to the caller.
+    """
+    path = find_classification_file()
+    if path is None:
+        raise FileNotFoundError('Command classification file not found')
+
+    with _classification_lock:
+        current = CLASSIFICATION_RULES
+        if not force and current is not None and current.source_path == path:
+            stat = os.stat(path)
+            if (stat.st_mtime_ns, stat.st_size) == (current.source_mtime_ns, current.source_size):
+                return False
+
+        rules = compile_classification(path)
+        if current is not None and rules.fingerprint == current.fingerprint:
+            return False
+        install_classification(rules)
+
+    classification_logger.info('Command classification reloaded: %s -> %s',
+                               current.rules_version if current else None, rules.rules_version)
+    # 保存済みログのカテゴリを新しいルールで付け直す
+    start_reclassification_job()
+    return True
+
+def start_classification_watcher():
+    """Poll the classification file for changes (once per process, after gunicorn forks)"""
+    pid = os.getpid()
+    if CLASSIFICATION_WATCH_SECONDS <= 0 or CLASSIFICATION_RULES is None or pid in _classification_watchers:
+        return
+    _classification_watchers.add(pid)
+
+    def run():
+        while True:
+            time.sleep(CLASSIFICATION_WATCH_SECONDS)
+            try:
+                reload_command_classification()
+            except Exception as e:
+                # 壊れたファイルが直るまで毎回失敗するので間引いて出す
+                classification_row_logger.warning('Could not reload command classification: %s', e)
 
-def calculate_overall_score(technical_score, cad_score, self_learning_score, rhino_gh_score):
-    """総合スコアを計算"""
-    return (technical_score * 0.25 +
-            cad_score * 0.15 +
-            self_learning_score * 0.20 +
-            rhino_gh_score * 0.40)
+    threading.Thread(target=run, name='rhinolog-classification-watcher', daemon=True).start()
 
-def determine_user_level(rhino_score, gh_score, technical_score, self_learning_score, cad_experience_score=0):
-    """ユーザーレベルを判定（1-5）
+@app.before_request
+def capture_classification_rules():
+    g.classification_rules = CLASSIFICATION_RULES
 
-    CAD経験スコアを含めた総合評価でレベルを判定
-    """
-    # RhinoGH複合スコアを計算
-    rhino_gh_score = calculate_rhino_gh_composite_score(rhino_score, gh_score)
-
-    # 総合スコアを計算
-    overall_score = calculate_overall_score(technical_score, cad_experience_score,
-                                           self_learning_score, rhino_gh_score)
-
-    # Level 5 判定: 最高レベル - 全ての条件を満たす
-    if (rhino_score >= 70 and gh_score >= 70 and
-        technical_score >= 60 and self_learning_score >= 60):
-        return 5
-
-    # Level 4 判定: 上級レベル - 総合スコアと個別条件
-    if ((rhino_score >= 70 and gh_score >= 70 and technical_score >= 50) or
-        (rhino_score >= 30 and gh_score >= 30 and technical_score >= 77) or
-        (rhino_score >= 70 and gh_score >= 30 and technical_score >= 50) or
-        (overall_score >= 65)):  # 総合スコアでの判定を追加
-        return 4
-
-    # Level 3 判定: 中級レベル
-    if ((rhino_score >= 70 and gh_score <= 30) or
-        (rhino_score == 30 and gh_score == 30) or
-        (overall_score >= 45)):  # 総合スコアでの判定を追加
-        return 3
-
-    # Level 2 判定: 初級レベル
-    if (rhino_score == 30 and gh_score == 0) or (overall_score >= 25):
-        return 2
-
-    # Level 1 判定: 入門レベル
-    return 1
+@app.after_request
+def add_rules_version_header(response):
+    """X-Rules-Version: the rules version that was current when the request started"""
+    rules = g.get('classification_rules')
+    if rules is not None:
+        response.headers['X-Rules-Version'] = rules.rules_version
+    return response
 
 # データベース初期化
+#
+# 起動時に行うのはテーブル作成とマイグレーションだけ。過去ログの分類と、分類から作る集計テーブル・
+# アクショングループは、受け付けを始めてから再分類ジョブ（start_reclassification_job）が埋める。
 def init_db():
     os.makedirs(LOG_BASE_DIR, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+    with db_connection() as conn:
+        _create_tables(conn)
+        applied = run_migrations(conn)
+        if applied & {4, 5, 14}:
+            # 新しく作った集計テーブル・アクショングループを埋めるため、再分類ジョブを実行させる
+            conn.execute("DELETE FROM app_meta WHERE key = 'classification_fingerprint'")
+            conn.commit()
+
+def _create_tables(conn):
     c = conn.cursor()
 
     # ユーザーテーブル
@@ -209,81 +749,594 @@ def init_db():
     )''')
 
     conn.commit()
-    conn.close()
 
-# ユーザー登録（Googleフォームから）
-@app.route('/api/user/register', methods=['POST'])
-def register_user():
+def timestamp_to_epoch(timestamp_str):
+    """Convert a log timestamp ('YYYY-MM-DD HH:MM:SS') to integer epoch seconds, or None if unparsable
+
+    Naive timestamps are treated as UTC so the value matches SQLite's strftime('%s', ...).
+    """
     try:
-        data = request.json
-        required = ['username', 'full_name', 'start_date', 'end_date']
+        dt = datetime.fromisoformat(str(timestamp_str).strip())
+    except ValueError:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return calendar.timegm(dt.timetuple())
+
+# スキーママイグレーション（起動時に未適用のものを順番に実行）
+#
+# 各マイグレーションは途中で中断されても再実行できるように冪等に書く。
+# 大きなテーブルの書き換えは小さなバッチに分けてコミットし、稼働中のサーバーの
+# 書き込みをブロックし続けないようにする。
+MIGRATION_BATCH_SIZE = 5000
+
+def _table_columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+def _backfill_in_batches(conn, update_sql, select_ids_sql):
+    """Run update_sql for id ranges of MIGRATION_BATCH_SIZE rows, committing after each batch"""
+    max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM logs').fetchone()[0]
+    low = conn.execute(select_ids_sql).fetchone()[0]
+    if low is None:
+        return
+    while low <= max_id:
+        high = low + MIGRATION_BATCH_SIZE
+        conn.execute(update_sql, (low, high))
+        conn.commit()
+        low = high
 
-        for field in required:
-            if field not in data:
-                return jsonify({'error': f'Missing field: {field}'}), 400
+def migration_001_log_indexes(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_logs_username_timestamp ON logs(username, timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_logs_action_timestamp ON logs(action, timestamp)')
+    conn.commit()
 
-        # レベル判定パラメータを取得
+def migration_002_log_epoch(conn):
+    if 'ts_epoch' not in _table_columns(conn, 'logs'):
+        conn.execute('ALTER TABLE logs ADD COLUMN ts_epoch INTEGER')
+        conn.commit()
+
+    _backfill_in_batches(
+        conn,
+        '''UPDATE logs SET ts_epoch = CAST(strftime('%s', timestamp) AS INTEGER)
+           WHERE id >= ? AND id < ? AND ts_epoch IS NULL''',
+        'SELECT MIN(id) FROM logs WHERE ts_epoch IS NULL')
+
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_logs_username_ts_epoch ON logs(username, ts_epoch)')
+    conn.commit()
+
+def migration_003_log_classification(conn):
+    columns = _table_columns(conn, 'logs')
+    for column in ('command', 'workflow_category', 'detail_category'):
+        if column not in columns:
+            conn.execute(f'ALTER TABLE logs ADD COLUMN {column} TEXT')
+
+    # 既存行の分類は再分類ジョブが埋める（app_meta に指紋がないため。start_reclassification_job）
+    conn.execute('''CREATE TABLE IF NOT EXISTS app_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )''')
+    conn.commit()
+
+def migration_004_user_rollups(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_category_stats (
+        username TEXT NOT NULL,
+        day TEXT NOT NULL,
+        workflow_category TEXT NOT NULL,
+        detail_category TEXT NOT NULL,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (username, day, workflow_category, detail_category)
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_daily_stats (
+        username TEXT NOT NULL,
+        day TEXT NOT NULL,
+        total_events INTEGER NOT NULL DEFAULT 0,
+        command_events INTEGER NOT NULL DEFAULT 0,
+        first_timestamp TEXT,
+        last_timestamp TEXT,
+        PRIMARY KEY (username, day)
+    ) WITHOUT ROWID''')
+    # 中身は分類を埋めた後に再分類ジョブが作る（start_reclassification_job）
+    conn.commit()
+
+def migration_005_action_groups(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS action_groups (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        window_minutes INTEGER NOT NULL,
+        start_time TEXT NOT NULL,
+        end_time TEXT NOT NULL,
+        start_epoch INTEGER NOT NULL,
+        end_epoch INTEGER NOT NULL,
+        total_actions INTEGER NOT NULL,
+        workflow_counts TEXT NOT NULL,
+        detail_counts TEXT NOT NULL,
+        dominant_workflow TEXT
+    )''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_action_groups_user_window_start
+                    ON action_groups(username, window_minutes, start_epoch)''')
+    # 中身は分類を埋めた後に再分類ジョブが作る（start_reclassification_job）
+    conn.commit()
+
+def migration_006_user_watermarks(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_watermarks (
+        username TEXT PRIMARY KEY,
+        max_log_id INTEGER NOT NULL,
+        updated_epoch INTEGER NOT NULL
+    )''')
+    conn.execute('''INSERT OR REPLACE INTO user_watermarks (username, max_log_id, updated_epoch)
+                    SELECT username, MAX(id), COALESCE(CAST(strftime('%s', MAX(created_at)) AS INTEGER), 0)
+                    FROM logs GROUP BY username''')
+    conn.commit()
+
+def migration_007_log_archives(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS log_archives (
+        username TEXT NOT NULL,
+        month TEXT NOT NULL,
+        path TEXT NOT NULL,
+        row_count INTEGER NOT NULL,
+        min_timestamp TEXT,
+        max_timestamp TEXT,
+        min_ts_epoch INTEGER,
+        max_ts_epoch INTEGER,
+        max_log_id INTEGER,
+        command_counts TEXT NOT NULL DEFAULT '[]',
+        bytes INTEGER NOT NULL DEFAULT 0,
+        archived_at TEXT NOT NULL,
+        PRIMARY KEY (username, month)
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_log_archives_month ON log_archives(month)')
+    conn.commit()
+
+# logs テーブルを辞書エンコードした log_events へ移す（1行は整数だけ、文字列は辞書テーブルに1回ずつ）
+#
+#   users.id      ユーザー名
+#   actions       アクション名
+#   log_details   (action, detail) の組とその分類結果（コマンド名・レイヤー名・開いたファイルのパス）
+#   documents     ドキュメント名
+#
+# 時刻は ts_epoch だけを持ち、'YYYY-MM-DD HH:MM:SS' に戻せない形式の時刻だけ timestamp_text に残す。
+# 従来の列構成は logs ビューで読め、logs への INSERT/DELETE はトリガーが log_events に振り替える。
+LOGS_VIEW_SQL = '''CREATE VIEW IF NOT EXISTS logs AS
+    SELECT e.id AS id,
+           COALESCE(e.timestamp_text, strftime('%Y-%m-%d %H:%M:%S', e.ts_epoch, 'unixepoch')) AS timestamp,
+           u.username AS username,
+           a.name AS action,
+           d.detail AS detail,
+           doc.name AS document_name,
+           strftime('%Y-%m-%dT%H:%M:%S', e.created_epoch, 'unixepoch') AS created_at,
+           e.ts_epoch AS ts_epoch,
+           d.command AS command,
+           d.workflow_category AS workflow_category,
+           d.detail_category AS detail_category
+    FROM log_events e
+    JOIN users u ON u.id = e.user_id
+    JOIN log_details d ON d.id = e.detail_id
+    JOIN actions a ON a.id = d.action_id
+    LEFT JOIN documents doc ON doc.id = e.document_id'''
+
+LOGS_VIEW_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS logs_insert INSTEAD OF INSERT ON logs
+    BEGIN
+        INSERT OR IGNORE INTO actions (name) VALUES (NEW.action);
+        INSERT INTO log_details (action_id, detail, command, workflow_category, detail_category)
+            SELECT a.id, NEW.detail, NEW.command, NEW.workflow_category, NEW.detail_category
+            FROM actions a
+            WHERE a.name = NEW.action
+              AND NOT EXISTS (SELECT 1 FROM log_details d WHERE d.action_id = a.id AND d.detail IS NEW.detail);
+        INSERT OR IGNORE INTO documents (name) SELECT NEW.document_name WHERE NEW.document_name IS NOT NULL;
+        INSERT INTO log_events (id, user_id, ts_epoch, detail_id, document_id, created_epoch, timestamp_text)
+        SELECT NEW.id,
+               (SELECT id FROM users WHERE username = NEW.username),
+               epoch,
+               (SELECT d.id FROM log_details d JOIN actions a ON a.id = d.action_id
+                WHERE a.name = NEW.action AND d.detail IS NEW.detail),
+               (SELECT id FROM documents WHERE name = NEW.document_name),
+               COALESCE(CAST(strftime('%s', NEW.created_at) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)),
+               CASE WHEN strftime('%Y-%m-%d %H:%M:%S', epoch, 'unixepoch') IS NEW.timestamp
+                    THEN NULL ELSE NEW.timestamp END
+        FROM (SELECT COALESCE(NEW.ts_epoch, CAST(strftime('%s', NEW.timestamp) AS INTEGER)) AS epoch);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS logs_delete INSTEAD OF DELETE ON logs
+    BEGIN
+        DELETE FROM log_events WHERE id = OLD.id;
+    END''',
+]
+
+def _schema_object_type(conn, name):
+    row = conn.execute('SELECT type FROM sqlite_master WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+def migration_008_log_events(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS actions (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS log_details (
+        id INTEGER PRIMARY KEY,
+        action_id INTEGER NOT NULL REFERENCES actions(id),
+        detail TEXT,
+        command TEXT,
+        workflow_category TEXT,
+        detail_category TEXT
+    )''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_log_details_action_detail ON log_details(action_id, detail)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS log_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL REFERENCES users(id),
+        ts_epoch INTEGER,
+        detail_id INTEGER NOT NULL REFERENCES log_details(id),
+        document_id INTEGER REFERENCES documents(id),
+        created_epoch INTEGER NOT NULL,
+        timestamp_text TEXT
+    )''')
+    conn.commit()
+
+    copied = 0
+    if _schema_object_type(conn, 'logs') == 'table':
+        copied = _copy_logs_to_log_events(conn)
+
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_log_events_user_epoch ON log_events(user_id, ts_epoch)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_log_events_epoch ON log_events(ts_epoch)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_log_events_user_detail ON log_events(user_id, detail_id)')
+    conn.commit()
+
+    # VACUUM は排他ロックと DB の2倍のディスクが要るので起動時には行わない（--vacuum で実行する）
+    if copied:
+        db_logger.info('Moved %d log rows to log_events; run server_v2.py --vacuum during a maintenance '
+                       'window to reclaim the space of the old logs table', copied)
+
+def _copy_logs_to_log_events(conn):
+    """Fill the dictionaries and log_events from the logs table in batches, then replace it with the view"""
+    def fill_dictionaries(after_id):
+        # 外部キーを検証していなかった頃の未登録ユーザーのログは仮のユーザー行を作って残す
+        conn.execute('''INSERT INTO users (username, full_name, start_date, end_date, created_at)
+                        SELECT DISTINCT l.username, l.username, '', '', ? FROM logs l
+                        WHERE l.id > ? AND NOT EXISTS (SELECT 1 FROM users u WHERE u.username = l.username)''',
+                     (datetime.now().isoformat(), after_id))
+        conn.execute('INSERT OR IGNORE INTO actions (name) SELECT DISTINCT action FROM logs WHERE id > ?',
+                     (after_id,))
+        conn.execute('''INSERT OR IGNORE INTO documents (name)
+                        SELECT DISTINCT document_name FROM logs WHERE id > ? AND document_name IS NOT NULL''',
+                     (after_id,))
+        conn.execute('''INSERT INTO log_details (action_id, detail, command, workflow_category, detail_category)
+                        SELECT a.id, l.detail, MAX(l.command), MAX(l.workflow_category), MAX(l.detail_category)
+                        FROM logs l JOIN actions a ON a.name = l.action
+                        WHERE l.id > ?
+                          AND NOT EXISTS (SELECT 1 FROM log_details d WHERE d.action_id = a.id AND d.detail IS l.detail)
+                        GROUP BY a.id, l.detail''', (after_id,))
+
+    def copy_rows(low, high):
+        return conn.execute('''INSERT INTO log_events
+            (id, user_id, ts_epoch, detail_id, document_id, created_epoch, timestamp_text)
+            SELECT l.id, u.id, l.ts_epoch, d.id, doc.id,
+                   COALESCE(CAST(strftime('%s', l.created_at) AS INTEGER), 0),
+                   CASE WHEN strftime('%Y-%m-%d %H:%M:%S', l.ts_epoch, 'unixepoch') IS l.timestamp
+                        THEN NULL ELSE l.timestamp END
+            FROM logs l
+            JOIN users u ON u.username = l.username
+            JOIN actions a ON a.name = l.action
+            JOIN log_details d ON d.action_id = a.id AND d.detail IS l.detail
+            LEFT JOIN documents doc ON doc.name = l.document_name
+            WHERE l.id > ? AND l.id <= ?''', (low, high)).rowcount
+
+    # 中断されても log_events の最大 id から続きをコピーする（id はそのまま引き継ぐ）
+    low = conn.execute('SELECT COALESCE(MAX(id), 0) FROM log_events').fetchone()[0]
+    fill_dictionaries(low)
+    conn.commit()
+    max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM logs').fetchone()[0]
+    copied = 0
+    while low < max_id:
+        high = low + MIGRATION_BATCH_SIZE
+        copied += copy_rows(low, high)
+        conn.commit()
+        low = high
+
+    # 差し替えは書き込みロックの中で行う。コピー中に稼働中のサーバーが書いた行をここで移し、
+    # コピー後に消された行（アーカイブなど）は log_events からも消してから件数を突き合わせる
+    conn.execute('BEGIN IMMEDIATE')
+    last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM log_events').fetchone()[0]
+    fill_dictionaries(last_id)
+    copied += copy_rows(last_id, conn.execute('SELECT COALESCE(MAX(id), 0) FROM logs').fetchone()[0])
+    conn.execute('DELETE FROM log_events WHERE id NOT IN (SELECT id FROM logs)')
+    logs_count = conn.execute('SELECT COUNT(*) FROM logs').fetchone()[0]
+    events_count = conn.execute('SELECT COUNT(*) FROM log_events').fetchone()[0]
+    if logs_count != events_count:
+        conn.rollback()
+        raise RuntimeError(f'log_events has {events_count} rows but logs has {logs_count}; logs was not replaced')
+
+    # 削除済みの id を再利用しないよう AUTOINCREMENT の位置も引き継いでから差し替える
+    old_seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'logs'").fetchone()
+    new_seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'log_events'").fetchone()
+    seq = max(old_seq[0] if old_seq else 0, new_seq[0] if new_seq else 0)
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = 'log_events'")
+    conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('log_events', ?)", (seq,))
+    conn.execute('DROP TABLE logs')
+    conn.execute(LOGS_VIEW_SQL)
+    for trigger in LOGS_VIEW_TRIGGERS:
+        conn.execute(trigger)
+    conn.commit()
+    return copied
+
+def migration_009_event_ids(conn):
+    # 既存の行は NULL のまま（一意インデックスの対象外）。以降の取り込みから重複を弾く
+    if 'event_hash' not in _table_columns(conn, 'log_events'):
+        conn.execute('ALTER TABLE log_events ADD COLUMN event_hash INTEGER')
+    conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_log_events_user_event
+                    ON log_events(user_id, event_hash) WHERE event_hash IS NOT NULL''')
+    conn.commit()
+
+def migration_010_scoring_version(conn):
+    # 既存ユーザーは NULL（どのルールで計算したか不明）。--relevel で現在のルールに揃える
+    if 'scoring_version' not in _table_columns(conn, 'users'):
+        conn.execute('ALTER TABLE users ADD COLUMN scoring_version INTEGER')
+    conn.commit()
+
+def migration_011_screening_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS screening_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        technical_score REAL NOT NULL,
+        category_scores TEXT,
+        question_scores TEXT,
+        submitted_at TEXT NOT NULL,
+        FOREIGN KEY (username) REFERENCES users(username)
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS screening_question_scores (
+        username TEXT NOT NULL REFERENCES screening_results(username),
+        question INTEGER NOT NULL,
+        points NUMERIC NOT NULL,
+        PRIMARY KEY (username, question)
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS screening_category_scores (
+        username TEXT NOT NULL REFERENCES screening_results(username),
+        category TEXT NOT NULL,
+        name TEXT,
+        correct INTEGER,
+        total INTEGER,
+        percentage REAL,
+        PRIMARY KEY (username, category)
+    ) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_screening_question_scores_question ON screening_question_scores(question, points)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_screening_category_scores_category ON screening_category_scores(category, percentage)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_learning_group ON users(learning_group)')
+
+    # JSON 列の内容を正規化テーブルへ移し、JSON 列は空にする（以降は書かない）
+    questions, categories = [], []
+    for username, category_scores, question_scores in conn.execute(
+            '''SELECT username, category_scores, question_scores FROM screening_results
+               WHERE category_scores IS NOT NULL OR question_scores IS NOT NULL'''):
+        for number, points in (json.loads(question_scores) if question_scores else {}).items():
+            try:
+                questions.append((username, int(number), float(points)))
+            except (TypeError, ValueError):
+                continue
+        for category, scores in (json.loads(category_scores) if category_scores else {}).items():
+            if isinstance(scores, dict):
+                categories.append((username, category, scores.get('name'), scores.get('correct'),
+                                   scores.get('total'), scores.get('percentage')))
+    conn.executemany('''INSERT OR REPLACE INTO screening_question_scores (username, question, points)
+                        VALUES (?, ?, ?)''', questions)
+    conn.executemany('''INSERT OR REPLACE INTO screening_category_scores
+                        (username, category, name, correct, total, percentage) VALUES (?, ?, ?, ?, ?, ?)''',
+                     categories)
+    conn.execute('UPDATE screening_results SET category_scores = NULL, question_scores = NULL')
+    conn.commit()
+
+def migration_012_archived_event_hashes(conn):
+    # アーカイブで log_events から消えたイベントの event_hash（再送をアーカイブ後も重複として弾く）
+    conn.execute('''CREATE TABLE IF NOT EXISTS archived_event_hashes (
+        user_id INTEGER NOT NULL,
+        event_hash INTEGER NOT NULL,
+        PRIMARY KEY (user_id, event_hash)
+    ) WITHOUT ROWID''')
+    conn.commit()
+
+def migration_013_nullable_user_dates(conn):
+    # 受講期間の NOT NULL を外す（NOT NULL を外すだけなら表を作り直さずにスキーマの SQL を書き換えられる）
+    table_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone()[0]
+    relaxed_sql = (table_sql.replace('start_date TEXT NOT NULL', 'start_date TEXT')
+                   .replace('end_date TEXT NOT NULL', 'end_date TEXT'))
+    if relaxed_sql != table_sql:
+        schema_version = conn.execute('PRAGMA schema_version').fetchone()[0]
+        conn.execute('PRAGMA writable_schema = ON')
+        conn.execute("UPDATE sqlite_master SET sql = ? WHERE type = 'table' AND name = 'users'", (relaxed_sql,))
+        conn.execute(f'PRAGMA schema_version = {schema_version + 1}')
+        conn.execute('PRAGMA writable_schema = OFF')
+        conn.commit()
+
+    # マイグレーション 8 が未登録ユーザーのログ用に作った仮のユーザー行は受講期間が不明
+    conn.execute('''UPDATE users SET start_date = NULL, end_date = NULL
+                    WHERE start_date = '' AND end_date = '' AND full_name = username AND email IS NULL''')
+    conn.commit()
+
+def migration_014_user_command_rollup(conn):
+    # ユーザー × コマンド（Command の Detail）の回数。中身は再分類ジョブが作る（start_reclassification_job）
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_command_stats (
+        username TEXT NOT NULL,
+        detail TEXT NOT NULL,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (username, detail)
+    ) WITHOUT ROWID''')
+    conn.commit()
+
+MIGRATIONS = [
+    (1, 'Index logs by (username, timestamp) and (action, timestamp)', migration_001_log_indexes),
+    (2, 'Add indexed integer epoch column logs.ts_epoch', migration_002_log_epoch),
+    (3, 'Store command/workflow_category/detail_category on logs at ingest', migration_003_log_classification),
+    (4, 'Add per-user daily/category rollup tables', migration_004_user_rollups),
+    (5, 'Persist sessionized action groups', migration_005_action_groups),
+    (6, 'Track per-user log watermarks for conditional GET', migration_006_user_watermarks),
+    (7, 'Catalog of archived user-month log files', migration_007_log_archives),
+    (8, 'Dictionary-encoded log_events table behind a logs view', migration_008_log_events),
+    (9, 'Unique per-user event ids for idempotent uploads', migration_009_event_ids),
+    (10, 'Record the scoring rules version of each user level', migration_010_scoring_version),
+    (11, 'Normalized, indexed screening question and category scores', migration_011_screening_tables),
+    (12, 'Keep the event hashes of archived logs for duplicate detection', migration_012_archived_event_hashes),
+    (13, 'Allow unknown start/end dates for users created from orphaned logs', migration_013_nullable_user_dates),
+    (14, 'Add a per-user command count rollup table', migration_014_user_command_rollup),
+]
+
+def run_migrations(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )''')
+    conn.commit()
+
+    applied = {row[0] for row in conn.execute('SELECT version FROM schema_version')}
+    newly_applied = set()
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+
+        migrate(conn)
+        conn.execute('INSERT OR IGNORE INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                     (version, description, datetime.now().isoformat()))
+        conn.commit()
+        newly_applied.add(version)
+        db_logger.info('Applied schema migration %d: %s', version, description)
+    return newly_applied
+
+# ユーザー登録（Googleフォームから）
+USER_REQUIRED_FIELDS = ['username', 'full_name', 'start_date', 'end_date']
+MAX_BULK_USERS = 2000
+USER_UPSERT_SQL = '''INSERT INTO users
+    (username, full_name, email, organization, start_date, end_date, created_at,
+     user_level, learning_group, rhino_experience, grasshopper_experience,
+     technical_score, self_learning_score,
+     cad_tools, modeling_tools, programming_languages, cad_experience_score, scoring_version)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(username) DO UPDATE SET
+        full_name = excluded.full_name, email = excluded.email, organization = excluded.organization,
+        start_date = excluded.start_date, end_date = excluded.end_date, user_level = excluded.user_level,
+        learning_group = excluded.learning_group, rhino_experience = excluded.rhino_experience,
+        grasshopper_experience = excluded.grasshopper_experience,
+        technical_score = excluded.technical_score, self_learning_score = excluded.self_learning_score,
+        cad_tools = excluded.cad_tools, modeling_tools = excluded.modeling_tools,
+        programming_languages = excluded.programming_languages,
+        cad_experience_score = excluded.cad_experience_score, scoring_version = excluded.scoring_version'''
+
+def build_user_rows(registrations, created_at):
+    """
+    Validate and score registrations in one pass -> (rows for USER_UPSERT_SQL, errors)
+
+    errors maps a registration's position to its message; those positions have no row.
+    Experience and CAD scores are computed once per distinct answer, since a cohort
+    mostly picks the same few choices.
+    """
+    experience_scores = {}
+    cad_scores = {}
+    rows, errors = {}, {}
+    for position, data in enumerate(registrations):
+        if not isinstance(data, dict):
+            errors[position] = 'Registration must be a JSON object'
+            continue
+        missing = next((field for field in USER_REQUIRED_FIELDS if field not in data), None)
+        if missing:
+            errors[position] = f'Missing field: {missing}'
+            continue
+        if any(isinstance(value, (list, dict)) for value in data.values()):
+            errors[position] = 'Fields must be strings or numbers'
+            continue
+        try:
+            technical_score = float(data.get('technical_score', 0))
+            self_learning = float(data.get('self_learning_score', 60))
+        except (TypeError, ValueError):
+            errors[position] = 'technical_score and self_learning_score must be numbers'
+            continue
+
+        # レベル判定パラメータ
         rhino_exp = data.get('rhino_experience', '未経験')
         gh_exp = data.get('grasshopper_experience', '未経験')
-        technical_score = float(data.get('technical_score', 0))
-        self_learning = float(data.get('self_learning_score', 60))
-        learning_group = data.get('learning_group', '')
-
-        # CAD経験データを取得
         cad_tools = data.get('cad_tools', '')
         modeling_tools = data.get('modeling_tools', '')
         programming_langs = data.get('programming_languages', '')
 
-        # スコア計算
-        rhino_score = get_experience_score(rhino_exp)
-        gh_score = get_experience_score(gh_exp)
-        cad_experience_score = calculate_cad_experience_score(cad_tools, modeling_tools, programming_langs)
+        for answer in (rhino_exp, gh_exp):
+            if answer not in experience_scores:
+                experience_scores[answer] = get_experience_score(answer)
+        tools = (cad_tools, modeling_tools, programming_langs)
+        if tools not in cad_scores:
+            cad_scores[tools] = calculate_cad_experience_score(*tools)
+        cad_experience_score = cad_scores[tools]
+
+        user_level = determine_user_level(experience_scores[rhino_exp], experience_scores[gh_exp],
+                                          technical_score, self_learning, cad_experience_score)
+        rows[position] = (data['username'], data['full_name'], data.get('email', ''),
+                          data.get('organization', ''), data['start_date'], data['end_date'],
+                          created_at, user_level, data.get('learning_group', ''),
+                          rhino_exp, gh_exp, technical_score, self_learning,
+                          cad_tools, modeling_tools, programming_langs, cad_experience_score,
+                          SCORING_RULES_VERSION)
+    return rows, errors
 
-        # レベル判定（CAD経験スコアを含む）
-        user_level = determine_user_level(rhino_score, gh_score, technical_score, self_learning, cad_experience_score)
+@app.route('/api/user/register', methods=['POST'])
+def register_user():
+    try:
+        data = request.json
+        rows, errors = build_user_rows([data], datetime.now().isoformat())
+        if errors:
+            return jsonify({'error': errors[0]}), 400
+        row = rows[0]
 
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
+        # 既存ユーザーは created_at を残して更新
+        c.execute(USER_UPSERT_SQL, row)
+        conn.commit()
 
-        # 既存チェック
-        c.execute('SELECT username FROM users WHERE username = ?', (data['username'],))
-        if c.fetchone():
-            # 既存ユーザーの更新
-            c.execute('''UPDATE users SET
-                full_name = ?, email = ?, organization = ?,
-                start_date = ?, end_date = ?, user_level = ?,
-                learning_group = ?, rhino_experience = ?, grasshopper_experience = ?,
-                technical_score = ?, self_learning_score = ?,
-                cad_tools = ?, modeling_tools = ?, programming_languages = ?, cad_experience_score = ?
-                WHERE username = ?''',
-                (data['full_name'], data.get('email', ''), data.get('organization', ''),
-                 data['start_date'], data['end_date'], user_level,
-                 learning_group, rhino_exp, gh_exp, technical_score, self_learning,
-                 cad_tools, modeling_tools, programming_langs, cad_experience_score,
-                 data['username']))
-        else:
-            # 新規登録
-            c.execute('''INSERT INTO users
-                (username, full_name, email, organization, start_date, end_date, created_at,
-                 user_level, learning_group, rhino_experience, grasshopper_experience,
-                 technical_score, self_learning_score,
-                 cad_tools, modeling_tools, programming_languages, cad_experience_score)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                (data['username'], data['full_name'], data.get('email', ''),
-                 data.get('organization', ''), data['start_date'], data['end_date'],
-                 datetime.now().isoformat(), user_level, learning_group,
-                 rhino_exp, gh_exp, technical_score, self_learning,
-                 cad_tools, modeling_tools, programming_langs, cad_experience_score))
+        return jsonify({
+            'status': 'success',
+            'message': 'User registered',
+            'user_level': row[7],
+            'learning_group': row[8],
+            'cad_experience_score': row[16]
+        }), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# ユーザー一括登録（受講者名簿のスプレッドシートから）
+@app.route('/api/users/bulk', methods=['POST'])
+def register_users_bulk():
+    """Upsert many registrations in one transaction and report per-row status"""
+    try:
+        data = request.json
+        registrations = data.get('users') if isinstance(data, dict) else data
+        if not isinstance(registrations, list):
+            return jsonify({'error': 'Expected a JSON array or {"users": [...]}'}), 400
+        if len(registrations) > MAX_BULK_USERS:
+            return jsonify({'error': f'Too many users in one request (max {MAX_BULK_USERS})'}), 413
+
+        rows, errors = build_user_rows(registrations, datetime.now().isoformat())
 
+        conn = get_db()
+        c = conn.cursor()
+        if not conn.in_transaction:
+            c.execute('BEGIN IMMEDIATE')
+        existing = fetch_registered_usernames(c, [row[0] for row in rows.values()])
+        c.executemany(USER_UPSERT_SQL, rows.values())
         conn.commit()
-        conn.close()
 
+        results = []
+        for position in range(len(registrations)):
+            if position in errors:
+                results.append({'index': position, 'status': 'rejected', 'error': errors[position]})
+                continue
+            row = rows[position]
+            # 同じリクエスト内で2回目以降に出てきたユーザー名も updated
+            status = 'updated' if row[0] in existing else 'created'
+            existing.add(row[0])
+            results.append({'index': position, 'username': row[0], 'status': status,
+                            'user_level': row[7], 'learning_group': row[8],
+                            'cad_experience_score': row[16]})
+
+        counts = Counter(result['status'] for result in results)
         return jsonify({
             'status': 'success',
-            'message': 'User registered',
-            'user_level': user_level,
-            'learning_group': learning_group,
-            'cad_experience_score': cad_experience_score
+            'created': counts['created'],
+            'updated': counts['updated'],
+            'rejected': counts['rejected'],
+            'results': results
         }), 200
 
     except Exception as e:
@@ -293,200 +1346,1499 @@ def register_user():
 @app.route('/api/user/<username>', methods=['GET'])
 def get_user(username):
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
-        c.execute('''SELECT id, username, full_name, email, organization, start_date, end_date,
-                     created_at, user_level, learning_group, rhino_experience, grasshopper_experience,
-                     technical_score, self_learning_score, cad_tools, modeling_tools,
-                     programming_languages, cad_experience_score
-                     FROM users WHERE username = ?''', (username,))
-        row = c.fetchone()
-        conn.close()
+        user = fetch_user_profile(c, username)
 
-        if not row:
+        if not user:
             return jsonify({'error': 'User not found', 'registered': False}), 404
 
-        user = {
-            'username': row[1],
-            'full_name': row[2],
-            'email': row[3],
-            'organization': row[4],
-            'start_date': row[5],
-            'end_date': row[6],
-            'registered': True,
-            'user_level': row[8],
-            'learning_group': row[9],
-            'rhino_experience': row[10],
-            'grasshopper_experience': row[11],
-            'technical_score': row[12],
-            'self_learning_score': row[13],
-            'cad_tools': row[14],
-            'modeling_tools': row[15],
-            'programming_languages': row[16],
-            'cad_experience_score': row[17]
-        }
-
         return jsonify(user), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def fetch_user_profile(c, username):
+    """Registered user's profile as returned by /api/user/<username> (None if not registered)"""
+    c.execute('''SELECT id, username, full_name, email, organization, start_date, end_date,
+                 created_at, user_level, learning_group, rhino_experience, grasshopper_experience,
+                 technical_score, self_learning_score, cad_tools, modeling_tools,
+                 programming_languages, cad_experience_score
+                 FROM users WHERE username = ?''', (username,))
+    row = c.fetchone()
+
+    if not row:
+        return None
+
+    return {
+        'username': row[1],
+        'full_name': row[2],
+        'email': row[3],
+        'organization': row[4],
+        'start_date': row[5],
+        'end_date': row[6],
+        'registered': True,
+        'user_level': row[8],
+        'learning_group': row[9],
+        'rhino_experience': row[10],
+        'grasshopper_experience': row[11],
+        'technical_score': row[12],
+        'self_learning_score': row[13],
+        'cad_tools': row[14],
+        'modeling_tools': row[15],
+        'programming_languages': row[16],
+        'cad_experience_score': row[17]
+    }
+
 # ログアップロード（Rhinoプラグインから）
+LOG_REQUIRED_FIELDS = ['Timestamp', 'UserID', 'Action', 'Detail', 'DocumentName']
+MAX_BATCH_EVENTS = 5000
+SQLITE_MAX_VARIABLES = 900
+EVENT_ID_MAX_LENGTH = 128
+
+def validate_log_event(data):
+    """Return an error message for a malformed log event, or None if it is valid"""
+    if not isinstance(data, dict):
+        return 'Event must be a JSON object'
+
+    for field in LOG_REQUIRED_FIELDS:
+        if field not in data:
+            return f'Missing field: {field}'
+
+    event_id = data.get('EventId')
+    if event_id is not None and (not isinstance(event_id, str) or len(event_id) > EVENT_ID_MAX_LENGTH):
+        return f'EventId must be a string of at most {EVENT_ID_MAX_LENGTH} characters'
+
+    return None
+
+def fetch_registered_usernames(c, usernames):
+    """Return the subset of usernames that exist in the users table (one query per 900 names)"""
+    usernames = list(set(usernames))
+    registered = set()
+    for i in range(0, len(usernames), SQLITE_MAX_VARIABLES):
+        chunk = usernames[i:i + SQLITE_MAX_VARIABLES]
+        placeholders = ','.join('?' * len(chunk))
+        c.execute(f'SELECT username FROM users WHERE username IN ({placeholders})', chunk)
+        registered.update(row[0] for row in c.fetchall())
+    return registered
+
+# イベントの同一性（再送・スプールの再生で二重に数えないため）
+#
+# クライアントが付けた EventId をユーザー名と合わせて 64 ビットのハッシュにして log_events.event_hash に持つ。
+# (user_id, event_hash) の一意インデックスがあるので、同じバッチを何度送り直しても1回分しか残らない。
+# EventId のないイベントは event_hash を NULL にして重複判定しない（同じ秒に同じ操作を2回しても両方残す）。
+def event_hash(username, event_id):
+    """Signed 64-bit dedup key of one user's event id"""
+    digest = hashlib.blake2b(f'{username}\x1f{event_id}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+def build_log_row(event, created_at):
+    """Turn a validated upload event into a row for insert_log_rows (classified at ingest)"""
+    command, workflow_cat, detail_cat = classify_log_event(event['Action'], event['Detail'])
+    event_id = event.get('EventId')
+    return (event['Timestamp'], event['UserID'], event['Action'], event['Detail'],
+            event['DocumentName'], created_at, timestamp_to_epoch(event['Timestamp']),
+            command, workflow_cat, detail_cat, event_hash(event['UserID'], event_id) if event_id else None)
+
+# 辞書テーブルの id（行は消さないので id は変わらない。コミットされたものだけをプロセスで共有する）
+LOG_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+_dictionary_ids = {'users': {}, 'actions': {}, 'documents': {}, 'log_details': {}}
+
+def publish_dictionary_ids(conn):
+    """Share the ids looked up in conn's just-committed transaction with the whole process"""
+    pending, conn.pending_dictionary_ids = conn.pending_dictionary_ids, None
+    for table, ids in (pending or {}).items():
+        _dictionary_ids[table].update(ids)
+
+def _remember_dictionary_ids(conn, table, ids):
+    if conn.pending_dictionary_ids is None:
+        conn.pending_dictionary_ids = {name: {} for name in _dictionary_ids}
+    conn.pending_dictionary_ids[table].update(ids)
+
+def _cached_dictionary_id(conn, table, key):
+    log_id = _dictionary_ids[table].get(key)
+    if log_id is None and conn.pending_dictionary_ids:
+        log_id = conn.pending_dictionary_ids[table].get(key)
+    return log_id
+
+def resolve_name_ids(c, table, column, names, create=True):
+    """name -> id in a users/actions/documents dictionary, adding unseen names when create"""
+    conn = c.connection
+    ids, missing = {}, []
+    for name in set(names):
+        log_id = _cached_dictionary_id(conn, table, name)
+        if log_id is None:
+            missing.append(name)
+        else:
+            ids[name] = log_id
+
+    if missing:
+        if create:
+            c.executemany(f'INSERT OR IGNORE INTO {table} ({column}) VALUES (?)', [(name,) for name in missing])
+        found = {}
+        for i in range(0, len(missing), SQLITE_MAX_VARIABLES):
+            chunk = missing[i:i + SQLITE_MAX_VARIABLES]
+            c.execute(f'SELECT {column}, id FROM {table} WHERE {column} IN ({",".join("?" * len(chunk))})', chunk)
+            found.update(c.fetchall())
+        _remember_dictionary_ids(conn, table, found)
+        ids.update(found)
+    return ids
+
+def resolve_detail_ids(c, classified_details):
+    """(action_id, detail) -> log_details id for {(action_id, detail): (command, workflow, detail category)}
+
+    New pairs are stored with the given classification. Existing pairs keep theirs; they
+    only change through reclassify_logs, which also rebuilds the rollups.
+    """
+    conn = c.connection
+    ids, found = {}, {}
+    for key, classification in classified_details.items():
+        log_id = _cached_dictionary_id(conn, 'log_details', key)
+        if log_id is None:
+            row = c.execute('SELECT id FROM log_details WHERE action_id = ? AND detail IS ?', key).fetchone()
+            if row is None:
+                c.execute('''INSERT INTO log_details (action_id, detail, command, workflow_category, detail_category)
+                             VALUES (?, ?, ?, ?, ?)''', key + classification)
+                log_id = c.lastrowid
+            else:
+                log_id = row[0]
+            found[key] = log_id
+        ids[key] = log_id
+    if found:
+        _remember_dictionary_ids(conn, 'log_details', found)
+    return ids
+
+def encode_log_rows(c, rows):
+    """build_log_row rows -> log_events rows
+
+    (user_id, ts_epoch, detail_id, document_id, created_epoch, timestamp_text, event_hash)
+    """
+    user_ids = resolve_name_ids(c, 'users', 'username', (row[1] for row in rows), create=False)
+    unknown = {row[1] for row in rows} - user_ids.keys()
+    if unknown:
+        raise ValueError(f'Logs of unregistered users: {", ".join(sorted(map(str, unknown)))}')
+    action_ids = resolve_name_ids(c, 'actions', 'name', (row[2] for row in rows))
+    document_ids = resolve_name_ids(c, 'documents', 'name', (row[4] for row in rows if row[4] is not None))
+    detail_ids = resolve_detail_ids(c, {(action_ids[row[2]], row[3]): row[7:10] for row in rows})
+
+    created_epochs = {}
+    events = []
+    for timestamp, username, action, detail, document_name, created_at, ts_epoch, _, _, _, key in rows:
+        created_epoch = created_epochs.get(created_at)
+        if created_epoch is None:
+            created_epoch = created_epochs[created_at] = timestamp_to_epoch(created_at) or int(time.time())
+        # 'YYYY-MM-DD HH:MM:SS' は ts_epoch から復元できるので文字列は持たない
+        if ts_epoch is not None and time.strftime(LOG_TIMESTAMP_FORMAT, time.gmtime(ts_epoch)) == timestamp:
+            timestamp = None
+        events.append((user_ids[username], ts_epoch, detail_ids[(action_ids[action], detail)],
+                       document_ids.get(document_name), created_epoch, timestamp, key))
+    return events
+
+def find_duplicate_events(c, events):
+    """Positions of encoded events that are already stored, or repeated earlier in the same batch"""
+    duplicates = set()
+    first_seen = {}
+    hashes_by_user = {}
+    for position, event in enumerate(events):
+        if event[6] is None:
+            continue
+        key = (event[0], event[6])
+        if key in first_seen:
+            duplicates.add(position)
+            continue
+        first_seen[key] = position
+        hashes_by_user.setdefault(event[0], []).append(event[6])
+
+    for user_id, hashes in hashes_by_user.items():
+        for i in range(0, len(hashes), SQLITE_MAX_VARIABLES):
+            chunk = hashes[i:i + SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' * len(chunk))
+            c.execute(f'''SELECT event_hash FROM log_events WHERE user_id = ? AND event_hash IN ({placeholders})
+                          UNION ALL
+                          SELECT event_hash FROM archived_event_hashes
+                          WHERE user_id = ? AND event_hash IN ({placeholders})''',
+                      [user_id] + chunk + [user_id] + chunk)
+            duplicates.update(first_seen[(user_id, key)] for (key,) in c.fetchall())
+    return duplicates
+
+def insert_log_rows(c, rows, sessionize=True):
+    """Insert build_log_row rows and keep the derived tables in step
+
+    Rows whose event is already stored are skipped; returns their positions in rows.
+    Bulk loaders that write many out-of-order batches pass sessionize=False and call
+    sessionize_user once per touched user afterwards.
+    """
+    # 重複の判定から挿入までを書き込みロックの中で行う（並行する再送と競合しない）
+    if not c.connection.in_transaction:
+        c.execute('BEGIN IMMEDIATE')
+    events = encode_log_rows(c, rows)
+    duplicates = find_duplicate_events(c, events)
+    if duplicates:
+        METRICS.inc('rhinolog_duplicate_events_total', value=len(duplicates))
+        rows = [row for position, row in enumerate(rows) if position not in duplicates]
+        events = [event for position, event in enumerate(events) if position not in duplicates]
+        if not rows:
+            return duplicates
+
+    record_ingest_metrics(rows)
+    c.executemany('''INSERT OR IGNORE INTO log_events
+        (user_id, ts_epoch, detail_id, document_id, created_epoch, timestamp_text, event_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?)''', events)
+    update_rollups(c, rows)
+    if sessionize:
+        update_action_groups(c, rows)
+    update_watermarks(c, rows)
+    return duplicates
+
+def record_ingest_metrics(rows):
+    """Count ingested events and how many of their commands could be classified"""
+    METRICS.inc('rhinolog_ingested_events_total', value=len(rows))
+    commands = [row for row in rows if row[2] == 'Command']
+    classified = sum(1 for row in commands if row[8] is not None)
+    METRICS.inc('rhinolog_ingested_commands_total', (('result', 'classified'),), classified)
+    METRICS.inc('rhinolog_ingested_commands_total', (('result', 'unclassified'),), len(commands) - classified)
+
+# ユーザー別の集計テーブル（取り込み時に加算、rebuild_rollups で生ログから再計算）
+#
+# user_category_stats: ユーザー × 日 × workflow_category × detail_category のコマンド数
+#   （/api/stats/workflow と同じく action = 'Command' で分類できたものだけ、未分類側は ''）
+# user_daily_stats: ユーザー × 日 の総イベント数・コマンド数・最初/最後の時刻
+# user_command_stats: ユーザー × コマンド（Command の Detail）の回数（/api/stats の上位コマンド）
+def update_rollups(c, rows):
+    """Add freshly inserted log rows (insert_log_rows layout) to the rollup tables"""
+    category_counts = Counter()
+    command_counts = Counter()
+    daily = {}
+    for timestamp, username, action, detail, _, _, _, _, workflow_cat, detail_cat, _ in rows:
+        day = str(timestamp)[:10]
+        stats = daily.get((username, day))
+        if stats is None:
+            stats = daily[(username, day)] = [0, 0, timestamp, timestamp]
+        stats[0] += 1
+        if action == 'Command':
+            stats[1] += 1
+            command_counts[(username, detail or '')] += 1
+            if workflow_cat or detail_cat:
+                category_counts[(username, day, workflow_cat or '', detail_cat or '')] += 1
+        stats[2] = min(stats[2], timestamp)
+        stats[3] = max(stats[3], timestamp)
+
+    c.executemany('''INSERT INTO user_category_stats
+        (username, day, workflow_category, detail_category, event_count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(username, day, workflow_category, detail_category)
+        DO UPDATE SET event_count = event_count + excluded.event_count''',
+        [key + (count,) for key, count in category_counts.items()])
+
+    c.executemany('''INSERT INTO user_daily_stats
+        (username, day, total_events, command_events, first_timestamp, last_timestamp)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(username, day) DO UPDATE SET
+            total_events = total_events + excluded.total_events,
+            command_events = command_events + excluded.command_events,
+            first_timestamp = MIN(first_timestamp, excluded.first_timestamp),
+            last_timestamp = MAX(last_timestamp, excluded.last_timestamp)''',
+        [key + tuple(stats) for key, stats in daily.items()])
+
+    c.executemany('''INSERT INTO user_command_stats (username, detail, event_count) VALUES (?, ?, ?)
+        ON CONFLICT(username, detail) DO UPDATE SET event_count = event_count + excluded.event_count''',
+        [key + (count,) for key, count in command_counts.items()])
+
+ROLLUP_CATEGORY_SELECT = '''SELECT username, substr(timestamp, 1, 10),
+        COALESCE(workflow_category, ''), COALESCE(detail_category, ''), COUNT(*)
+    FROM {source}
+    WHERE action = 'Command' AND (workflow_category IS NOT NULL OR detail_category IS NOT NULL)
+    GROUP BY 1, 2, 3, 4'''
+ROLLUP_DAILY_SELECT = '''SELECT username, substr(timestamp, 1, 10), COUNT(*),
+        SUM(action = 'Command'), MIN(timestamp), MAX(timestamp)
+    FROM {source}
+    GROUP BY 1, 2'''
+ROLLUP_COMMAND_SELECT = '''SELECT username, COALESCE(detail, ''), COUNT(*)
+    FROM {source}
+    WHERE action = 'Command'
+    GROUP BY 1, 2'''
+ROLLUP_SOURCE_COLUMNS = 'username, timestamp, action, detail, workflow_category, detail_category'
+
+def rebuild_rollups(conn):
+    """Recompute the rollup tables from raw logs (live and archived) in one transaction
+
+    Returns how many rollup rows differed from the recomputed values, which doubles as a
+    consistency check for the incremental updates.
+    """
+    c = conn.cursor()
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS rebuilt_category_stats AS SELECT * FROM user_category_stats WHERE 0')
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS rebuilt_daily_stats AS SELECT * FROM user_daily_stats WHERE 0')
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS rebuilt_command_stats AS SELECT * FROM user_command_stats WHERE 0')
+    c.execute('DELETE FROM rebuilt_category_stats')
+    c.execute('DELETE FROM rebuilt_daily_stats')
+    c.execute('DELETE FROM rebuilt_command_stats')
+
+    # アーカイブ済みの月は一時テーブルに展開して生ログと一緒に集計する
+    source = 'logs'
+    archived = iter_archived_rows(conn, ROLLUP_SOURCE_COLUMNS)
+    if archived is not None:
+        c.execute(f'CREATE TEMP TABLE IF NOT EXISTS archived_rollup_source AS '
+                  f'SELECT {ROLLUP_SOURCE_COLUMNS} FROM logs WHERE 0')
+        c.execute('DELETE FROM archived_rollup_source')
+        c.executemany('INSERT INTO archived_rollup_source VALUES (?, ?, ?, ?, ?, ?)', archived)
+        source = (f'(SELECT {ROLLUP_SOURCE_COLUMNS} FROM logs '
+                  f'UNION ALL SELECT {ROLLUP_SOURCE_COLUMNS} FROM archived_rollup_source)')
+
+    c.execute(f'INSERT INTO rebuilt_category_stats {ROLLUP_CATEGORY_SELECT.format(source=source)}')
+    c.execute(f'INSERT INTO rebuilt_daily_stats {ROLLUP_DAILY_SELECT.format(source=source)}')
+    c.execute(f'INSERT INTO rebuilt_command_stats {ROLLUP_COMMAND_SELECT.format(source=source)}')
+
+    # 不一致 = 値が違う/欠けている行 + 生ログに存在しない余分な行
+    mismatched = 0
+    for table, rebuilt, key in (('user_category_stats', 'rebuilt_category_stats',
+                                 'username, day, workflow_category, detail_category'),
+                                ('user_daily_stats', 'rebuilt_daily_stats', 'username, day'),
+                                ('user_command_stats', 'rebuilt_command_stats', 'username, detail')):
+        c.execute(f'''SELECT (SELECT COUNT(*) FROM (SELECT * FROM {rebuilt} EXCEPT SELECT * FROM {table}))
+                          + (SELECT COUNT(*) FROM (SELECT {key} FROM {table} EXCEPT SELECT {key} FROM {rebuilt}))''')
+        mismatched += c.fetchone()[0]
+        c.execute(f'DELETE FROM {table}')
+        c.execute(f'INSERT INTO {table} SELECT * FROM {rebuilt}')
+
+    c.execute('SELECT COUNT(*) FROM user_category_stats')
+    category_rows = c.fetchone()[0]
+    c.execute('SELECT COUNT(*) FROM user_daily_stats')
+    daily_rows = c.fetchone()[0]
+    c.execute('SELECT COUNT(*) FROM user_command_stats')
+    command_rows = c.fetchone()[0]
+    conn.commit()
+
+    bump_data_generation(conn)
+    return {'category_rows': category_rows, 'daily_rows': daily_rows, 'command_rows': command_rows,
+            'mismatched_rows': mismatched}
+
+# 古いログのアーカイブ（締まった月を ユーザー × 月 の圧縮ファイルへ移す）
+#
+# ARCHIVE_AFTER_MONTHS か月より前の月のログを LOG_BASE_DIR/archive/<YYYY-MM>/<username>.json.gz
+# （列ごとの配列を gzip した JSON）へ書き出して logs から削除する。ファイルの目録は
+# log_archives で、読み出し側は範囲が重なるファイルだけを月単位で開いて生ログとマージする。
+# 集計テーブル・アクショングループ・ウォーターマークはアーカイブ後もそのまま使える。
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('RHINOLOG_ARCHIVE_AFTER_MONTHS', '3'))
+ARCHIVE_COLUMNS = ('id', 'timestamp', 'username', 'action', 'detail', 'document_name',
+                   'created_at', 'ts_epoch', 'command', 'workflow_category', 'detail_category')
+ARCHIVE_COLUMN_INDEX = {name: i for i, name in enumerate(ARCHIVE_COLUMNS)}
+ARCHIVE_READ_CACHE_SIZE = 32  # 展開済みファイルをプロセスごとに保持する数
+_archive_lock = threading.Lock()
+
+def get_archive_dir():
+    return os.path.join(LOG_BASE_DIR, 'archive')
+
+def archive_relative_path(username, month):
+    """Catalog path of a user-month file (relative to the archive directory)"""
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', username)
+    if safe_name != username:
+        safe_name += '-' + hashlib.sha1(username.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(month, safe_name + '.json.gz')
+
+def write_archive_file(relative_path, rows):
+    """Atomically write rows (ARCHIVE_COLUMNS order) as gzip-compressed column arrays; returns the file size"""
+    path = os.path.join(get_archive_dir(), relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    payload = {'columns': ARCHIVE_COLUMNS,
+               'data': {name: [row[i] for row in rows] for i, name in enumerate(ARCHIVE_COLUMNS)}}
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=9) as f:
+        json.dump(payload, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+@lru_cache(maxsize=ARCHIVE_READ_CACHE_SIZE)
+def _load_archive_file(path, mtime_ns, size):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        data = json.load(f)['data']
+    row_count = len(data['id'])
+    # 古いファイルにない列は None として読む
+    return tuple(zip(*(data.get(name) or [None] * row_count for name in ARCHIVE_COLUMNS)))
+
+def read_archive_file(relative_path):
+    """Rows of one archive file in ARCHIVE_COLUMNS order (decoded files are cached until rewritten)"""
+    path = os.path.join(get_archive_dir(), relative_path)
+    stat = os.stat(path)
+    return _load_archive_file(path, stat.st_mtime_ns, stat.st_size)
+
+def column_names(columns):
+    return tuple(name.strip() for name in columns.split(',')) if isinstance(columns, str) else tuple(columns)
+
+def iter_archived_rows(conn, columns, username=None, by_epoch=False, descending=False,
+                       start=None, end=None, before=None):
+    """
+    Archived rows shaped like `SELECT columns`, ordered by (timestamp, id), or by
+    (ts_epoch, id) when by_epoch. start/end bound the order column (inclusive) and
+    before is a keyset cursor (value, id). Only files whose range overlaps are opened,
+    one month at a time. Returns None when no archive file overlaps.
+    """
+    if not _table_columns(conn, 'log_archives'):
+        return None  # マイグレーション 7 より前
+
+    low, high = ('min_ts_epoch', 'max_ts_epoch') if by_epoch else ('min_timestamp', 'max_timestamp')
+    conditions, params = ['1=1'], []
+    if username:
+        conditions.append('username = ?')
+        params.append(username)
+    if start is not None:
+        conditions.append(f'{high} >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append(f'{low} <= ?')
+        params.append(end)
+    if before is not None:
+        conditions.append(f'{low} <= ?')
+        params.append(before[0])
+
+    months = OrderedDict()
+    for month, path in conn.execute(f'''SELECT month, path FROM log_archives WHERE {' AND '.join(conditions)}
+                                        ORDER BY month {'DESC' if descending else 'ASC'}''', params):
+        months.setdefault(month, []).append(path)
+    if not months:
+        return None
+
+    order_index = ARCHIVE_COLUMN_INDEX['ts_epoch' if by_epoch else 'timestamp']
+    id_index = ARCHIVE_COLUMN_INDEX['id']
+    sort_key = itemgetter(order_index, id_index)
+    project = itemgetter(*(ARCHIVE_COLUMN_INDEX[name] for name in column_names(columns)))
+    before = tuple(before) if before is not None else None
+
+    def generate():
+        for paths in months.values():
+            rows = []
+            for path in paths:
+                for row in read_archive_file(path):
+                    value = row[order_index]
+                    if (value is None or (start is not None and value < start) or (end is not None and value > end)
+                            or (before is not None and (value, row[id_index]) >= before)):
+                        continue
+                    rows.append(row)
+            rows.sort(key=sort_key, reverse=descending)
+            for row in rows:
+                yield project(row)
+
+    return generate()
+
+def merge_archived_rows(conn, live_rows, columns, username=None, by_epoch=False, descending=False,
+                        start=None, end=None, before=None):
+    """Merge archived rows into an ordered live query result (see iter_archived_rows for the filters)
+
+    live_rows is returned as is when no archive file overlaps, so queries that stay within
+    the live months cost one catalog lookup.
+    """
+    archived = iter_archived_rows(conn, columns, username, by_epoch, descending, start, end, before)
+    if archived is None:
+        return live_rows
+    names = column_names(columns)
+    order_index, id_index = names.index('ts_epoch' if by_epoch else 'timestamp'), names.index('id')
+
+    def sort_key(row):
+        # 時刻を解釈できなかった生ログの行（ts_epoch が NULL）は SQLite と同じく最も古い扱い
+        value = row[order_index]
+        return (float('-inf') if value is None else value), row[id_index]
+
+    return heapq.merge(live_rows, archived, key=sort_key, reverse=descending)
+
+def _next_month(month):
+    year, month_number = int(month[:4]), int(month[5:7])
+    return f'{year + month_number // 12:04d}-{month_number % 12 + 1:02d}'
+
+def archive_cutoff_month(keep_months, today=None):
+    """First month that stays in logs when the last keep_months months (plus this one) are kept"""
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1 - keep_months
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+def _month_start_epoch(month):
+    return calendar.timegm((int(month[:4]), int(month[5:7]), 1, 0, 0, 0))
+
+def archive_user_month(conn, username, month):
+    """
+    Move one user-month out of logs into its archive file (merged with an existing file
+    when late logs arrived after the month was archived) and commit. The file is replaced
+    before the rows are deleted, so an interrupted run only leaves rows in both places
+    until the next run merges them again.
+    """
+    # 月の範囲は ts_epoch で絞る（log_events(user_id, ts_epoch) のインデックスを使う）
+    month_range = (username, _month_start_epoch(month), _month_start_epoch(_next_month(month)))
+    rows = conn.execute(f'''SELECT {', '.join(ARCHIVE_COLUMNS)} FROM logs
+                            WHERE username = ? AND ts_epoch >= ? AND ts_epoch < ?
+                            ORDER BY ts_epoch, id''', month_range).fetchall()
+    if not rows:
+        return 0
+    max_log_id = max(row[0] for row in rows)
+
+    existing = conn.execute('SELECT path FROM log_archives WHERE username = ? AND month = ?',
+                            (username, month)).fetchone()
+    relative_path = existing[0] if existing else archive_relative_path(username, month)
+    if existing:
+        merged = {row[0]: row for row in read_archive_file(relative_path)}
+        merged.update((row[0], row) for row in rows)
+        rows = sorted(merged.values(), key=itemgetter(1, 0))
+
+    epochs = [row[7] for row in rows if row[7] is not None]
+    command_counts = Counter(row[4] for row in rows if row[3] == 'Command')
+    size = write_archive_file(relative_path, rows)
+
+    conn.execute('''INSERT INTO log_archives
+        (username, month, path, row_count, min_timestamp, max_timestamp, min_ts_epoch, max_ts_epoch,
+         max_log_id, command_counts, bytes, archived_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(username, month) DO UPDATE SET
+            row_count = excluded.row_count, min_timestamp = excluded.min_timestamp,
+            max_timestamp = excluded.max_timestamp, min_ts_epoch = excluded.min_ts_epoch,
+            max_ts_epoch = excluded.max_ts_epoch, max_log_id = MAX(max_log_id, excluded.max_log_id),
+            command_counts = excluded.command_counts, bytes = excluded.bytes,
+            archived_at = excluded.archived_at''',
+        (username, month, relative_path, len(rows), rows[0][1], rows[-1][1],
+         min(epochs, default=None), max(epochs, default=None), max_log_id,
+         json.dumps(sorted(command_counts.items(), key=lambda item: (item[0] is None, item[0] or '')),
+                    ensure_ascii=False),
+         size, datetime.now().isoformat()))
+    # 読み出し後に届いた行（id が大きい）は残し、次回のアーカイブで追記する
+    archived_ids = '''SELECT id FROM logs
+                      WHERE username = ? AND ts_epoch >= ? AND ts_epoch < ? AND id <= ?'''
+    params = month_range + (max_log_id,)
+    conn.execute(f'''INSERT OR IGNORE INTO archived_event_hashes (user_id, event_hash)
+                     SELECT user_id, event_hash FROM log_events
+                     WHERE id IN ({archived_ids}) AND event_hash IS NOT NULL''', params)
+    deleted = conn.execute(f'DELETE FROM log_events WHERE id IN ({archived_ids})', params).rowcount
+    conn.commit()
+    return deleted
+
+def archive_closed_months(conn, keep_months=ARCHIVE_AFTER_MONTHS, today=None):
+    """Archive every user-month older than the kept months; one committed transaction per user-month"""
+    cutoff = archive_cutoff_month(keep_months, today)
+    with _archive_lock:
+        # 時刻を解釈できない（ts_epoch が NULL の）行は月が決まらないので logs に残す
+        user_months = conn.execute('''SELECT username, strftime('%Y-%m', ts_epoch, 'unixepoch') FROM logs
+                                      WHERE ts_epoch < ? GROUP BY 1, 2 ORDER BY 2, 1''',
+                                   (_month_start_epoch(cutoff),)).fetchall()
+        archived_rows = 0
+        for username, month in user_months:
+            archived_rows += archive_user_month(conn, username, month)
+
+    db_logger.info('Archived %d log rows in %d user-months before %s', archived_rows, len(user_months), cutoff)
+    return {'cutoff_month': cutoff, 'archived_user_months': len(user_months),
+            'archived_rows': archived_rows, 'archive': archive_summary(conn)}
+
+def reclassify_archives(conn):
+    """Rewrite the stored classification columns of every archive file with the current rules"""
+    if not _table_columns(conn, 'log_archives'):
+        return 0
+    processed = 0
+    with _archive_lock:
+        for username, month, relative_path in conn.execute(
+                'SELECT username, month, path FROM log_archives').fetchall():
+            rows = [row[:8] + classify_log_event(row[3], row[4]) for row in read_archive_file(relative_path)]
+            size = write_archive_file(relative_path, rows)
+            conn.execute('UPDATE log_archives SET bytes = ? WHERE username = ? AND month = ?',
+                         (size, username, month))
+            conn.commit()
+            processed += len(rows)
+    return processed
+
+def archive_summary(conn):
+    if not _table_columns(conn, 'log_archives'):
+        return {'files': 0, 'rows': 0, 'bytes': 0, 'oldest_month': None, 'newest_month': None}
+    files, rows, size, oldest, newest = conn.execute('''SELECT COUNT(*), COALESCE(SUM(row_count), 0),
+        COALESCE(SUM(bytes), 0), MIN(month), MAX(month) FROM log_archives''').fetchone()
+    return {'files': files, 'rows': rows, 'bytes': size, 'oldest_month': oldest, 'newest_month': newest}
+
+def parse_log_batch(req):
+    """Parse a batch upload body: a JSON array, {"events": [...]} or NDJSON (one event per line)"""
+    content_type = (req.mimetype or '').lower()
+
+    if content_type in ('application/x-ndjson', 'application/ndjson', 'application/jsonl'):
+        events = []
+        for line_no, line in enumerate(req.get_data(as_text=True).splitlines(), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError as e:
+                # 壊れた行も位置を保ったまま返して、クライアント側で個別に拒否を判断できるようにする
+                events.append(ValueError(f'Invalid JSON on line {line_no}: {e}'))
+        return events
+
+    data = req.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('events')
+    if not isinstance(data, list):
+        raise ValueError('Body must be a JSON array of events, {"events": [...]} or NDJSON')
+    return data
+
+# 非同期取り込み（RHINOLOG_INGEST_MODE=async）
+#
+# リクエストは検証・分類までを行ってキューに積み、202 を返す。書き込みスレッドが
+# INGEST_GROUP_COMMIT_EVENTS 件たまるか INGEST_GROUP_COMMIT_MS 経過するごとに
+# まとめて1トランザクションでコミットする。キューが満杯なら 429 + Retry-After。
+#
+# 202 を返した行は捨てない。DB のロック待ち（SQLITE_BUSY / SQLITE_LOCKED）だけはバックオフしながら
+# 再試行し（その間も行はキューの容量を占めるので、詰まれば 429 で送信側を待たせる）、
+# INGEST_RETRY_ATTEMPTS 回でも書けなければ行を LOG_BASE_DIR/ingest_spool/ に NDJSON で書き出す
+# （--replay-ingest-spool で取り込み直す）。それ以外のエラーは1リクエスト分ずつコミットし直して、
+# 失敗したリクエストの行だけをスプールに書き出す。
+INGEST_ASYNC = os.environ.get('RHINOLOG_INGEST_MODE', 'sync') == 'async'
+INGEST_QUEUE_EVENTS = int(os.environ.get('RHINOLOG_INGEST_QUEUE_EVENTS', '20000'))
+INGEST_GROUP_COMMIT_EVENTS = int(os.environ.get('RHINOLOG_INGEST_GROUP_COMMIT_EVENTS', '1000'))
+INGEST_GROUP_COMMIT_MS = int(os.environ.get('RHINOLOG_INGEST_GROUP_COMMIT_MS', '50'))
+INGEST_RETRY_AFTER_SECONDS = 1
+INGEST_RETRY_INITIAL_SECONDS = 0.1
+INGEST_RETRY_MAX_SECONDS = 5.0
+INGEST_RETRY_ATTEMPTS = 12  # 約40秒
+INGEST_STOP_ATTEMPTS = 3  # 停止中は再試行を打ち切ってスプールに書き出す
+ingest_logger = logging.getLogger('rhinolog.ingest')
+
+def is_busy_error(error):
+    """Whether a SQLite error only means the database was busy or locked (worth retrying)"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    name = getattr(error, 'sqlite_errorname', None)  # Python 3.11+
+    if name:
+        return name.startswith(('SQLITE_BUSY', 'SQLITE_LOCKED'))
+    return str(error) in ('database is locked', 'database table is locked')
+
+def get_ingest_spool_dir():
+    return os.path.join(LOG_BASE_DIR, 'ingest_spool')
+
+class IngestWriter:
+    """Bounded event queue drained by one writer thread with group commits"""
+
+    def __init__(self, capacity, group_events, group_ms):
+        self.capacity = capacity
+        self.group_events = group_events
+        self.group_seconds = group_ms / 1000
+        self._batches = deque()  # 1リクエスト分の行はまとめて積む（途中で分割しない）
+        self._pending = 0  # キューの行とコミット中の行（コミットかスプールが済むまで容量を占める）
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._spool_sequence = 0
+        self.stats = {
+            'commits': 0,
+            'events_committed': 0,
+            'failed_events': 0,
+            'duplicate_events': 0,
+            'rejected_full': 0,
+            'commit_retries': 0,
+            'isolated_commits': 0,
+            'spooled_events': 0,
+            'last_batch_size': 0,
+            'max_batch_size': 0,
+            'last_commit_ms': 0.0,
+            'max_commit_ms': 0.0,
+            'total_commit_ms': 0.0
+        }
+        self._thread = threading.Thread(target=self._run, name='rhinolog-ingest-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, rows):
+        """Queue one request's rows; False when they do not fit (caller answers 429)"""
+        with self._condition:
+            if self._pending + len(rows) > self.capacity:
+                self.stats['rejected_full'] += 1
+                return False
+            self._batches.append(rows)
+            self._pending += len(rows)
+            if self._pending >= self.group_events:
+                self._condition.notify()
+            return True
+
+    def _take_group(self):
+        """Next group of whole request batches (they stay counted in the queue until written)"""
+        with self._condition:
+            deadline = None
+            while not self._stopping:
+                if self._pending >= self.group_events:
+                    break
+                if self._pending:
+                    if deadline is None:
+                        deadline = time.monotonic() + self.group_seconds
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait()
+
+            batches = []
+            size = 0
+            while self._batches and (not batches or size + len(self._batches[0]) <= self.group_events):
+                batch = self._batches.popleft()
+                batches.append(batch)
+                size += len(batch)
+            return batches
+
+    def _write(self, rows):
+        """Insert rows in one transaction, retrying busy/locked errors with capped backoff
+
+        Returns the number of duplicates. Other errors are raised at once; busy/locked ones
+        after INGEST_RETRY_ATTEMPTS tries (INGEST_STOP_ATTEMPTS during shutdown).
+        """
+        delay = INGEST_RETRY_INITIAL_SECONDS
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                with db_connection() as conn:
+                    duplicates = insert_log_rows(conn.cursor(), rows)
+                    conn.commit()
+                return len(duplicates)
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e):
+                    raise
+                if attempt >= (INGEST_STOP_ATTEMPTS if self._stopping else INGEST_RETRY_ATTEMPTS):
+                    raise
+                self.stats['commit_retries'] += 1
+                ingest_logger.warning('Commit of %d events failed (attempt %d), retrying in %.1fs',
+                                      len(rows), attempt, delay, exc_info=True)
+                with self._condition:
+                    if not self._stopping:
+                        self._condition.wait(delay)
+                delay = min(delay * 2, INGEST_RETRY_MAX_SECONDS)
+
+    def _spool(self, rows):
+        """Write rows that cannot be committed to an NDJSON file for --replay-ingest-spool"""
+        self._spool_sequence += 1
+        spool_dir = get_ingest_spool_dir()
+        name = f'{datetime.now().strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{self._spool_sequence}.ndjson'
+        try:
+            os.makedirs(spool_dir, exist_ok=True)
+            tmp_path = os.path.join(spool_dir, name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            os.replace(tmp_path, os.path.join(spool_dir, name))
+        except OSError:
+            self.stats['failed_events'] += len(rows)
+            ingest_logger.exception('Could not spool %d events that failed to commit', len(rows))
+            return
+        self.stats['spooled_events'] += len(rows)
+        ingest_logger.error('Spooled %d events that failed to commit to %s', len(rows), name)
+
+    def _commit(self, batches):
+        rows = [row for batch in batches for row in batch]
+        started = time.perf_counter()
+        try:
+            duplicates = self._write(rows)
+        except Exception as e:
+            if is_busy_error(e):
+                # 再試行しても DB のロックが解けない: 行はすべてスプールに残す
+                ingest_logger.exception('Group commit of %d events gave up waiting for the database', len(rows))
+                self._spool(rows)
+            else:
+                ingest_logger.exception('Group commit of %d events failed, committing its %d requests separately',
+                                        len(rows), len(batches))
+                self._commit_separately(batches)
+        else:
+            self._record_commit(len(rows), duplicates, started)
+        finally:
+            with self._condition:
+                self._pending -= len(rows)
+
+    def _commit_separately(self, batches):
+        """One transaction per request batch, so a batch that cannot be stored does not drop the others"""
+        for batch in batches:
+            started = time.perf_counter()
+            self.stats['isolated_commits'] += 1
+            try:
+                duplicates = self._write(batch)
+            except Exception:
+                ingest_logger.exception('Commit of a %d-event request failed', len(batch))
+                self._spool(batch)
+            else:
+                self._record_commit(len(batch), duplicates, started)
+
+    def _record_commit(self, size, duplicates, started):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats['commits'] += 1
+        self.stats['events_committed'] += size - duplicates
+        self.stats['duplicate_events'] += duplicates
+        self.stats['last_batch_size'] = size
+        self.stats['max_batch_size'] = max(self.stats['max_batch_size'], size)
+        self.stats['last_commit_ms'] = round(elapsed_ms, 2)
+        self.stats['max_commit_ms'] = round(max(self.stats['max_commit_ms'], elapsed_ms), 2)
+        self.stats['total_commit_ms'] += elapsed_ms
+
+    def _run(self):
+        while True:
+            batches = self._take_group()
+            if batches:
+                self._commit(batches)
+            elif self._stopping:
+                return
+
+    def stop(self):
+        """Commit whatever is still queued and stop the writer thread"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+
+    def health(self):
+        with self._condition:
+            depth = self._pending
+        commits = self.stats['commits']
+        return {
+            'mode': 'async',
+            'queue_depth': depth,
+            'queue_capacity': self.capacity,
+            'group_commit_events': self.group_events,
+            'group_commit_ms': int(self.group_seconds * 1000),
+            'commits': commits,
+            'events_committed': self.stats['events_committed'],
+            'failed_events': self.stats['failed_events'],
+            'commit_retries': self.stats['commit_retries'],
+            'isolated_commits': self.stats['isolated_commits'],
+            'spooled_events': self.stats['spooled_events'],
+            'duplicate_events': self.stats['duplicate_events'],
+            'rejected_full': self.stats['rejected_full'],
+            'last_batch_size': self.stats['last_batch_size'],
+            'max_batch_size': self.stats['max_batch_size'],
+            'avg_batch_size': round(self.stats['events_committed'] / commits, 1) if commits else 0,
+            'last_commit_ms': self.stats['last_commit_ms'],
+            'max_commit_ms': self.stats['max_commit_ms'],
+            'avg_commit_ms': round(self.stats['total_commit_ms'] / commits, 2) if commits else 0
+        }
+
+_ingest_writers = {}
+_ingest_writers_lock = threading.Lock()
+
+def get_ingest_writer():
+    """Writer thread of this worker process (started on first use, after gunicorn forks)"""
+    pid = os.getpid()
+    writer = _ingest_writers.get(pid)
+    if writer is None:
+        with _ingest_writers_lock:
+            writer = _ingest_writers.get(pid)
+            if writer is None:
+                writer = IngestWriter(INGEST_QUEUE_EVENTS, INGEST_GROUP_COMMIT_EVENTS, INGEST_GROUP_COMMIT_MS)
+                _ingest_writers[pid] = writer
+                atexit.register(writer.stop)
+    return writer
+
+def ingest_health():
+    if not INGEST_ASYNC:
+        return {'mode': 'sync'}
+    return get_ingest_writer().health()
+
+def replay_ingest_spool(conn):
+    """Insert the rows of every ingest spool file (classified again) and delete the files that went in
+
+    Events with an EventId that did get stored before are skipped as duplicates. A file that
+    still fails is kept and reported.
+    """
+    spool_dir = get_ingest_spool_dir()
+    names = sorted(name for name in os.listdir(spool_dir) if name.endswith('.ndjson')) \
+        if os.path.isdir(spool_dir) else []
+    result = {'files': 0, 'events': 0, 'duplicates': 0, 'failed_files': []}
+    for name in names:
+        path = os.path.join(spool_dir, name)
+        try:
+            with open(path, encoding='utf-8') as f:
+                rows = [tuple(json.loads(line)) for line in f if line.strip()]
+            rows = [row[:7] + classify_log_event(row[2], row[3]) + row[10:] for row in rows]
+            duplicates = insert_log_rows(conn.cursor(), rows)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            ingest_logger.exception('Could not replay ingest spool file %s', name)
+            result['failed_files'].append({'file': name, 'error': str(e)})
+            continue
+        os.remove(path)
+        result['files'] += 1
+        result['events'] += len(rows) - len(duplicates)
+        result['duplicates'] += len(duplicates)
+    return result
+
+def store_log_rows(conn, rows):
+    """Write rows in this request (sync mode) or queue them for the writer (async mode)
+
+    Returns the positions of rows skipped as already stored (always empty in async mode,
+    where the writer drops them), or None when the async queue is full.
+    """
+    if INGEST_ASYNC:
+        return set() if get_ingest_writer().submit(rows) else None
+    duplicates = insert_log_rows(conn.cursor(), rows)
+    conn.commit()
+    return duplicates
+
+def ingest_queue_full_response():
+    response = jsonify({'error': 'Ingest queue is full, retry later'})
+    response.headers['Retry-After'] = str(INGEST_RETRY_AFTER_SECONDS)
+    return response, 429
+
 @app.route('/api/log/upload', methods=['POST'])
 def upload_log():
     try:
         data = request.json
-        required = ['Timestamp', 'UserID', 'Action', 'Detail', 'DocumentName']
 
-        for field in required:
-            if field not in data:
-                return jsonify({'error': f'Missing field: {field}'}), 400
+        error = validate_log_event(data)
+        if error:
+            return jsonify({'error': error}), 400
 
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
 
         # ユーザーが登録されているか確認
         c.execute('SELECT username FROM users WHERE username = ?', (data['UserID'],))
         if not c.fetchone():
-            conn.close()
             return jsonify({'error': 'User not registered'}), 403
 
-        # ログ保存
-        c.execute('''INSERT INTO logs
-            (timestamp, username, action, detail, document_name, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)''',
-            (data['Timestamp'], data['UserID'], data['Action'], data['Detail'],
-             data['DocumentName'], datetime.now().isoformat()))
+        # ログ保存（非同期モードではキューに積むだけ）
+        duplicates = store_log_rows(conn, [build_log_row(data, datetime.now().isoformat())])
+        if duplicates is None:
+            return ingest_queue_full_response()
 
-        conn.commit()
-        conn.close()
+        if INGEST_ASYNC:
+            return jsonify({'status': 'queued'}), 202
+        return jsonify({'status': 'duplicate' if duplicates else 'success'}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# ログ一括アップロード（Rhinoプラグインのバッチ送信）
+@app.route('/api/log/upload/batch', methods=['POST'])
+def upload_log_batch():
+    """Insert many log events in a single transaction and report per-item status"""
+    try:
+        try:
+            events = parse_log_batch(request)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if len(events) > MAX_BATCH_EVENTS:
+            return jsonify({'error': f'Too many events in one batch (max {MAX_BATCH_EVENTS})'}), 413
+
+        # 1パス目: 形式チェック
+        results = []
+        valid = []
+        for index, event in enumerate(events):
+            error = str(event) if isinstance(event, ValueError) else validate_log_event(event)
+            if error:
+                results.append({'index': index, 'status': 'rejected', 'error': error})
+            else:
+                results.append({'index': index, 'status': 'accepted'})
+                valid.append((index, event))
+
+        conn = get_db()
+        c = conn.cursor()
+
+        # 登録済みユーザーをまとめて1回のクエリで確認
+        registered = fetch_registered_usernames(c, [event['UserID'] for _, event in valid])
 
-        return jsonify({'status': 'success'}), 200
+        stored = []
+        for index, event in valid:
+            if event['UserID'] not in registered:
+                results[index] = {'index': index, 'status': 'rejected', 'error': 'User not registered'}
+                continue
+            stored.append((index, event))
+        created_at = datetime.now().isoformat()
+        rows = [build_log_row(event, created_at) for _, event in stored]
+
+        # 1トランザクションでまとめて保存（非同期モードではまとめてキューに積む）
+        duplicates = set()
+        if rows:
+            duplicates = store_log_rows(conn, rows)
+            if duplicates is None:
+                return ingest_queue_full_response()
+
+        # 非同期モードでは重複の判定も保存も書き込みスレッドが行うので、キューに積んだ行は queued
+        if INGEST_ASYNC:
+            for index, _ in stored:
+                results[index] = {'index': index, 'status': 'queued'}
+            return jsonify({
+                'status': 'queued',
+                'queued': len(rows),
+                'rejected': len(results) - len(rows),
+                'results': results
+            }), 202
+
+        # 保存済みのイベント（再送）は duplicate。クライアントは送信済みとして扱ってよい
+        for position in duplicates:
+            index = stored[position][0]
+            results[index] = {'index': index, 'status': 'duplicate'}
+
+        return jsonify({
+            'status': 'success',
+            'accepted': len(rows) - len(duplicates),
+            'duplicates': len(duplicates),
+            'rejected': len(results) - len(rows),
+            'results': results
+        }), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # ユーザー一覧取得（可視化アプリ用）
+#
+# 絞り込み: group（learning_group）, level（user_level、カンマ区切りで複数可）,
+#           from / to（YYYY-MM-DD、この期間に操作したユーザーのみ。last_active / event_count もこの期間で集計）
+# 並び替え: sort=<field>（降順は -<field>）、ページング: limit / offset（総件数は X-Total-Count ヘッダー）
+# 項目選択: fields=username,full_name,...（username は常に含む）
+USER_LIST_COLUMNS = {
+    'username': 'u.username',
+    'full_name': 'u.full_name',
+    'email': 'u.email',
+    'organization': 'u.organization',
+    'start_date': 'u.start_date',
+    'end_date': 'u.end_date',
+    'user_level': 'u.user_level',
+    'learning_group': 'u.learning_group',
+    'rhino_experience': 'u.rhino_experience',
+    'grasshopper_experience': 'u.grasshopper_experience',
+    'technical_score': 'u.technical_score',
+    'self_learning_score': 'u.self_learning_score',
+    'cad_tools': 'u.cad_tools',
+    'modeling_tools': 'u.modeling_tools',
+    'programming_languages': 'u.programming_languages',
+    'cad_experience_score': 'u.cad_experience_score',
+    'last_active': 'a.last_active',
+    'event_count': 'COALESCE(a.event_count, 0)'
+}
+USERS_MAX_LIMIT = 1000
+
+def build_users_query(args):
+    """Build the /api/users query from request args; raises ValueError on bad parameters"""
+    fields = list(USER_LIST_COLUMNS)
+    if args.get('fields'):
+        requested = [f.strip() for f in args['fields'].split(',') if f.strip()]
+        unknown = [f for f in requested if f not in USER_LIST_COLUMNS]
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+        fields = ['username'] + [f for f in requested if f != 'username']
+
+    activity_where = []
+    activity_params = []
+    for param, op in (('from', '>='), ('to', '<=')):
+        day = args.get(param)
+        if day:
+            try:
+                datetime.strptime(day, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f'{param} must be YYYY-MM-DD')
+            activity_where.append(f'day {op} ?')
+            activity_params.append(day)
+
+    where = []
+    params = []
+    if activity_where:
+        where.append('a.username IS NOT NULL')
+    if args.get('group'):
+        where.append('u.learning_group = ?')
+        params.append(args['group'])
+    if args.get('level'):
+        try:
+            levels = [int(level) for level in args['level'].split(',')]
+        except ValueError:
+            raise ValueError('level must be an integer or a comma-separated list of integers')
+        where.append(f'u.user_level IN ({",".join("?" * len(levels))})')
+        params.extend(levels)
+
+    order_by = 'u.id'
+    sort = args.get('sort')
+    if sort:
+        descending = sort.startswith('-')
+        sort_field = sort.lstrip('-')
+        if sort_field not in USER_LIST_COLUMNS:
+            raise ValueError(f'Unknown sort field: {sort_field}')
+        order_by = f'{USER_LIST_COLUMNS[sort_field]} {"DESC" if descending else "ASC"}, u.id'
+
+    limit = args.get('limit')
+    offset = args.get('offset', 0)
+    try:
+        limit = min(int(limit), USERS_MAX_LIMIT) if limit is not None else -1
+        offset = int(offset)
+    except ValueError:
+        raise ValueError('limit and offset must be integers')
+    if limit == 0 or limit < -1 or offset < 0:
+        raise ValueError('limit must be positive and offset must not be negative')
+
+    from_clause = f'''FROM users u
+        LEFT JOIN (SELECT username, MAX(last_timestamp) AS last_active, SUM(total_events) AS event_count
+                   FROM user_daily_stats
+                   {'WHERE ' + ' AND '.join(activity_where) if activity_where else ''}
+                   GROUP BY username) a ON a.username = u.username
+        {'WHERE ' + ' AND '.join(where) if where else ''}'''
+    from_params = activity_params + params
+
+    query = (f'''SELECT {', '.join(USER_LIST_COLUMNS[f] for f in fields)} {from_clause}
+                ORDER BY {order_by} LIMIT ? OFFSET ?''')
+    count_query = f'SELECT COUNT(*) {from_clause}'
+    return fields, query, from_params + [limit, offset], count_query, from_params
+
 @app.route('/api/users', methods=['GET'])
 def get_users():
     try:
-        conn = sqlite3.connect(DB_PATH)
+        try:
+            fields, query, params, count_query, count_params = build_users_query(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        conn = get_db()
         c = conn.cursor()
-        c.execute('''SELECT username, full_name, email, organization, start_date, end_date,
-                     user_level, learning_group, rhino_experience, grasshopper_experience,
-                     technical_score, self_learning_score, cad_tools, modeling_tools,
-                     programming_languages, cad_experience_score
-                     FROM users''')
-        rows = c.fetchall()
-        conn.close()
+        c.execute(query, params)
+        users = [dict(zip(fields, row)) for row in c.fetchall()]
 
-        users = []
-        for row in rows:
-            users.append({
-                'username': row[0],
-                'full_name': row[1],
-                'email': row[2],
-                'organization': row[3],
-                'start_date': row[4],
-                'end_date': row[5],
-                'user_level': row[6],
-                'learning_group': row[7],
-                'rhino_experience': row[8],
-                'grasshopper_experience': row[9],
-                'technical_score': row[10],
-                'self_learning_score': row[11],
-                'cad_tools': row[12],
-                'modeling_tools': row[13],
-                'programming_languages': row[14],
-                'cad_experience_score': row[15]
-            })
+        c.execute(count_query, count_params)
+        total_count = c.fetchone()[0]
 
-        return jsonify(users), 200
+        response = jsonify(users)
+        response.headers['X-Total-Count'] = str(total_count)
+        return response, 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# ログ取得（可視化アプリ用）
-@app.route('/api/logs', methods=['GET'])
-def get_logs():
+# ログ取得のページング（(ts_epoch, id) のキーセットページング。時刻を解釈できない行は最後）
+LOGS_MAX_LIMIT = 10000
+LOG_QUERY_COLUMNS = '''id, timestamp, username, action, detail, document_name,
+                      command, workflow_category, detail_category, ts_epoch'''
+LOG_CURSOR_INDEX = 9  # 行の ts_epoch の位置
+
+def encode_log_cursor(ts_epoch, log_id):
+    return base64.urlsafe_b64encode(json.dumps([ts_epoch, log_id]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_log_cursor(cursor):
+    """(ts_epoch or None, id); cursors issued before the epoch keyset carry the timestamp text"""
     try:
-        username = request.args.get('username')
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
+        padded = cursor + '=' * (-len(cursor) % 4)
+        # 以前のカーソルには3つ目の要素（フィルタの状態）が付いていることがある
+        position, log_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))[:2]
+        if isinstance(position, str):
+            position = timestamp_to_epoch(position)
+        return (int(position) if position is not None else None), int(log_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def parse_logs_limit(args, default):
+    """Read the limit parameter, clamped to LOGS_MAX_LIMIT (None means no limit)"""
+    limit = args.get('limit')
+    if limit is None:
+        return default
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, LOGS_MAX_LIMIT)
+
+def parse_date_bound(args, name):
+    """Epoch of a start_date/end_date parameter and whether it had a time part (None when absent)"""
+    value = args.get(name)
+    if not value:
+        return None, False
+    epoch = timestamp_to_epoch(value)
+    if epoch is None:
+        raise ValueError(f'{name} must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS')
+    return epoch, len(value.strip()) > 10
+
+def build_logs_query(args, limit):
+    """Build the newest-first logs query for username/start_date/end_date/cursor filters
+
+    Returns (query, params, archive_filter); archive_filter applies the same filters to
+    archived months (see merge_archived_rows), or is None when no archived row can match.
+    end_date is inclusive when it has a time part; a bare date ends just before that day,
+    as the text comparison on timestamp did.
+    """
+    query = f'SELECT {LOG_QUERY_COLUMNS} FROM logs WHERE 1=1'
+    params = []
+
+    username = args.get('username')
+    if username:
+        query += ' AND username = ?'
+        params.append(username)
+
+    start_epoch, _ = parse_date_bound(args, 'start_date')
+    if start_epoch is not None:
+        query += ' AND ts_epoch >= ?'
+        params.append(start_epoch)
+
+    end_epoch, end_has_time = parse_date_bound(args, 'end_date')
+    if end_epoch is not None:
+        if not end_has_time:
+            end_epoch -= 1
+        query += ' AND ts_epoch <= ?'
+        params.append(end_epoch)
+
+    # 前ページ最後の行より古いものだけを取得
+    before = None
+    archived = True
+    cursor = args.get('cursor')
+    if cursor:
+        cursor_epoch, cursor_id = decode_log_cursor(cursor)
+        if cursor_epoch is None:
+            query += ' AND ts_epoch IS NULL AND id < ?'
+            params.append(cursor_id)
+            archived = False  # アーカイブの行はすべて返し終わっている
+        else:
+            query += ' AND (ts_epoch < ? OR (ts_epoch = ? AND id < ?) OR ts_epoch IS NULL)'
+            params.extend([cursor_epoch, cursor_epoch, cursor_id])
+            before = (cursor_epoch, cursor_id)
+
+    query += ' ORDER BY ts_epoch DESC, id DESC'
+
+    # 次ページの有無を判定するため1行多く取得する
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit + 1)
+
+    archive_filter = None
+    if archived:
+        archive_filter = {'username': username or None, 'start': start_epoch, 'end': end_epoch, 'before': before}
+    return query, params, archive_filter
+
+def merge_logs_page(conn, live_rows, archive_filter):
+    if archive_filter is None:
+        return live_rows
+    return merge_archived_rows(conn, live_rows, LOG_QUERY_COLUMNS, by_epoch=True, descending=True, **archive_filter)
+
+def fetch_log_page(c, query, params, limit, archive_filter):
+    """Run a paged logs query (merged with archived months) and return (rows, next_cursor)"""
+    rows = merge_logs_page(c.connection, c.execute(query, params), archive_filter)
+    rows = list(islice(rows, limit + 1))
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_log_cursor(rows[-1][LOG_CURSOR_INDEX], rows[-1][0])
+    return rows, None
+
+def stream_log_rows(query, params, archive_filter, limit, to_entry, filter_auto_generated=False):
+    """Stream query results as NDJSON straight from the cursor (constant memory per request)
+
+    When a limit is given and more rows remain, the last line is {"next_cursor": "..."}.
+    With filter_auto_generated the query must not have a LIMIT: the filter reads a few rows
+    past the page to decide the layer actions at its end.
+    """
+    def generate():
+        last_row = None
+        next_page = []
+        with db_connection() as conn:
+            cursor = merge_logs_page(conn, conn.execute(query, params), archive_filter)
+
+            def entries():
+                nonlocal last_row
+                count = 0
+                for row in cursor:
+                    if limit is not None and count == limit:
+                        next_page.append(row)
+                        return
+                    count += 1
+                    last_row = row
+                    yield to_entry(row)
+                last_row = None  # 最後まで返した
+
+            def lookahead():
+                for row in chain(next_page, cursor):
+                    yield to_entry(row)
+
+            logs = entries()
+            if filter_auto_generated:
+                logs = iter_filter_auto_generated_actions(logs, lookahead=lookahead())
+            for entry in logs:
+                yield json.dumps(entry, ensure_ascii=False) + '\n'
+
+        if last_row is not None:
+            next_cursor = encode_log_cursor(last_row[LOG_CURSOR_INDEX], last_row[0])
+            yield json.dumps({'next_cursor': next_cursor}) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def log_entry_from_row(row):
+    _, timestamp, username, action, detail, document_name, command, workflow_category, detail_category, _ = row
+
+    # Layer/Document operations are classified by action name (see classify_log_event)
+    command_name = command
+    if action in LAYER_ACTIONS or action in DOCUMENT_ACTIONS:
+        command_name = action
+
+    log_entry = {
+        'timestamp': timestamp,
+        'username': username,
+        'action': action,
+        'detail': detail,
+        'document_name': document_name,
+        'command_name': command_name,
+        'WorkflowCategory': workflow_category,
+        'DetailCategory': detail_category
+    }
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+    # Add Japanese names if available
+    if workflow_category and COMMAND_CLASSIFICATION:
+        wf_cats = COMMAND_CLASSIFICATION.get('workflow_categories', {})
+        if workflow_category in wf_cats:
+            log_entry['WorkflowCategoryName'] = wf_cats[workflow_category].get('name_ja', workflow_category)
 
-        query = 'SELECT timestamp, username, action, detail, document_name FROM logs WHERE 1=1'
-        params = []
+    if detail_category and DETAIL_CATEGORY_NAMES:
+        log_entry['DetailCategoryName'] = DETAIL_CATEGORY_NAMES.get(detail_category, detail_category)
 
-        if username:
-            query += ' AND username = ?'
-            params.append(username)
+    return log_entry
 
-        if start_date:
-            query += ' AND timestamp >= ?'
-            params.append(start_date)
+def classified_entry_from_row(row):
+    _, timestamp, username, action, detail, document_name, command_name, workflow_cat, detail_cat, _ = row
 
-        if end_date:
-            query += ' AND timestamp <= ?'
-            params.append(end_date)
+    # Only commands are counted here (layer/document rows keep their stored category out)
+    if action != 'Command':
+        workflow_cat, detail_cat = None, None
 
-        query += ' ORDER BY timestamp DESC LIMIT 10000'
+    return {
+        'timestamp': timestamp,
+        'username': username,
+        'action': action,
+        'detail': detail,
+        'document_name': document_name,
+        'command': command_name,
+        'workflow_category': workflow_cat,
+        'detail_category': detail_cat
+    }
 
-        c.execute(query, params)
-        rows = c.fetchall()
-        conn.close()
+# 条件付きGETとレスポンスキャッシュ（分析系エンドポイント）
+#
+# ETag は (エンドポイント, クエリ, ウォーターマーク, データ世代, 分類ルール) から作る。
+# ウォーターマークは user_watermarks（取り込み時に更新）の最大ログIDで、username を
+# 指定しないリクエストは全ユーザーの最大値を使う。データ世代は再分類・集計の再計算で
+# 上がるので、新しいログがなくても結果が変わる操作の後は別のキーになる。
+RESPONSE_CACHE_SIZE = int(os.environ.get('RHINOLOG_RESPONSE_CACHE_SIZE', '256'))
+
+class ResponseCache:
+    """Bounded LRU of serialized responses, keyed by ETag (per worker process)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses}
+
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_SIZE)
+
+def update_watermarks(c, rows):
+    """Advance the watermark of every user in a freshly inserted batch"""
+    max_log_id = c.execute('SELECT MAX(id) FROM log_events').fetchone()[0]
+    now = int(time.time())
+    c.executemany('''INSERT INTO user_watermarks (username, max_log_id, updated_epoch) VALUES (?, ?, ?)
+                     ON CONFLICT(username) DO UPDATE SET
+                         max_log_id = excluded.max_log_id, updated_epoch = excluded.updated_epoch''',
+                  [(username, max_log_id, now) for username in {row[1] for row in rows}])
+
+def bump_data_generation(conn):
+    """Invalidate cached analytics after stored results changed without new logs"""
+    generation = int(get_meta(conn, 'data_generation') or 0) + 1
+    set_meta(conn, 'data_generation', str(generation))
+    conn.commit()
 
-        logs = []
-        for row in rows:
-            timestamp, username, action, detail, document_name = row
-
-            # Classify command if it's a Command action or Layer operation
-            workflow_category = None
-            detail_category = None
-            command_name = None
-
-            if action == 'Command' and detail:
-                command_name = detail.split(';')[0].strip()
-                workflow_category, detail_category = classify_command(command_name)
-            elif action in ['Layer Created', 'Layer Modified', 'Layer Deleted']:
-                # Classify layer operations as organization/layer_organization
-                workflow_category = 'organization'
-                detail_category = 'layer_organization'
-                command_name = action
-            elif action in ['Document Opened', 'Document Closed']:
-                # Classify document operations as data_management/file_open_close
-                workflow_category = 'data_management'
-                detail_category = 'file_open_close'
-                command_name = action
-
-            log_entry = {
-                'timestamp': timestamp,
-                'username': username,
-                'action': action,
-                'detail': detail,
-                'document_name': document_name,
-                'command_name': command_name,
-                'WorkflowCategory': workflow_category,
-                'DetailCategory': detail_category
-            }
+def read_watermark(c, username=None):
+    """(max_log_id, data_generation) for a user, or for all users"""
+    if username is None:
+        c.execute('''SELECT MAX(max_log_id),
+                            (SELECT value FROM app_meta WHERE key = 'data_generation')
+                     FROM user_watermarks''')
+    else:
+        c.execute('''SELECT w.max_log_id,
+                            (SELECT value FROM app_meta WHERE key = 'data_generation')
+                     FROM (SELECT 1) LEFT JOIN user_watermarks w ON w.username = ?''', (username,))
+    return c.fetchone()
 
-            # Add Japanese names if available
-            if workflow_category and COMMAND_CLASSIFICATION:
-                wf_cats = COMMAND_CLASSIFICATION.get('workflow_categories', {})
-                if workflow_category in wf_cats:
-                    log_entry['WorkflowCategoryName'] = wf_cats[workflow_category].get('name_ja', workflow_category)
+def conditional_cached(view):
+    """
+    Serve a GET view with an ETag, 304 on If-None-Match and an LRU of serialized 200
+    responses. Streaming responses (format=ndjson) bypass the cache.
 
-            if detail_category and DETAIL_CATEGORY_NAMES:
-                log_entry['DetailCategoryName'] = DETAIL_CATEGORY_NAMES.get(detail_category, detail_category)
+    There is no Last-Modified: reclassification, rule changes and rollup rebuilds change
+    the response without new logs, which only the ETag (generation, rules) reflects.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.args.get('format') == 'ndjson':
+            return view(*args, **kwargs)
+
+        username = kwargs.get('username') or request.args.get('username')
+        max_log_id, generation = read_watermark(get_db().cursor(), username)
+        etag = hashlib.sha1(json.dumps([
+            request.endpoint, sorted(request.args.items(multi=True)), kwargs,
+            max_log_id, generation, CLASSIFICATION_FINGERPRINT
+        ]).encode()).hexdigest()
+
+        cached = RESPONSE_CACHE.get(etag)
+        if cached is not None:
+            body, mimetype, headers = cached
+            response = Response(body, mimetype=mimetype, headers=headers)
+        else:
+            response = app.make_response(view(*args, **kwargs))
+            # 再分類中の結果は途中経過なので保存しない
+            if response.status_code != 200 or _reclassify_status['running']:
+                return response
+            headers = {k: v for k, v in response.headers.items() if k.startswith('X-')}
+            RESPONSE_CACHE.put(etag, (response.get_data(), response.mimetype, headers))
 
-            logs.append(log_entry)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True  # キャッシュしてよいが毎回再検証する
+        return response.make_conditional(request)
+
+    return wrapper
+
+# ログ取得（可視化アプリ用）
+@app.route('/api/logs', methods=['GET'])
+def get_logs():
+    """Newest-first logs; paged with limit/cursor, or streamed with format=ndjson"""
+    try:
+        stream = request.args.get('format') == 'ndjson'
+        try:
+            limit = parse_logs_limit(request.args, None if stream else LOGS_MAX_LIMIT)
+            # 自動生成アクションのフィルタはページの末尾のレイヤー操作を次の数行で判定するので LIMIT を付けない
+            # （行はカーソルから必要な分だけ読む。ページの区切り方で結果が変わらない）
+            query, params, archive_filter = build_logs_query(request.args, None)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if stream:
+            return stream_log_rows(query, params, archive_filter, limit, log_entry_from_row,
+                                   filter_auto_generated=True)
+
+        conn = get_db()
+        c = conn.cursor()
+        cursor = merge_logs_page(conn, c.execute(query, params), archive_filter)
+        rows = list(islice(cursor, limit + 1))
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_log_cursor(rows[limit - 1][LOG_CURSOR_INDEX], rows[limit - 1][0])
+
+        logs = [log_entry_from_row(row) for row in rows[:limit]]
+        lookahead = (log_entry_from_row(row) for row in chain(rows[limit:], cursor))
 
         # Filter out auto-generated actions
-        filtered_logs = filter_auto_generated_actions(logs)
+        filtered_logs = filter_auto_generated_actions(logs, lookahead=lookahead)
 
-        return jsonify(filtered_logs), 200
+        response = jsonify(filtered_logs)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -495,25 +2847,18 @@ def get_logs():
 @app.route('/api/stats/<username>', methods=['GET'])
 def get_stats(username):
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
 
-        # コマンド使用頻度
-        c.execute('''SELECT action, COUNT(*) as count
-                     FROM logs
-                     WHERE username = ? AND action = 'Command'
-                     GROUP BY detail
-                     ORDER BY count DESC
-                     LIMIT 20''', (username,))
-
-        commands = [{'action': row[0], 'count': row[1]} for row in c.fetchall()]
+        # コマンド使用頻度（取り込み時に加算するコマンド別の集計から。アーカイブ済みの月も含む）
+        c.execute('''SELECT detail, event_count FROM user_command_stats WHERE username = ?
+                     ORDER BY event_count DESC, detail LIMIT 20''', (username,))
+        commands = [{'command': detail, 'count': count} for detail, count in c.fetchall()]
 
-        # 総操作数
-        c.execute('SELECT COUNT(*) FROM logs WHERE username = ?', (username,))
+        # 総操作数（日別集計から）
+        c.execute('SELECT COALESCE(SUM(total_events), 0) FROM user_daily_stats WHERE username = ?', (username,))
         total_logs = c.fetchone()[0]
 
-        conn.close()
-
         return jsonify({
             'username': username,
             'total_logs': total_logs,
@@ -527,7 +2872,7 @@ def get_stats(username):
 @app.route('/api/groups', methods=['GET'])
 def get_learning_groups():
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
 
         # グループ別にユーザーを集計
@@ -540,7 +2885,6 @@ def get_learning_groups():
                      ORDER BY learning_group DESC''')
 
         rows = c.fetchall()
-        conn.close()
 
         groups = []
         for row in rows:
@@ -560,7 +2904,7 @@ def get_learning_groups():
 @app.route('/api/group/<group_id>/users', methods=['GET'])
 def get_group_users(group_id):
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
 
         c.execute('''SELECT username, full_name, user_level,
@@ -571,7 +2915,6 @@ def get_group_users(group_id):
                      ORDER BY user_level DESC''', (group_id,))
 
         rows = c.fetchall()
-        conn.close()
 
         users = []
         for row in rows:
@@ -590,6 +2933,48 @@ def get_group_users(group_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# スクリーニングテストの問題別・カテゴリ別得点（screening_question_scores / screening_category_scores）
+def store_screening_scores(c, username, category_scores, question_scores):
+    """Replace a user's per-question and per-category rows with the ones from a submission
+
+    question_scores is {"<question number>": points}; category_scores is
+    {category: {"name", "correct", "total", "percentage"}} as sent by ScreeningTest_Code.gs.
+    Entries that do not have that shape are skipped.
+    """
+    questions = []
+    for number, points in question_scores.items():
+        try:
+            questions.append((username, int(number), float(points)))  # NUMERIC 列なので 1.0 は 1 で保存される
+        except (TypeError, ValueError):
+            continue
+    categories = [(username, category, scores.get('name'), scores.get('correct'), scores.get('total'),
+                   scores.get('percentage'))
+                  for category, scores in category_scores.items() if isinstance(scores, dict)]
+
+    c.execute('DELETE FROM screening_question_scores WHERE username = ?', (username,))
+    c.executemany('INSERT INTO screening_question_scores (username, question, points) VALUES (?, ?, ?)', questions)
+    c.execute('DELETE FROM screening_category_scores WHERE username = ?', (username,))
+    c.executemany('''INSERT INTO screening_category_scores (username, category, name, correct, total, percentage)
+                     VALUES (?, ?, ?, ?, ?, ?)''', categories)
+
+def fetch_screening_scores(c, usernames):
+    """username -> (category_scores, question_scores) dicts in the submitted JSON shape"""
+    scores = {username: ({}, {}) for username in usernames}
+    usernames = list(scores)
+    for i in range(0, len(usernames), SQLITE_MAX_VARIABLES):
+        chunk = usernames[i:i + SQLITE_MAX_VARIABLES]
+        placeholders = ','.join('?' * len(chunk))
+        c.execute(f'''SELECT username, category, name, correct, total, percentage FROM screening_category_scores
+                      WHERE username IN ({placeholders})''', chunk)
+        for username, category, name, correct, total, percentage in c.fetchall():
+            scores[username][0][category] = {'name': name, 'correct': correct, 'total': total,
+                                             'percentage': percentage}
+        c.execute(f'''SELECT username, question, points FROM screening_question_scores
+                      WHERE username IN ({placeholders}) ORDER BY username, question''', chunk)
+        for username, question, points in c.fetchall():
+            scores[username][1][str(question)] = points
+    return scores
+
 # スクリーニングテストのスコアを更新
 @app.route('/api/user/update-score', methods=['POST'])
 def update_user_score():
@@ -601,222 +2986,620 @@ def update_user_score():
             if field not in data:
                 return jsonify({'error': f'Missing field: {field}'}), 400
 
-        email = data['email']
-        technical_score = float(data['technical_score'])
+        email = data['email']
+        technical_score = float(data['technical_score'])
+
+        # カテゴリ別スコアと問題別スコア（オプション）
+        category_scores = data.get('category_scores') or {}
+        question_scores = data.get('question_scores') or {}
+        if not isinstance(category_scores, dict) or not isinstance(question_scores, dict):
+            return jsonify({'error': 'category_scores and question_scores must be objects'}), 400
+
+        conn = get_db()
+        c = conn.cursor()
+
+        # メールアドレスでユーザーを検索
+        c.execute('''SELECT username, rhino_experience, grasshopper_experience, self_learning_score,
+                     cad_tools, modeling_tools, programming_languages
+                     FROM users WHERE email = ?''', (email,))
+        user_row = c.fetchone()
+
+        if not user_row:
+            return jsonify({'error': 'User not found with this email'}), 404
+
+        username = user_row[0]
+
+        # スコアを計算してレベルを再判定
+        cad_experience_score, user_level = score_user(user_row[1], user_row[2], technical_score, user_row[3],
+                                                      user_row[4], user_row[5], user_row[6])
+
+        # ユーザーのtechnical_scoreとuser_levelとcad_experience_scoreを更新
+        c.execute('''UPDATE users SET
+            technical_score = ?, user_level = ?, cad_experience_score = ?, scoring_version = ?
+            WHERE username = ?''',
+            (technical_score, user_level, cad_experience_score, SCORING_RULES_VERSION, username))
+
+        # screening_resultsテーブルに詳細データを保存（存在する場合は更新）
+        if category_scores or question_scores:
+            c.execute('''INSERT INTO screening_results (username, technical_score, submitted_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(username) DO UPDATE SET
+                    technical_score = excluded.technical_score, submitted_at = excluded.submitted_at''',
+                (username, technical_score, datetime.now().isoformat()))
+            store_screening_scores(c, username, category_scores, question_scores)
+
+        conn.commit()
+
+        return jsonify({
+            'status': 'success',
+            'message': 'Technical score updated',
+            'username': username,
+            'technical_score': technical_score,
+            'user_level': user_level,
+            'cad_experience_score': cad_experience_score
+        }), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# スクリーニングテスト結果取得
+@app.route('/api/screening/<username>', methods=['GET'])
+def get_screening_results(username):
+    try:
+        conn = get_db()
+        c = conn.cursor()
+
+        c.execute('''SELECT technical_score, submitted_at
+                     FROM screening_results
+                     WHERE username = ?''', (username,))
+        row = c.fetchone()
+
+        if not row:
+            return jsonify({'error': 'Screening results not found'}), 404
+
+        category_scores, question_scores = fetch_screening_scores(c, [username])[username]
+
+        return jsonify({
+            'username': username,
+            'technical_score': row[0],
+            'category_scores': category_scores,
+            'question_scores': question_scores,
+            'submitted_at': row[1]
+        }), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# スクリーニングテストの集計（正規化テーブルを SQL で集計。group で学習グループに絞る）
+SCREENING_SCORE_BIN_WIDTH = 10
+SCREENING_QUESTION_CATEGORIES = {question: category for category, (_, questions) in SCREENING_CATEGORIES.items()
+                                 for question in questions}
+
+@app.route('/api/screening/stats', methods=['GET'])
+def get_screening_stats():
+    """Per-question difficulty, per-category averages and score distributions of one group (or everyone)"""
+    try:
+        group = request.args.get('group')
+        where, params = ('WHERE u.learning_group = ?', [group]) if group else ('', [])
+
+        conn = get_db()
+        c = conn.cursor()
+
+        # technical_score の平均と 10 点刻みの分布
+        c.execute(f'''SELECT COUNT(*), AVG(s.technical_score), MIN(s.technical_score), MAX(s.technical_score)
+                      FROM screening_results s JOIN users u ON u.username = s.username {where}''', params)
+        user_count, average, lowest, highest = c.fetchone()
+        last_bin = 100 // SCREENING_SCORE_BIN_WIDTH - 1
+        c.execute(f'''SELECT MIN(CAST(s.technical_score / ? AS INTEGER), ?) AS score_bin, COUNT(*)
+                      FROM screening_results s JOIN users u ON u.username = s.username {where}
+                      GROUP BY score_bin ORDER BY score_bin''', [SCREENING_SCORE_BIN_WIDTH, last_bin] + params)
+        distribution = [{'min': score_bin * SCREENING_SCORE_BIN_WIDTH, 'max': (score_bin + 1) * SCREENING_SCORE_BIN_WIDTH,
+                         'users': count} for score_bin, count in c.fetchall()]
+
+        # 問題別の正答率（正答率の低い＝難しい順）
+        c.execute(f'''SELECT q.question, COUNT(*), SUM(q.points > 0)
+                      FROM screening_question_scores q JOIN users u ON u.username = q.username {where}
+                      GROUP BY q.question
+                      ORDER BY AVG(q.points > 0), q.question''', params)
+        questions = [{'question': question, 'category': SCREENING_QUESTION_CATEGORIES.get(question),
+                      'answered': answered, 'correct': correct,
+                      'correct_rate': round(correct / answered, 4), 'difficulty': round(1 - correct / answered, 4)}
+                     for question, answered, correct in c.fetchall()]
+
+        # カテゴリ別の平均正答率と、正解数ごとの人数
+        c.execute(f'''SELECT k.category, k.correct, COUNT(*)
+                      FROM screening_category_scores k JOIN users u ON u.username = k.username {where}
+                      GROUP BY k.category, k.correct''', params)
+        category_distributions = {}
+        for category, correct, count in c.fetchall():
+            category_distributions.setdefault(category, []).append({'correct': correct, 'users': count})
+        c.execute(f'''SELECT k.category, MAX(k.name), MAX(k.total), COUNT(*),
+                             AVG(k.percentage), MIN(k.percentage), MAX(k.percentage)
+                      FROM screening_category_scores k JOIN users u ON u.username = k.username {where}
+                      GROUP BY k.category
+                      ORDER BY AVG(k.percentage), k.category''', params)
+        categories = [{'category': category, 'name': name, 'total': total, 'users': count,
+                       'avg_percentage': round(avg, 2) if avg is not None else None,
+                       'min_percentage': low, 'max_percentage': high,
+                       'distribution': category_distributions.get(category, [])}
+                      for category, name, total, count, avg, low, high in c.fetchall()]
+
+        return jsonify({
+            'group': group,
+            'users': user_count,
+            'technical_score': {
+                'avg': round(average, 2) if average is not None else None,
+                'min': lowest,
+                'max': highest,
+                'distribution': distribution
+            },
+            'questions': questions,
+            'categories': categories
+        }), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 学習グループごとのスクリーニング結果の比較
+@app.route('/api/screening/stats/groups', methods=['GET'])
+def get_screening_group_stats():
+    """technical_score summary and per-category average percentage of every learning_group"""
+    try:
+        conn = get_db()
+        c = conn.cursor()
+
+        c.execute('''SELECT u.learning_group, k.category, AVG(k.percentage)
+                     FROM screening_category_scores k JOIN users u ON u.username = k.username
+                     GROUP BY u.learning_group, k.category''')
+        category_averages = {}
+        for group, category, avg in c.fetchall():
+            category_averages.setdefault(group, {})[category] = round(avg, 2) if avg is not None else None
+
+        c.execute('''SELECT u.learning_group, COUNT(*), AVG(s.technical_score),
+                            MIN(s.technical_score), MAX(s.technical_score)
+                     FROM screening_results s JOIN users u ON u.username = s.username
+                     GROUP BY u.learning_group
+                     ORDER BY u.learning_group DESC''')
+        groups = [{'group_id': group, 'users': count, 'avg_technical_score': round(avg, 2),
+                   'min_technical_score': low, 'max_technical_score': high,
+                   'category_avg_percentage': category_averages.get(group, {})}
+                  for group, count, avg, low, high in c.fetchall()]
+
+        return jsonify(groups), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# スコアの再計算（scoring_rules.py のルール変更時）
+#
+# ユーザーを id 順に RELEVEL_BATCH_SIZE 件ずつ読み、値が変わる行だけをバッチごとの executemany で
+# 書き戻す（全体で1トランザクション）。スクリーニングの問題別得点が全問そろっていれば
+# technical_score とカテゴリ別得点も現在のルールで計算し直す。
+RELEVEL_BATCH_SIZE = 500
+RELEVEL_SAMPLE_SIZE = 50
+
+def relevel_users(conn, dry_run=False):
+    """Recompute every user's scores and level with the current scoring rules -> diff report"""
+    c = conn.cursor()
+    if not dry_run and not conn.in_transaction:
+        c.execute('BEGIN IMMEDIATE')
+
+    levels_before, levels_after, transitions = Counter(), Counter(), Counter()
+    scanned = users_updated = screening_updated = 0
+    sample = []
+    last_id = 0
+    try:
+        while True:
+            c.execute('''SELECT u.id, u.username, u.rhino_experience, u.grasshopper_experience,
+                                 u.technical_score, u.self_learning_score, u.cad_tools, u.modeling_tools,
+                                 u.programming_languages, u.cad_experience_score, u.user_level,
+                                 u.scoring_version, s.technical_score
+                          FROM users u LEFT JOIN screening_results s ON s.username = u.username
+                          WHERE u.id > ? ORDER BY u.id LIMIT ?''', (last_id, RELEVEL_BATCH_SIZE))
+            rows = c.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            screening_scores = fetch_screening_scores(c, [row[1] for row in rows if row[12] is not None])
+
+            user_updates, screening_updates = [], []
+            for (user_id, username, rhino_exp, gh_exp, technical_score, self_learning, cad_tools,
+                 modeling_tools, programming_langs, cad_score, level, version,
+                 screening_technical) in rows:
+                new_technical = technical_score
+                category_scores, question_scores = screening_scores.get(username, ({}, {}))
+                screening = score_screening(question_scores) if question_scores else None
+                if screening is not None:
+                    new_technical, new_categories = screening
+                    if new_technical != screening_technical or new_categories != category_scores:
+                        screening_updates.append((username, new_technical, new_categories, question_scores))
+
+                new_cad, new_level = score_user(rhino_exp, gh_exp, new_technical, self_learning,
+                                                cad_tools, modeling_tools, programming_langs)
+                if (new_technical, new_cad, new_level, SCORING_RULES_VERSION) != (technical_score, cad_score, level, version):
+                    user_updates.append((new_technical, new_cad, new_level, SCORING_RULES_VERSION, user_id))
+
+                levels_before[level] += 1
+                levels_after[new_level] += 1
+                if new_level != level:
+                    transitions[f'{level}->{new_level}'] += 1
+                    if len(sample) < RELEVEL_SAMPLE_SIZE:
+                        sample.append({'username': username, 'user_level': level, 'new_user_level': new_level,
+                                       'technical_score': technical_score, 'new_technical_score': new_technical,
+                                       'cad_experience_score': cad_score, 'new_cad_experience_score': new_cad})
+
+            scanned += len(rows)
+            users_updated += len(user_updates)
+            screening_updated += len(screening_updates)
+            if not dry_run:
+                c.executemany('''UPDATE users SET technical_score = ?, cad_experience_score = ?, user_level = ?,
+                                 scoring_version = ? WHERE id = ?''', user_updates)
+                c.executemany('UPDATE screening_results SET technical_score = ? WHERE username = ?',
+                              [(technical, username) for username, technical, _, _ in screening_updates])
+                for username, _, new_categories, question_scores in screening_updates:
+                    store_screening_scores(c, username, new_categories, question_scores)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return {
+        'scoring_rules_version': SCORING_RULES_VERSION,
+        'dry_run': dry_run,
+        'users_scanned': scanned,
+        'users_updated': users_updated,
+        'screening_results_updated': screening_updated,
+        'level_changes': sum(transitions.values()),
+        'transitions': dict(transitions.most_common()),
+        'levels_before': {str(level): count for level, count in sorted(levels_before.items(), key=str)},
+        'levels_after': {str(level): count for level, count in sorted(levels_after.items(), key=str)},
+        'sample': sample
+    }
+
+def count_stale_scores(conn):
+    """Users whose level was computed with other scoring rules (or before versions were recorded)"""
+    return conn.execute('SELECT COUNT(*) FROM users WHERE scoring_version IS NOT ?',
+                        (SCORING_RULES_VERSION,)).fetchone()[0]
+
+# スコア・レベルの再計算（管理用）。{"dry_run": true} で書き込まずに差分だけ返す
+@app.route('/api/admin/scoring/relevel', methods=['POST'])
+def admin_relevel_users():
+    try:
+        data = request.get_json(silent=True) or {}
+        dry_run = data.get('dry_run', False)
+        if not isinstance(dry_run, bool):
+            return jsonify({'error': 'dry_run must be true or false'}), 400
+
+        result = relevel_users(get_db(), dry_run=dry_run)
+        return jsonify({'status': 'success', **result}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# スコアリングルールの版と、古い版で計算されたままのユーザー数
+@app.route('/api/admin/scoring', methods=['GET'])
+def admin_scoring_status():
+    try:
+        return jsonify({'scoring_rules_version': SCORING_RULES_VERSION,
+                        'stale_users': count_stale_scores(get_db())}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        # カテゴリ別スコアと問題別スコア（オプション）
-        category_scores = data.get('category_scores', {})
-        question_scores = data.get('question_scores', {})
+def classify_command(command_name):
+    """Classify a Rhino command into workflow and detail categories"""
+    rules = CLASSIFICATION_RULES
+    if rules is None:
+        classification_row_logger.warning('COMMAND_CLASSIFICATION is not loaded!')
+        return None, None
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+    if not command_name:
+        return None, None
 
-        # メールアドレスでユーザーを検索
-        c.execute('''SELECT username, rhino_experience, grasshopper_experience, self_learning_score,
-                     cad_tools, modeling_tools, programming_languages
-                     FROM users WHERE email = ?''', (email,))
-        user_row = c.fetchone()
+    categories = _lookup_command(command_name, rules)
+    if categories is None:
+        UNCLASSIFIED_COMMANDS[command_name] += 1
+        count_diagnostic('unclassified_commands', command_name)
+        classification_row_logger.debug('No classification for command: %r', command_name)
+        return None, None
 
-        if not user_row:
-            conn.close()
-            return jsonify({'error': 'User not found with this email'}), 404
+    return categories
+
+@lru_cache(maxsize=UNCLASSIFIED_LOOKUP_CACHE_SIZE)
+def _lookup_command(command_name, rules):
+    """Resolve a raw command name through one rules version's lookup and alias tables (cached)"""
+    key = normalize_command_name(command_name)
+    categories = rules.lookup.get(key)
+    if categories is None and key in rules.aliases:
+        categories = rules.lookup.get(rules.aliases[key])
+    return categories
+
+LAYER_ACTIONS = ('Layer Created', 'Layer Modified', 'Layer Deleted')
+DOCUMENT_ACTIONS = ('Document Opened', 'Document Closed')
+
+def classify_log_event(action, detail):
+    """Return (command, workflow_category, detail_category) to store with a log row"""
+    if action == 'Command' and detail:
+        command_name = detail.split(';')[0].strip()
+        workflow_cat, detail_cat = classify_command(command_name)
+        return command_name, workflow_cat, detail_cat
+    elif action in LAYER_ACTIONS:
+        # Classify layer operations as organization/layer_organization
+        return None, 'organization', 'layer_organization'
+    elif action in DOCUMENT_ACTIONS:
+        # Classify document operations as data_management/file_open_close
+        return None, 'data_management', 'file_open_close'
+    return None, None, None
+
+# 分類の再計算（過去ログのバックフィル・分類ルール変更時）
+#
+# gunicorn の各ワーカーのウォッチャーが同じルール変更を同時に検知するので、ジョブは
+# DB_PATH.reclassify.lock の排他ロック（flock）を取れたプロセスだけが実行する。
+RECLASSIFY_BATCH_SIZE = 5000
+_reclassify_lock = threading.Lock()
+_reclassify_status = {'running': False, 'processed': 0, 'fingerprint': None, 'finished_at': None}
+
+def claim_reclassification(blocking=False):
+    """Take the cross-process reclassification lock; the open lock file (close it to release), or None"""
+    lock_file = open(DB_PATH + '.reclassify.lock', 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_file.close()
+            return None
+    return lock_file
+
+def get_meta(conn, key):
+    row = conn.execute('SELECT value FROM app_meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+def set_meta(conn, key, value):
+    conn.execute('''INSERT INTO app_meta (key, value) VALUES (?, ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value''', (key, value))
+
+def reclassify_logs(conn):
+    """Recompute the stored classification of every (action, detail) pair, in committed batches
+
+    Live rows share their pair's log_details entry, so this touches one row per distinct
+    command/layer/path rather than one per event.
+    """
+    fingerprint = CLASSIFICATION_FINGERPRINT
+    max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM log_details').fetchone()[0]
+    processed = 0
+    last_id = 0
+
+    while last_id < max_id:
+        rows = conn.execute('''SELECT d.id, a.name, d.detail FROM log_details d JOIN actions a ON a.id = d.action_id
+                                WHERE d.id > ? AND d.id <= ? ORDER BY d.id LIMIT ?''',
+                            (last_id, max_id, RECLASSIFY_BATCH_SIZE)).fetchall()
+        if not rows:
+            break
 
-        username = user_row[0]
-        rhino_exp = user_row[1] if user_row[1] else '未経験'
-        gh_exp = user_row[2] if user_row[2] else '未経験'
-        self_learning = user_row[3] if user_row[3] else 60
-        cad_tools = user_row[4] if user_row[4] else ''
-        modeling_tools = user_row[5] if user_row[5] else ''
-        programming_langs = user_row[6] if user_row[6] else ''
+        updates = [classify_log_event(action, detail) + (detail_id,) for detail_id, action, detail in rows]
+        conn.executemany('''UPDATE log_details SET command = ?, workflow_category = ?, detail_category = ?
+                              WHERE id = ?''', updates)
+        conn.commit()
 
-        # スコアを計算してレベルを再判定
-        rhino_score = get_experience_score(rhino_exp)
-        gh_score = get_experience_score(gh_exp)
-        cad_experience_score = calculate_cad_experience_score(cad_tools, modeling_tools, programming_langs)
-        user_level = determine_user_level(rhino_score, gh_score, technical_score, self_learning, cad_experience_score)
+        last_id = rows[-1][0]
+        processed += len(rows)
+        _reclassify_status['processed'] = processed
 
-        # ユーザーのtechnical_scoreとuser_levelとcad_experience_scoreを更新
-        c.execute('''UPDATE users SET
-            technical_score = ?, user_level = ?, cad_experience_score = ?
-            WHERE username = ?''',
-            (technical_score, user_level, cad_experience_score, username))
+    processed += reclassify_archives(conn)
 
-        # screening_resultsテーブルに詳細データを保存（存在する場合は更新）
-        if category_scores or question_scores:
-            # テーブルが存在しない場合は作成
-            c.execute('''CREATE TABLE IF NOT EXISTS screening_results (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                technical_score REAL NOT NULL,
-                category_scores TEXT,
-                question_scores TEXT,
-                submitted_at TEXT NOT NULL,
-                FOREIGN KEY (username) REFERENCES users(username)
-            )''')
-
-            # データをJSON文字列に変換
-            category_scores_json = json.dumps(category_scores) if category_scores else None
-            question_scores_json = json.dumps(question_scores) if question_scores else None
-
-            # 既存データがあれば更新、なければ挿入
-            c.execute('SELECT username FROM screening_results WHERE username = ?', (username,))
-            if c.fetchone():
-                c.execute('''UPDATE screening_results SET
-                    technical_score = ?, category_scores = ?, question_scores = ?, submitted_at = ?
-                    WHERE username = ?''',
-                    (technical_score, category_scores_json, question_scores_json,
-                     datetime.now().isoformat(), username))
-            else:
-                c.execute('''INSERT INTO screening_results
-                    (username, technical_score, category_scores, question_scores, submitted_at)
-                    VALUES (?, ?, ?, ?, ?)''',
-                    (username, technical_score, category_scores_json, question_scores_json,
-                     datetime.now().isoformat()))
+    # 以降に取り込まれた行はアップロード時に同じルールで分類済み
+    set_meta(conn, 'classification_fingerprint', fingerprint)
+    conn.commit()
 
-        conn.commit()
-        conn.close()
+    # カテゴリが変わったので集計テーブルとアクショングループも作り直す
+    rebuild_rollups(conn)
+    rebuild_action_groups(conn)
+    return processed
 
-        return jsonify({
-            'status': 'success',
-            'message': 'Technical score updated',
-            'username': username,
-            'technical_score': technical_score,
-            'user_level': user_level,
-            'cad_experience_score': cad_experience_score
-        }), 200
+def _run_reclassification(lock_file):
+    try:
+        with db_connection() as conn:
+            processed = reclassify_logs(conn)
+        classification_logger.info('Reclassified %d log details and archived rows with rules %s',
+                                   processed, CLASSIFICATION_FINGERPRINT)
+    except Exception as e:
+        classification_logger.exception('Log reclassification failed: %s', e)
+    finally:
+        _reclassify_status['running'] = False
+        _reclassify_status['finished_at'] = datetime.now().isoformat()
+        lock_file.close()
+        _reclassify_lock.release()
+
+def start_reclassification_job(force=False):
+    """Reclassify stored logs in a background thread when the rules changed (or when forced)"""
+    if not COMMAND_CLASSIFICATION:
+        return False
+
+    if not force and reclassification_done():
+        return False
+
+    if not _reclassify_lock.acquire(blocking=False):
+        return False  # このプロセスで実行中
+    lock_file = claim_reclassification()
+    if lock_file is None:
+        _reclassify_lock.release()
+        return False  # 別のプロセスで実行中
+
+    # 最初の確認からロックを取るまでに別のプロセスが同じルールで終えていれば何もしない
+    if not force and reclassification_done():
+        lock_file.close()
+        _reclassify_lock.release()
+        return False
+
+    _reclassify_status.update({'running': True, 'processed': 0,
+                               'fingerprint': CLASSIFICATION_FINGERPRINT, 'finished_at': None})
+    threading.Thread(target=_run_reclassification, args=(lock_file,), name='reclassify-logs', daemon=True).start()
+    return True
+
+def reclassification_done():
+    """Whether the stored classification was computed with the loaded rules"""
+    with db_connection() as conn:
+        return get_meta(conn, 'classification_fingerprint') == CLASSIFICATION_FINGERPRINT
+
+# 集計テーブルを生ログから再計算（管理用・整合性チェック）
+@app.route('/api/admin/rollups/rebuild', methods=['POST'])
+def admin_rebuild_rollups():
+    try:
+        result = rebuild_rollups(get_db())
+        return jsonify({'status': 'success', **result}), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# スクリーニングテスト結果取得
-@app.route('/api/screening/<username>', methods=['GET'])
-def get_screening_results(username):
+# 分類の再計算を手動で開始（管理用）
+@app.route('/api/admin/reclassify', methods=['POST'])
+def admin_reclassify():
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
-        c.execute('''SELECT technical_score, category_scores, question_scores, submitted_at
-                     FROM screening_results
-                     WHERE username = ?''', (username,))
-        row = c.fetchone()
-        conn.close()
-
-        if not row:
-            return jsonify({'error': 'Screening results not found'}), 404
+        started = start_reclassification_job(force=True)
+        return jsonify({'started': started, **_reclassify_status}), 202 if started else 409
 
-        # JSONデータをパース
-        category_scores = json.loads(row[1]) if row[1] else {}
-        question_scores = json.loads(row[2]) if row[2] else {}
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
+# 分類ルールファイルを読み直す（管理用、ワーカーごと。各ワーカーはファイルの変更も自動で検知する）
+@app.route('/api/admin/classification/reload', methods=['POST'])
+def admin_reload_classification():
+    try:
+        data = request.get_json(silent=True) or {}
+        reloaded = reload_command_classification(force=bool(data.get('force')))
         return jsonify({
-            'username': username,
-            'technical_score': row[0],
-            'category_scores': category_scores,
-            'question_scores': question_scores,
-            'submitted_at': row[3]
+            'reloaded': reloaded,
+            'rules_version': CLASSIFICATION_RULES.rules_version if CLASSIFICATION_RULES else None,
+            'reclassification': _reclassify_status
         }), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def classify_command(command_name):
-    """Classify a Rhino command into workflow and detail categories"""
-    if not COMMAND_CLASSIFICATION:
-        print("⚠⚠⚠ COMMAND_CLASSIFICATION is not loaded!")
-        return None, None
+# 締まった月のログをアーカイブへ移す（管理用、cron から呼ぶ想定）
+@app.route('/api/admin/archive', methods=['POST'])
+def admin_archive_logs():
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            keep_months = int(data.get('keep_months', ARCHIVE_AFTER_MONTHS))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'keep_months must be an integer'}), 400
+        if keep_months < 0:
+            return jsonify({'error': 'keep_months must not be negative'}), 400
 
-    if not command_name:
-        return None, None
+        result = archive_closed_months(get_db(), keep_months)
+        return jsonify({'status': 'success', **result}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-    # Search in classification_mapping
-    mapping = COMMAND_CLASSIFICATION.get('classification_mapping', {})
-    if command_name in mapping:
-        cmd_info = mapping[command_name]
-        return cmd_info.get('workflow_category'), cmd_info.get('detail_category')
+# アーカイブの状況（ファイル数・行数・サイズ）
+@app.route('/api/admin/archive', methods=['GET'])
+def admin_archive_status():
+    try:
+        return jsonify(archive_summary(get_db())), 200
 
-    return None, None
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-def filter_auto_generated_actions(logs):
+def iter_filter_auto_generated_actions(logs, stats=None, lookahead=()):
     """
     Filter out auto-generated actions that occur immediately after Document Opened.
     These include Layer Created and Layer Modified actions that happen within 2 seconds of document opening.
 
-    Note: Logs should be in chronological order (oldest first) for accurate filtering.
+    Logs must be newest first, as /api/logs returns them. A layer action is decided by the
+    closest Document Opened before it, which comes later in the input, so logs are held back
+    (for at most 2 seconds of logs) until that is known. lookahead continues logs past the end
+    of a page: its logs only decide the held-back layer actions and are never yielded.
+    Works on any iterable and yields lazily, so it can sit inside a streaming response.
+    The number of dropped actions is kept in stats['filtered'] when stats is given.
     """
-    from datetime import datetime, timedelta
+    if stats is None:
+        stats = {}
+    stats['filtered'] = 0
+    held = deque()  # (log, レイヤー操作の時刻 or None)。先頭は常に判定待ちのレイヤー操作
+
+    def parse_time(log):
+        try:
+            return datetime.strptime(log.get('timestamp'), '%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            return None
+
+    def settle(log):
+        """Decide the held layer actions that the (older) log settles; return the logs to release"""
+        released = []
+        if log.get('action') == 'Document Opened':
+            # 判定待ちのレイヤー操作すべての直前の Document Opened
+            open_time = parse_time(log)
+            for held_log, layer_time in held:
+                if (open_time and layer_time
+                        and (layer_time - open_time).total_seconds() <= AUTO_GENERATED_LAYER_SECONDS):
+                    stats['filtered'] += 1
+                else:
+                    released.append(held_log)
+            held.clear()
+            return released
+
+        # 2秒より古い行まで来たら、その後の Document Opened では自動生成にならない
+        current_time = parse_time(log)
+        if current_time:
+            while held and (held[0][1] is None or
+                            (held[0][1] - current_time).total_seconds() > AUTO_GENERATED_LAYER_SECONDS):
+                released.append(held.popleft()[0])
+        return released
 
+    for log in logs:
+        yield from settle(log)
+        layer_time = parse_time(log) if log.get('action') in ('Layer Created', 'Layer Modified') else None
+        if held or layer_time:
+            held.append((log, layer_time))
+        else:
+            yield log
+
+    # ページの末尾で判定待ちのレイヤー操作は続きの行で判定する（続きの行は返さない）
+    for log in lookahead:
+        if not held:
+            break
+        yield from settle(log)
+
+    # 続きがなければ直前に Document Opened はないので残す
+    for log, _ in held:
+        yield log
+
+def filter_auto_generated_actions(logs, stats=None, lookahead=()):
+    """List version of iter_filter_auto_generated_actions"""
+    if stats is None:
+        stats = {}
     if not logs:
+        stats['filtered'] = 0
         return logs
 
-    filtered_logs = []
-    document_open_time = None
-    filtered_count = 0
-
-    for log in logs:
-        action = log.get('action')
-        timestamp_str = log.get('timestamp')
-
-        # Track when documents are opened
-        if action == 'Document Opened':
-            try:
-                document_open_time = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-            except:
-                document_open_time = None
-            filtered_logs.append(log)
-            continue
-
-        # Filter Layer actions that happen within 2 seconds of document opening
-        if document_open_time and action in ['Layer Created', 'Layer Modified']:
-            try:
-                current_time = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                time_diff = (current_time - document_open_time).total_seconds()
-
-                # Skip layer actions within 2 seconds of document opening
-                if time_diff <= 2:
-                    filtered_count += 1
-                    continue
-            except:
-                pass
+    filtered_logs = list(iter_filter_auto_generated_actions(logs, stats, lookahead))
 
-        filtered_logs.append(log)
-
-    if filtered_count > 0:
-        print(f"🧹 Filtered out {filtered_count} auto-generated layer actions")
+    count_diagnostic('auto_generated_filtered', amount=stats['filtered'])
 
     return filtered_logs
 
 # 分類済みログ取得（可視化アプリ用）
 @app.route('/api/logs/classified', methods=['GET'])
+@conditional_cached
 def get_logs_classified():
-    """Get logs with workflow and detail category classification"""
+    """Get logs with workflow and detail category classification (paged like /api/logs)"""
     try:
-        username = request.args.get('username')
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
-        query = 'SELECT timestamp, username, action, detail, document_name FROM logs WHERE 1=1'
-        params = []
+        stream = request.args.get('format') == 'ndjson'
+        try:
+            limit = parse_logs_limit(request.args, None if stream else LOGS_MAX_LIMIT)
+            query, params, archive_filter = build_logs_query(request.args, limit)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
-        if username:
-            query += ' AND username = ?'
-            params.append(username)
+        if stream:
+            return stream_log_rows(query, params, archive_filter, limit, classified_entry_from_row)
 
-        if start_date:
-            query += ' AND timestamp >= ?'
-            params.append(start_date)
-
-        if end_date:
-            query += ' AND timestamp <= ?'
-            params.append(end_date)
-
-        query += ' ORDER BY timestamp DESC LIMIT 10000'
-
-        c.execute(query, params)
-        rows = c.fetchall()
-        conn.close()
+        conn = get_db()
+        c = conn.cursor()
+        rows, next_cursor = fetch_log_page(c, query, params, limit, archive_filter)
 
         # Classify logs
         classified_logs = []
@@ -824,32 +3607,14 @@ def get_logs_classified():
         detail_category_counts = Counter()
 
         for row in rows:
-            timestamp, username, action, detail, document_name = row
-
-            # Extract command name from detail
-            command_name = None
-            if action == 'Command' and detail:
-                command_name = detail.split(';')[0].strip()
-
-            # Classify command
-            workflow_cat, detail_cat = classify_command(command_name) if command_name else (None, None)
-
-            classified_logs.append({
-                'timestamp': timestamp,
-                'username': username,
-                'action': action,
-                'detail': detail,
-                'document_name': document_name,
-                'command': command_name,
-                'workflow_category': workflow_cat,
-                'detail_category': detail_cat
-            })
+            log_entry = classified_entry_from_row(row)
+            classified_logs.append(log_entry)
 
             # Count categories
-            if workflow_cat:
-                workflow_category_counts[workflow_cat] += 1
-            if detail_cat:
-                detail_category_counts[detail_cat] += 1
+            if log_entry['workflow_category']:
+                workflow_category_counts[log_entry['workflow_category']] += 1
+            if log_entry['detail_category']:
+                detail_category_counts[log_entry['detail_category']] += 1
 
         # Get workflow category info
         workflow_categories_info = {}
@@ -862,171 +3627,355 @@ def get_logs_classified():
                     'description': cat_info.get('description')
                 }
 
-        return jsonify({
+        response = jsonify({
             'logs': classified_logs,
             'workflow_category_counts': dict(workflow_category_counts),
             'detail_category_counts': dict(detail_category_counts),
             'workflow_categories_info': workflow_categories_info,
             'total_logs': len(classified_logs),
-            'classified_logs': sum(1 for log in classified_logs if log['workflow_category'])
-        }), 200
+            'classified_logs': sum(1 for log in classified_logs if log['workflow_category']),
+            'next_cursor': next_cursor
+        })
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # ワークフロー統計取得
+WORKFLOW_TIMELINE_LENGTH = 100
+
 @app.route('/api/stats/workflow/<username>', methods=['GET'])
+@conditional_cached
 def get_workflow_stats(username):
     """Get workflow category statistics for a user"""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
 
-        c.execute('''SELECT timestamp, action, detail FROM logs
-                     WHERE username = ?
-                     ORDER BY timestamp ASC''', (username,))
-        rows = c.fetchall()
-        conn.close()
-
-        if not rows:
+        c.execute('SELECT 1 FROM user_daily_stats WHERE username = ? LIMIT 1', (username,))
+        if not c.fetchone():
             return jsonify({'error': 'No logs found for user'}), 404
 
-        # Classify and analyze
-        workflow_stats = Counter()
-        detail_stats = Counter()
-        timeline = []
+        # Last 100 classified commands, oldest first
+        columns = 'id, timestamp, action, workflow_category, detail_category, command, ts_epoch'
+        c.execute(f'''SELECT {columns} FROM logs
+                      WHERE username = ? AND action = 'Command' AND workflow_category IS NOT NULL
+                      ORDER BY ts_epoch DESC, id DESC
+                      LIMIT ?''', (username, WORKFLOW_TIMELINE_LENGTH))
+        rows = merge_archived_rows(conn, c.fetchall(), columns, username, by_epoch=True, descending=True)
+        rows = islice((row for row in rows if row[2] == 'Command' and row[3] is not None), WORKFLOW_TIMELINE_LENGTH)
+        timeline = [timeline_entry(timestamp, workflow_cat, detail_cat, command_name)
+                    for _, timestamp, _, workflow_cat, detail_cat, command_name, _ in reversed(list(rows))]
 
-        for timestamp, action, detail in rows:
-            if action == 'Command' and detail:
-                command_name = detail.split(';')[0].strip()
-                workflow_cat, detail_cat = classify_command(command_name)
+        return jsonify(build_workflow_stats(c, username, timeline)), 200
 
-                # Debug logging
-                if detail_cat:
-                    print(f"✓ Classified '{command_name}': workflow={workflow_cat}, detail={detail_cat}")
-                else:
-                    print(f"✗ No detail_category for '{command_name}'")
-
-                if workflow_cat:
-                    workflow_stats[workflow_cat] += 1
-                if detail_cat:
-                    detail_stats[detail_cat] += 1
-
-                if workflow_cat:
-                    timeline.append({
-                        'timestamp': timestamp,
-                        'workflow_category': workflow_cat,
-                        'detail_category': detail_cat,
-                        'command': command_name
-                    })
-
-        # Get category names
-        workflow_names = {}
-        if COMMAND_CLASSIFICATION:
-            wf_cats = COMMAND_CLASSIFICATION.get('workflow_categories', {})
-            for cat_key, cat_info in wf_cats.items():
-                workflow_names[cat_key] = cat_info.get('name_ja', cat_key)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        print(f"📊 Final stats: workflow_stats={dict(workflow_stats)}, detail_stats={dict(detail_stats)}")
+def timeline_entry(timestamp, workflow_cat, detail_cat, command_name):
+    return {
+        'timestamp': timestamp,
+        'workflow_category': workflow_cat,
+        'detail_category': detail_cat,
+        'command': command_name
+    }
 
-        return jsonify({
-            'username': username,
-            'workflow_category_counts': dict(workflow_stats),
-            'detail_category_counts': dict(detail_stats),
-            'workflow_category_names': workflow_names,
-            'timeline': timeline[-100:],  # Last 100 classified actions
-            'total_classified_actions': len(timeline)
-        }), 200
+def build_workflow_stats(c, username, timeline):
+    """Workflow stats payload: counts from the rollup tables plus the given timeline"""
+    # Counts come from the incrementally maintained rollup (O(days x categories) rows)
+    c.execute('''SELECT workflow_category, SUM(event_count) FROM user_category_stats
+                 WHERE username = ? AND workflow_category != ''
+                 GROUP BY workflow_category''', (username,))
+    workflow_stats = Counter(dict(c.fetchall()))
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    c.execute('''SELECT detail_category, SUM(event_count) FROM user_category_stats
+                 WHERE username = ? AND detail_category != ''
+                 GROUP BY detail_category''', (username,))
+    detail_stats = Counter(dict(c.fetchall()))
+
+    total_classified_actions = sum(workflow_stats.values())
+
+    logger.debug('Workflow stats for %s: workflow_stats=%s, detail_stats=%s',
+                 username, dict(workflow_stats), dict(detail_stats))
+
+    return {
+        'username': username,
+        'workflow_category_counts': dict(workflow_stats),
+        'detail_category_counts': dict(detail_stats),
+        'workflow_category_names': get_workflow_category_names(),
+        'timeline': timeline,  # Last 100 classified actions
+        'total_classified_actions': total_classified_actions
+    }
+
+# アクショングループ（一定時間ごとの作業セッション）
+#
+# グループの最初のアクションから window 分以内のアクションを同じグループにまとめる。
+# ACTION_GROUP_WINDOWS の幅は取り込み時に逐次計算して action_groups に保存し、
+# それ以外の幅はリクエスト時に生ログから計算する。
+ACTION_GROUP_WINDOW_MINUTES = 10
+ACTION_GROUP_WINDOWS = tuple(sorted({ACTION_GROUP_WINDOW_MINUTES} | {
+    int(w) for w in os.environ.get('RHINOLOG_ACTION_GROUP_WINDOWS', '').split(',') if w.strip()}))
+AUTO_GENERATED_LAYER_SECONDS = 2  # Document Opened 直後に自動で発生するレイヤー操作
+ACTION_GROUP_LOG_COLUMNS = '''id, ts_epoch, timestamp, action, detail, document_name,
+                              workflow_category, detail_category'''
+
+def iter_action_groups(rows, window_minutes, document_open_epoch=None):
+    """
+    Sessionize chronological log rows (ACTION_GROUP_LOG_COLUMNS, ordered by ts_epoch, id).
+
+    The auto-generated layer filter (see iter_filter_auto_generated_actions) is applied
+    in-stream. document_open_epoch carries the filter state when resuming mid-history.
+    Yields (start_epoch, end_epoch, actions) per closed group.
+    """
+    window_seconds = window_minutes * 60
+    group_start = group_end = None
+    actions = []
+
+    for _, ts_epoch, timestamp, action, detail, document_name, workflow_cat, detail_cat in rows:
+        if ts_epoch is None:
+            continue
+
+        if action == 'Document Opened':
+            document_open_epoch = ts_epoch
+        elif (document_open_epoch is not None and action in ('Layer Created', 'Layer Modified')
+              and ts_epoch - document_open_epoch <= AUTO_GENERATED_LAYER_SECONDS):
+            continue
+
+        if group_start is not None and ts_epoch - group_start > window_seconds:
+            yield group_start, group_end, actions
+            group_start = None
+
+        if group_start is None:
+            group_start = ts_epoch
+            actions = []
+
+        group_end = ts_epoch
+        actions.append({
+            'timestamp': timestamp,
+            'action': action,
+            'detail': detail,
+            'document_name': document_name,
+            'WorkflowCategory': workflow_cat or 'Unknown',
+            'DetailCategory': detail_cat or 'Unknown'
+        })
+
+    if actions:
+        yield group_start, group_end, actions
+
+def _document_open_epoch_before(c, username, epoch):
+    """Filter state at epoch: the Document Opened still inside the auto-generated window"""
+    c.execute('''SELECT MAX(ts_epoch) FROM logs
+                 WHERE username = ? AND action = 'Document Opened' AND ts_epoch >= ? AND ts_epoch < ?''',
+              (username, epoch - AUTO_GENERATED_LAYER_SECONDS, epoch))
+    live_epoch = c.fetchone()[0]
+    archived = iter_archived_rows(c.connection, 'id, ts_epoch, action', username, by_epoch=True,
+                                  start=epoch - AUTO_GENERATED_LAYER_SECONDS, end=epoch - 1)
+    if archived is None:
+        return live_epoch
+    epochs = [ts_epoch for _, ts_epoch, action in archived if action == 'Document Opened']
+    if live_epoch is not None:
+        epochs.append(live_epoch)
+    return max(epochs, default=None)
+
+def sessionize_user(conn, username, window_minutes, since_epoch=None):
+    """
+    Recompute a user's persisted groups for one window, starting from the group that
+    contains since_epoch (or from scratch). Earlier groups cannot change, so ingest only
+    re-streams the still-open tail of the user's history.
+    """
+    c = conn.cursor()
+    restart_epoch = None
+    if since_epoch is not None:
+        c.execute('''SELECT MAX(start_epoch) FROM action_groups
+                     WHERE username = ? AND window_minutes = ? AND start_epoch <= ?''',
+                  (username, window_minutes, since_epoch))
+        restart_epoch = c.fetchone()[0]
+
+    if restart_epoch is None:
+        c.execute('DELETE FROM action_groups WHERE username = ? AND window_minutes = ?',
+                  (username, window_minutes))
+        document_open_epoch = None
+        c.execute(f'''SELECT {ACTION_GROUP_LOG_COLUMNS} FROM logs
+                      WHERE username = ? AND ts_epoch IS NOT NULL
+                      ORDER BY ts_epoch, id''', (username,))
+    else:
+        c.execute('DELETE FROM action_groups WHERE username = ? AND window_minutes = ? AND start_epoch >= ?',
+                  (username, window_minutes, restart_epoch))
+        document_open_epoch = _document_open_epoch_before(c, username, restart_epoch)
+        c.execute(f'''SELECT {ACTION_GROUP_LOG_COLUMNS} FROM logs
+                      WHERE username = ? AND ts_epoch >= ?
+                      ORDER BY ts_epoch, id''', (username, restart_epoch))
+    rows = merge_archived_rows(conn, c, ACTION_GROUP_LOG_COLUMNS, username, by_epoch=True, start=restart_epoch)
+
+    groups = []
+    for start_epoch, end_epoch, actions in iter_action_groups(rows, window_minutes, document_open_epoch):
+        summary = analyze_action_group(actions, start_epoch, end_epoch)
+        groups.append((username, window_minutes, summary['start_time'], summary['end_time'],
+                       start_epoch, end_epoch, summary['total_actions'],
+                       json.dumps(summary['workflow_categories'], ensure_ascii=False),
+                       json.dumps(summary['detail_categories'], ensure_ascii=False),
+                       summary['dominant_workflow']))
+
+    conn.executemany('''INSERT INTO action_groups
+        (username, window_minutes, start_time, end_time, start_epoch, end_epoch,
+         total_actions, workflow_counts, detail_counts, dominant_workflow)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', groups)
+    return len(groups)
+
+def update_action_groups(c, rows):
+    """Re-sessionize the tail of each user's history touched by freshly inserted rows"""
+    oldest_new_epoch = {}
+    for row in rows:
+        username, ts_epoch = row[1], row[6]
+        if ts_epoch is not None:
+            oldest_new_epoch[username] = min(ts_epoch, oldest_new_epoch.get(username, ts_epoch))
+
+    for username, since_epoch in oldest_new_epoch.items():
+        for window_minutes in ACTION_GROUP_WINDOWS:
+            sessionize_user(c.connection, username, window_minutes, since_epoch)
+
+def rebuild_action_groups(conn):
+    """Recompute every user's persisted groups from the raw logs, one committed user at a time"""
+    usernames = [row[0] for row in conn.execute('SELECT DISTINCT username FROM user_daily_stats')]
+    total = 0
+    for username in usernames:
+        for window_minutes in ACTION_GROUP_WINDOWS:
+            total += sessionize_user(conn, username, window_minutes)
+        conn.commit()
+    # 設定から外れた幅の保存分は使われないので消しておく
+    conn.execute(f'''DELETE FROM action_groups
+                     WHERE window_minutes NOT IN ({','.join('?' * len(ACTION_GROUP_WINDOWS))})''',
+                 ACTION_GROUP_WINDOWS)
+    conn.commit()
+    bump_data_generation(conn)
+    return total
+
+def analyze_action_group(group_actions, start_epoch, end_epoch):
+    """Summarize a single action group (category counts use the stored classification)"""
+    if not group_actions:
+        return None
+
+    workflow_counts = Counter()
+    detail_counts = Counter()
+
+    # 未分類コマンドは classify_command が UNCLASSIFIED_COMMANDS に記録済み
+    for action_dict in group_actions:
+        workflow_cat = action_dict.get('WorkflowCategory', 'Unknown')
+        detail_cat = action_dict.get('DetailCategory', 'Unknown')
+
+        if workflow_cat != 'Unknown':
+            workflow_counts[workflow_cat] += 1
+        if detail_cat != 'Unknown':
+            detail_counts[detail_cat] += 1
+
+    return {
+        'start_time': group_actions[0]['timestamp'],
+        'end_time': group_actions[-1]['timestamp'],
+        'start_epoch': start_epoch,
+        'end_epoch': end_epoch,
+        'total_actions': len(group_actions),
+        'workflow_categories': dict(workflow_counts),
+        'detail_categories': dict(detail_counts),
+        'dominant_workflow': workflow_counts.most_common(1)[0][0] if workflow_counts else None
+    }
+
+def get_workflow_category_names():
+    names = {}
+    if COMMAND_CLASSIFICATION:
+        wf_cats = COMMAND_CLASSIFICATION.get('workflow_categories', {})
+        for cat_key, cat_info in wf_cats.items():
+            names[cat_key] = cat_info.get('name_ja', cat_key)
+    return names
+
+def format_action_group(summary, workflow_names, group_id=None):
+    """API representation of a group summary (same keys the dashboard has always used)"""
+    duration_minutes = (summary['end_epoch'] - summary['start_epoch']) / 60
+    dominant_workflow = summary['dominant_workflow']
+    return {
+        'group_id': group_id,
+        'start_time': summary['start_time'],
+        'end_time': summary['end_time'],
+        'duration_minutes': round(duration_minutes, 2),
+        'total_actions': summary['total_actions'],
+        'actions_per_minute': round(summary['total_actions'] / max(duration_minutes, 0.1), 2),
+        'workflow_categories': summary['workflow_categories'],
+        'workflow_category_names': workflow_names,
+        'detail_categories': summary['detail_categories'],
+        'detail_category_names': DETAIL_CATEGORY_NAMES.copy() if DETAIL_CATEGORY_NAMES else {},
+        'dominant_workflow': workflow_names.get(dominant_workflow, dominant_workflow) if dominant_workflow else 'Unknown'
+    }
+
+def fetch_action_group_summaries(c, username, window_minutes, workflow_names):
+    """Persisted group summaries for one of ACTION_GROUP_WINDOWS, oldest first"""
+    c.execute('''SELECT id, start_time, end_time, start_epoch, end_epoch, total_actions,
+                        workflow_counts, detail_counts, dominant_workflow
+                 FROM action_groups WHERE username = ? AND window_minutes = ?
+                 ORDER BY start_epoch''', (username, window_minutes))
+    groups = []
+    for (group_id, start_time, end_time, start_epoch, end_epoch, total_actions,
+         workflow_counts, detail_counts, dominant_workflow) in c.fetchall():
+        summary = {
+            'start_time': start_time,
+            'end_time': end_time,
+            'start_epoch': start_epoch,
+            'end_epoch': end_epoch,
+            'total_actions': total_actions,
+            'workflow_categories': json.loads(workflow_counts),
+            'detail_categories': json.loads(detail_counts),
+            'dominant_workflow': dominant_workflow
+        }
+        groups.append(format_action_group(summary, workflow_names, group_id))
+    return groups
 
 #  Action Groups API (10-minute intervals)
 @app.route('/api/action-groups/<username>', methods=['GET'])
+@conditional_cached
 def get_action_groups(username):
-    """Get user's actions grouped into 10-minute intervals"""
+    """
+    Get user's action groups (summaries only).
+
+    ?window=<minutes> changes the grouping window (default 10). Windows listed in
+    ACTION_GROUP_WINDOWS are served from the action_groups table, others are computed
+    from the raw logs. ?expand=actions includes every action of every group; otherwise
+    fetch a group's actions via /api/action-groups/<username>/<group_id>/actions.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
+        try:
+            window_minutes = int(request.args.get('window', ACTION_GROUP_WINDOW_MINUTES))
+        except ValueError:
+            return jsonify({'error': 'window must be an integer number of minutes'}), 400
+        if window_minutes <= 0:
+            return jsonify({'error': 'window must be positive'}), 400
+        expand = request.args.get('expand') == 'actions'
+
+        conn = get_db()
         c = conn.cursor()
 
-        c.execute('''SELECT timestamp, action, detail, document_name FROM logs
-                     WHERE username = ?
-                     ORDER BY timestamp ASC''', (username,))
-        rows = c.fetchall()
-        conn.close()
-
-        if not rows:
+        c.execute('SELECT 1 FROM user_daily_stats WHERE username = ? LIMIT 1', (username,))
+        if not c.fetchone():
             return jsonify({'error': 'No logs found for user'}), 404
 
-        # Convert rows to log dictionaries for filtering
-        all_logs = []
-        for timestamp_str, action, detail, document_name in rows:
-            all_logs.append({
-                'timestamp': timestamp_str,
-                'action': action,
-                'detail': detail,
-                'document_name': document_name
-            })
-
-        # Filter out auto-generated actions
-        filtered_logs = filter_auto_generated_actions(all_logs)
-
-        # Group actions into 10-minute intervals
-        groups = []
-        current_group = []
-        group_start_time = None
-        idle_threshold_minutes = 10
-
-        for log in filtered_logs:
-            timestamp_str = log['timestamp']
-            action = log['action']
-            detail = log.get('detail', '')
-            document_name = log.get('document_name', '')
-            try:
-                timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-            except:
-                continue
+        workflow_names = get_workflow_category_names()
 
-            if group_start_time is None:
-                # Start first group
-                group_start_time = timestamp
-                current_group = [{
-                    'timestamp': timestamp_str,
-                    'action': action,
-                    'detail': detail,
-                    'document_name': document_name
-                }]
-            else:
-                # Check if within 10 minutes of group start
-                time_diff_minutes = (timestamp - group_start_time).total_seconds() / 60
-
-                if time_diff_minutes <= idle_threshold_minutes:
-                    # Add to current group
-                    current_group.append({
-                        'timestamp': timestamp_str,
-                        'action': action,
-                        'detail': detail,
-                        'document_name': document_name
-                    })
-                else:
-                    # Save current group and start new one
-                    if current_group:
-                        groups.append(analyze_action_group(current_group, group_start_time))
-
-                    group_start_time = timestamp
-                    current_group = [{
-                        'timestamp': timestamp_str,
-                        'action': action,
-                        'detail': detail,
-                        'document_name': document_name
-                    }]
-
-        # Don't forget last group
-        if current_group:
-            groups.append(analyze_action_group(current_group, group_start_time))
+        if window_minutes in ACTION_GROUP_WINDOWS and not expand:
+            groups = fetch_action_group_summaries(c, username, window_minutes, workflow_names)
+        else:
+            groups = []
+            c.execute(f'''SELECT {ACTION_GROUP_LOG_COLUMNS} FROM logs
+                          WHERE username = ? AND ts_epoch IS NOT NULL
+                          ORDER BY ts_epoch, id''', (username,))
+            rows = merge_archived_rows(conn, c, ACTION_GROUP_LOG_COLUMNS, username, by_epoch=True)
+            for start_epoch, end_epoch, actions in iter_action_groups(rows, window_minutes):
+                group = format_action_group(analyze_action_group(actions, start_epoch, end_epoch), workflow_names)
+                if expand:
+                    group['actions'] = actions
+                groups.append(group)
 
         return jsonify({
             'username': username,
+            'window_minutes': window_minutes,
             'total_groups': len(groups),
             'groups': groups
         }), 200
@@ -1034,106 +3983,185 @@ def get_action_groups(username):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def analyze_action_group(group_actions, start_time):
-    """Analyze a single 10-minute action group"""
-    if not group_actions:
-        return None
+# アクショングループ内のアクション一覧（ダッシュボードで展開したときに取得）
+@app.route('/api/action-groups/<username>/<int:group_id>/actions', methods=['GET'])
+def get_action_group_actions(username, group_id):
+    """Get the (filtered) actions of one persisted group, optionally only the first ?limit="""
+    try:
+        limit = request.args.get('limit')
+        try:
+            limit = int(limit) if limit is not None else None
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
 
-    # Calculate basic metrics
-    end_time = datetime.strptime(group_actions[-1]['timestamp'], '%Y-%m-%d %H:%M:%S')
-    duration_minutes = (end_time - start_time).total_seconds() / 60
-    total_actions = len(group_actions)
+        conn = get_db()
+        c = conn.cursor()
 
-    # Analyze workflow categories
-    workflow_counts = Counter()
-    detail_counts = Counter()
+        c.execute('''SELECT window_minutes, start_epoch, end_epoch, total_actions FROM action_groups
+                     WHERE id = ? AND username = ?''', (group_id, username))
+        row = c.fetchone()
+        if not row:
+            return jsonify({'error': 'Action group not found'}), 404
+        window_minutes, start_epoch, end_epoch, total_actions = row
+
+        document_open_epoch = _document_open_epoch_before(c, username, start_epoch)
+        c.execute(f'''SELECT {ACTION_GROUP_LOG_COLUMNS} FROM logs
+                      WHERE username = ? AND ts_epoch >= ? AND ts_epoch <= ?
+                      ORDER BY ts_epoch, id''', (username, start_epoch, end_epoch))
+        rows = merge_archived_rows(conn, c, ACTION_GROUP_LOG_COLUMNS, username, by_epoch=True,
+                                   start=start_epoch, end=end_epoch)
+        actions = []
+        for _, _, group_actions in iter_action_groups(rows, window_minutes, document_open_epoch):
+            actions.extend(group_actions)
 
-    for action_dict in group_actions:
-        action = action_dict['action']
-        detail = action_dict.get('detail', '')
+        return jsonify({
+            'username': username,
+            'group_id': group_id,
+            'total_actions': total_actions,
+            'actions': actions[:limit] if limit is not None else actions
+        }), 200
 
-        # Classify command or layer operation
-        if action == 'Command' and detail:
-            command_name = detail.split(';')[0].strip()
-            workflow_cat, detail_cat = classify_command(command_name)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-            # Debug logging
-            if not detail_cat:
-                print(f"⚠ No classification for command: '{command_name}' (from detail: '{detail}')")
-            else:
-                print(f"✓ Classified '{command_name}': workflow={workflow_cat}, detail={detail_cat}")
+# ユーザーダッシュボード（プロフィール・最近のログ・ワークフロー統計・アクショングループを1回で取得）
+DASHBOARD_FIELDS = ('profile', 'logs', 'workflow_stats', 'action_groups')
+DASHBOARD_RECENT_LOGS = 100
 
-            # Add categories to action data
-            action_dict['WorkflowCategory'] = workflow_cat if workflow_cat else 'Unknown'
-            action_dict['DetailCategory'] = detail_cat if detail_cat else 'Unknown'
+def scan_recent_activity(c, username, logs_limit, timeline_limit):
+    """
+    One newest-first pass over the user's logs that fills both the recent-actions list
+    (auto-generated layer actions filtered, like /api/logs) and the workflow timeline
+    (last classified commands, like /api/stats/workflow). Stops as soon as both are full.
+    """
+    c.execute(f'''SELECT {LOG_QUERY_COLUMNS} FROM logs WHERE username = ?
+                  ORDER BY ts_epoch DESC, id DESC''', (username,))
+    rows = merge_archived_rows(c.connection, c, LOG_QUERY_COLUMNS, username, by_epoch=True, descending=True)
+    timeline = []
 
-            if workflow_cat:
-                workflow_counts[workflow_cat] += 1
-            if detail_cat:
-                detail_counts[detail_cat] += 1
-        elif action in ['Layer Created', 'Layer Modified', 'Layer Deleted']:
-            # Classify layer operations as organization/layer_organization
-            workflow_cat = 'organization'
-            detail_cat = 'layer_organization'
+    def entries():
+        for row in rows:
+            _, timestamp, _, action, _, _, command_name, workflow_cat, detail_cat, _ = row
+            if len(timeline) < timeline_limit and action == 'Command' and workflow_cat is not None:
+                timeline.append(timeline_entry(timestamp, workflow_cat, detail_cat, command_name))
+            yield log_entry_from_row(row)
+
+    logs = []
+    stats = {}
+    for log_entry in iter_filter_auto_generated_actions(entries(), stats):
+        if len(logs) < logs_limit:
+            logs.append(log_entry)
+        elif len(timeline) >= timeline_limit:
+            break
+    count_diagnostic('auto_generated_filtered', amount=stats.get('filtered', 0))
 
-            action_dict['WorkflowCategory'] = workflow_cat
-            action_dict['DetailCategory'] = detail_cat
+    timeline.reverse()
+    return logs, timeline
 
-            workflow_counts[workflow_cat] += 1
-            detail_counts[detail_cat] += 1
-        elif action in ['Document Opened', 'Document Closed']:
-            # Classify document operations as data_management/file_open_close
-            workflow_cat = 'data_management'
-            detail_cat = 'file_open_close'
+@app.route('/api/dashboard/<username>', methods=['GET'])
+def get_dashboard(username):
+    """
+    Everything the user dashboard shows in one request.
 
-            action_dict['WorkflowCategory'] = workflow_cat
-            action_dict['DetailCategory'] = detail_cat
+    ?fields=profile,logs,workflow_stats,action_groups selects sections (default: all).
+    ?logs_limit= sets the number of recent logs (default 100). Logs are scanned once for
+    both the recent actions and the workflow timeline; counts and action groups come
+    from the rollup and action_groups tables. Sections without logs are null.
+    """
+    try:
+        fields = [f.strip() for f in request.args.get('fields', ','.join(DASHBOARD_FIELDS)).split(',') if f.strip()]
+        unknown = [f for f in fields if f not in DASHBOARD_FIELDS]
+        if unknown:
+            return jsonify({'error': f'Unknown fields: {", ".join(unknown)}'}), 400
+        try:
+            logs_limit = min(int(request.args.get('logs_limit', DASHBOARD_RECENT_LOGS)), LOGS_MAX_LIMIT)
+        except ValueError:
+            return jsonify({'error': 'logs_limit must be an integer'}), 400
+        if logs_limit < 1:
+            return jsonify({'error': 'logs_limit must be positive'}), 400
+
+        conn = get_db()
+        c = conn.cursor()
 
-            workflow_counts[workflow_cat] += 1
-            detail_counts[detail_cat] += 1
-        else:
-            # For other non-command actions, set as Unknown
-            action_dict['WorkflowCategory'] = 'Unknown'
-            action_dict['DetailCategory'] = 'Unknown'
+        profile = fetch_user_profile(c, username)
+        if not profile:
+            return jsonify({'error': 'User not found', 'registered': False}), 404
 
-    # Get workflow category names
-    workflow_names = {}
-    if COMMAND_CLASSIFICATION:
-        wf_cats = COMMAND_CLASSIFICATION.get('workflow_categories', {})
-        for cat_key, cat_info in wf_cats.items():
-            workflow_names[cat_key] = cat_info.get('name_ja', cat_key)
-
-    # Get detail category names
-    detail_names = {}
-    if DETAIL_CATEGORY_NAMES:
-        detail_names = DETAIL_CATEGORY_NAMES.copy()
-
-    # Determine dominant activity
-    dominant_workflow = None
-    if workflow_counts:
-        dominant_workflow = workflow_counts.most_common(1)[0][0]
-
-    # Debug output
-    print(f"📊 Group analysis complete:")
-    print(f"   Workflow counts: {dict(workflow_counts)}")
-    print(f"   Detail counts: {dict(detail_counts)}")
-    print(f"   Total actions processed: {total_actions}")
-    print(f"   COMMAND_CLASSIFICATION loaded: {COMMAND_CLASSIFICATION is not None}")
-    print(f"   DETAIL_CATEGORY_NAMES loaded: {DETAIL_CATEGORY_NAMES is not None}")
+        c.execute('''SELECT COALESCE(SUM(total_events), 0), MAX(last_timestamp)
+                     FROM user_daily_stats WHERE username = ?''', (username,))
+        total_actions, last_active = c.fetchone()
+        has_logs = last_active is not None
 
-    return {
-        'start_time': start_time.strftime('%Y-%m-%d %H:%M:%S'),
-        'end_time': end_time.strftime('%Y-%m-%d %H:%M:%S'),
-        'duration_minutes': round(duration_minutes, 2),
-        'total_actions': total_actions,
-        'actions_per_minute': round(total_actions / max(duration_minutes, 0.1), 2),
-        'workflow_categories': dict(workflow_counts),
-        'workflow_category_names': workflow_names,
-        'detail_categories': dict(detail_counts),
-        'detail_category_names': detail_names,
-        'dominant_workflow': workflow_names.get(dominant_workflow, dominant_workflow) if dominant_workflow else 'Unknown',
-        'actions': group_actions
-    }
+        result = {
+            'username': username,
+            'total_actions': total_actions,
+            'last_active': last_active
+        }
+
+        if 'profile' in fields:
+            result['profile'] = profile
+
+        logs, timeline = [], []
+        if has_logs and ('logs' in fields or 'workflow_stats' in fields):
+            logs, timeline = scan_recent_activity(
+                c, username,
+                logs_limit if 'logs' in fields else 0,
+                WORKFLOW_TIMELINE_LENGTH if 'workflow_stats' in fields else 0)
+
+        if 'logs' in fields:
+            result['logs'] = logs
+
+        if 'workflow_stats' in fields:
+            result['workflow_stats'] = build_workflow_stats(c, username, timeline) if has_logs else None
+
+        if 'action_groups' in fields:
+            result['action_groups'] = None
+            if has_logs:
+                groups = fetch_action_group_summaries(c, username, ACTION_GROUP_WINDOW_MINUTES,
+                                                      get_workflow_category_names())
+                result['action_groups'] = {
+                    'username': username,
+                    'window_minutes': ACTION_GROUP_WINDOW_MINUTES,
+                    'total_groups': len(groups),
+                    'groups': groups
+                }
+
+        return jsonify(result), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@METRICS.collector
+def collect_runtime_metrics():
+    lookup = _lookup_command.cache_info()
+    cache = RESPONSE_CACHE.stats()
+    samples = [
+        ('counter', 'rhinolog_command_lookup_cache_hits_total', (), lookup.hits + _lookup_cache_cleared['hits']),
+        ('counter', 'rhinolog_command_lookup_cache_misses_total', (),
+         lookup.misses + _lookup_cache_cleared['misses']),
+        ('counter', 'rhinolog_response_cache_hits_total', (), cache['hits']),
+        ('counter', 'rhinolog_response_cache_misses_total', (), cache['misses']),
+        ('gauge', 'rhinolog_response_cache_entries', (), cache['entries']),
+    ]
+    if INGEST_ASYNC:
+        ingest = get_ingest_writer().health()
+        samples += [
+            ('gauge', 'rhinolog_ingest_queue_depth', (), ingest['queue_depth']),
+            ('counter', 'rhinolog_ingest_commits_total', (), ingest['commits']),
+            ('counter', 'rhinolog_ingest_rejected_full_total', (), ingest['rejected_full']),
+            ('counter', 'rhinolog_ingest_failed_events_total', (), ingest['failed_events']),
+        ]
+    return samples
+
+# メトリクス（Prometheus）
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if METRICS_DIR:
+        flush_metrics()
+        snapshots = read_worker_snapshots()
+    else:
+        snapshots = [METRICS.snapshot()]
+    return Response(render_metrics(snapshots), mimetype='text/plain; version=0.0.4')
 
 # ヘルスチェック
 @app.route('/api/health', methods=['GET'])
@@ -1144,7 +4172,11 @@ def health_check():
         'classification_loaded': COMMAND_CLASSIFICATION is not None,
         'total_commands': len(COMMAND_CLASSIFICATION.get('classification_mapping', {})) if COMMAND_CLASSIFICATION else 0,
         'detail_names_loaded': DETAIL_CATEGORY_NAMES is not None,
-        'total_detail_categories': len(DETAIL_CATEGORY_NAMES) if DETAIL_CATEGORY_NAMES else 0
+        'total_detail_categories': len(DETAIL_CATEGORY_NAMES) if DETAIL_CATEGORY_NAMES else 0,
+        'rules_version': CLASSIFICATION_RULES.rules_version if CLASSIFICATION_RULES else None,
+        'reclassification': _reclassify_status,
+        'response_cache': RESPONSE_CACHE.stats(),
+        'ingest': ingest_health()
     }), 200
 
 # Debug endpoint to check classification status
@@ -1156,6 +4188,8 @@ def debug_classification():
         'detail_names_loaded': DETAIL_CATEGORY_NAMES is not None,
         'total_commands': len(COMMAND_CLASSIFICATION.get('classification_mapping', {})) if COMMAND_CLASSIFICATION else 0,
         'total_detail_categories': len(DETAIL_CATEGORY_NAMES) if DETAIL_CATEGORY_NAMES else 0,
+        'rules_version': CLASSIFICATION_RULES.rules_version if CLASSIFICATION_RULES else None,
+        'rules_source': CLASSIFICATION_RULES.source_path if CLASSIFICATION_RULES else None,
         'sample_classifications': {
             'Box': classify_command('Box'),
             'Move': classify_command('Move'),
@@ -1163,45 +4197,65 @@ def debug_classification():
         }
     }), 200
 
+# Debug endpoint to list commands that could not be classified
+@app.route('/api/debug/unclassified', methods=['GET'])
+def debug_unclassified():
+    """Commands that fell through classification since the rules were loaded, most frequent first"""
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    cache_info = _lookup_command.cache_info()
+    return jsonify({
+        'total_misses': sum(UNCLASSIFIED_COMMANDS.values()),
+        'distinct_commands': len(UNCLASSIFIED_COMMANDS),
+        'commands': [{'command': name, 'count': count}
+                     for name, count in UNCLASSIFIED_COMMANDS.most_common(limit)],
+        'lookup_cache': {'hits': cache_info.hits, 'misses': cache_info.misses,
+                         'size': cache_info.currsize, 'max_size': cache_info.maxsize}
+    }), 200
+
 # Debug endpoint to check actual log data
 @app.route('/api/debug/sample-logs', methods=['GET'])
 def debug_sample_logs():
     """Debug endpoint to see actual log data from database"""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
 
         # First, check what action types exist
-        c.execute('''SELECT DISTINCT action FROM logs LIMIT 20''')
+        c.execute('''SELECT DISTINCT action FROM logs ORDER BY action LIMIT 20''')
         action_types = [row[0] for row in c.fetchall()]
 
         # Get total log count
-        c.execute('''SELECT COUNT(*) FROM logs''')
+        c.execute('''SELECT COUNT(*) FROM log_events''')
         total_logs = c.fetchone()[0]
 
         # Get 10 recent logs regardless of action type
-        c.execute('''SELECT timestamp, username, action, detail, document_name
+        c.execute('''SELECT timestamp, username, action, detail, document_name,
+                            workflow_category, detail_category
                      FROM logs
-                     ORDER BY timestamp DESC
+                     ORDER BY ts_epoch DESC, id DESC
                      LIMIT 10''')
         all_rows = c.fetchall()
 
         # Get 10 "Command" logs
-        c.execute('''SELECT timestamp, username, action, detail, document_name
+        c.execute('''SELECT timestamp, username, action, detail, document_name,
+                            workflow_category, detail_category
                      FROM logs
-                     WHERE action = "Command"
-                     ORDER BY timestamp DESC
+                     WHERE action = 'Command'
+                     ORDER BY ts_epoch DESC, id DESC
                      LIMIT 10''')
         command_rows = c.fetchall()
 
-        conn.close()
-
         # Process all logs
         all_samples = []
         for row in all_rows:
-            timestamp, username, action, detail, document_name = row
+            timestamp, username, action, detail, document_name, workflow_cat, detail_cat = row
             command_name = detail.split(';')[0].strip() if detail else None
-            workflow_cat, detail_cat = classify_command(command_name) if command_name and action == 'Command' else (None, None)
+            if not (command_name and action == 'Command'):
+                workflow_cat, detail_cat = None, None
 
             all_samples.append({
                 'timestamp': timestamp,
@@ -1216,9 +4270,8 @@ def debug_sample_logs():
         # Process command logs
         command_samples = []
         for row in command_rows:
-            timestamp, username, action, detail, document_name = row
+            timestamp, username, action, detail, document_name, workflow_cat, detail_cat = row
             command_name = detail.split(';')[0].strip() if detail else None
-            workflow_cat, detail_cat = classify_command(command_name) if command_name else (None, None)
 
             command_samples.append({
                 'timestamp': timestamp,
@@ -1254,6 +4307,69 @@ def debug_sample_logs():
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    init_db()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='GEL Training Log API server')
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help='recompute the rollup tables from raw logs, report mismatches and exit')
+    parser.add_argument('--archive', action='store_true',
+                        help='move closed months out of the logs table into compressed archive files and exit')
+    parser.add_argument('--keep-months', type=int, default=ARCHIVE_AFTER_MONTHS,
+                        help='months (besides the current one) kept in the logs table by --archive')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='VACUUM the database (after --archive when given) and exit; blocks writers while it runs')
+    parser.add_argument('--relevel', action='store_true',
+                        help='recompute every user\'s scores and level with the current scoring rules and exit')
+    parser.add_argument('--dry-run', action='store_true', help='with --relevel, report the changes without writing')
+    parser.add_argument('--replay-ingest-spool', action='store_true',
+                        help='insert the events the async ingest writer could not commit and exit')
+    args = parser.parse_args()
+
     load_command_classification()  # Load classification data on startup
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    init_db()
+
+    if args.rebuild_rollups:
+        with db_connection() as conn:
+            result = rebuild_rollups(conn)
+        print(f"✓ Rollups rebuilt: {result['category_rows']} category rows, {result['daily_rows']} daily rows, "
+              f"{result['command_rows']} command rows, {result['mismatched_rows']} mismatched rows fixed")
+    elif args.archive:
+        with db_connection() as conn:
+            result = archive_closed_months(conn, args.keep_months)
+            if args.vacuum:
+                conn.execute('VACUUM')
+        archive = result['archive']
+        print(f"✓ Archived {result['archived_rows']} log rows from {result['archived_user_months']} user-months "
+              f"before {result['cutoff_month']} (archive: {archive['files']} files, {archive['rows']} rows, "
+              f"{archive['bytes'] / 1e6:.1f} MB)")
+    elif args.relevel:
+        with db_connection() as conn:
+            result = relevel_users(conn, dry_run=args.dry_run)
+        transitions = ', '.join(f'L{change.replace("->", " -> L")}: {count}'
+                                for change, count in result['transitions'].items())
+        print(f"✓ Scoring rules v{result['scoring_rules_version']}{' (dry run)' if args.dry_run else ''}: "
+              f"{result['level_changes']} of {result['users_scanned']} users "
+              f"{'would change' if args.dry_run else 'changed'} level{f' ({transitions})' if transitions else ''}, "
+              f"{result['users_updated']} users and {result['screening_results_updated']} screening results "
+              f"{'to update' if args.dry_run else 'updated'}")
+        for change in result['sample']:
+            print(f"  {change['username']}: L{change['user_level']} -> L{change['new_user_level']}")
+    elif args.vacuum:
+        with db_connection() as conn:
+            conn.execute('VACUUM')
+        print(f"✓ Vacuumed {DB_PATH} ({os.path.getsize(DB_PATH) / 1e6:.1f} MB)")
+    elif args.replay_ingest_spool:
+        with db_connection() as conn:
+            result = replay_ingest_spool(conn)
+        print(f"✓ Replayed {result['files']} spool files: {result['events']} events inserted, "
+              f"{result['duplicates']} already stored")
+        for failed in result['failed_files']:
+            print(f"  ✗ {failed['file']}: {failed['error']}")
+    else:
+        with db_connection() as conn:
+            stale_users = count_stale_scores(conn)
+        if stale_users:
+            logger.warning('%d users were scored with older scoring rules; run --relevel --dry-run to review',
+                           stale_users)
+        start_reclassification_job()  # Backfill/refresh stored categories if the rules changed
+        app.run(host='0.0.0.0', port=5000, debug=False)
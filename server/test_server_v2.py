@@ -0,0 +1,465 @@
+"""
+Regression tests for server_v2 (each test runs against a fresh database in a temp directory):
+
+    cd server && python3 -m pytest -q test_server_v2.py
+"""
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date
+from unittest import mock
+
+import server_v2
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self._saved = (server_v2.DB_PATH, server_v2.LOG_BASE_DIR, server_v2.INGEST_ASYNC)
+        server_v2.DB_PATH = os.path.join(self.tmpdir, 'rhinolog.db')
+        server_v2.LOG_BASE_DIR = self.tmpdir
+        server_v2.INGEST_ASYNC = False
+        # 辞書 id のキャッシュはプロセス全体で1つなので、前のテストの DB の id を持ち越さない
+        for ids in server_v2._dictionary_ids.values():
+            ids.clear()
+        server_v2.init_db()
+        server_v2.load_command_classification()
+        self.client = server_v2.app.test_client()
+        self.register('alice')
+
+    def tearDown(self):
+        server_v2.DB_PATH, server_v2.LOG_BASE_DIR, server_v2.INGEST_ASYNC = self._saved
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def register(self, username, **fields):
+        response = self.client.post('/api/user/register', json=dict({
+            'username': username, 'full_name': username, 'email': f'{username}@example.com',
+            'start_date': '2025-01-01', 'end_date': '2025-12-31'}, **fields))
+        self.assertEqual(response.status_code, 200, response.json)
+
+    def event(self, second, **fields):
+        return dict({'Timestamp': f'2025-11-13 10:00:{second:02d}', 'UserID': 'alice',
+                     'Action': 'Command', 'Detail': 'Box', 'DocumentName': 'D'}, **fields)
+
+    def count_logs(self):
+        with sqlite3.connect(server_v2.DB_PATH) as conn:
+            return conn.execute('SELECT COUNT(*) FROM logs').fetchone()[0]
+
+
+class EventIdTest(ServerTestCase):
+    def test_identical_single_uploads_without_event_id_are_kept(self):
+        for _ in range(2):
+            response = self.client.post('/api/log/upload', json=self.event(1))
+            self.assertEqual(response.json['status'], 'success')
+        self.assertEqual(self.count_logs(), 2)
+
+    def test_identical_batch_events_without_event_id_are_kept(self):
+        for _ in range(2):
+            response = self.client.post('/api/log/upload/batch', json=[self.event(1), self.event(1)])
+            self.assertEqual(response.json['duplicates'], 0)
+        self.assertEqual(self.count_logs(), 4)
+
+    def test_resent_event_id_is_duplicate(self):
+        batch = [self.event(1, EventId='a'), self.event(2, EventId='b'), self.event(3, EventId='a')]
+        first = self.client.post('/api/log/upload/batch', json=batch).json
+        self.assertEqual((first['accepted'], first['duplicates']), (2, 1))
+        second = self.client.post('/api/log/upload/batch', json=batch).json
+        self.assertEqual((second['accepted'], second['duplicates']), (0, 3))
+        single = self.client.post('/api/log/upload', json=self.event(4, EventId='b')).json
+        self.assertEqual(single['status'], 'duplicate')
+        self.assertEqual(self.count_logs(), 2)
+
+    def test_resent_event_id_is_duplicate_after_archiving(self):
+        batch = [self.event(1, EventId='a'), self.event(2, EventId='b'), self.event(3)]
+        self.client.post('/api/log/upload/batch', json=batch)
+        with server_v2.db_connection() as conn:
+            result = server_v2.archive_closed_months(conn, keep_months=0, today=date(2026, 1, 15))
+        self.assertEqual(result['archived_rows'], 3)
+        self.assertEqual(self.count_logs(), 0)
+
+        resent = self.client.post('/api/log/upload/batch', json=batch).json
+        self.assertEqual((resent['accepted'], resent['duplicates']), (1, 2))
+        self.assertEqual(self.count_logs(), 1)
+
+    def test_batch_reports_status_of_every_event(self):
+        self.client.post('/api/log/upload', json=self.event(1, EventId='sent'))
+        response = self.client.post('/api/log/upload/batch', json=[
+            self.event(2, EventId='new'), self.event(3, EventId='sent'), {'Timestamp': '2025-11-13 10:00:04'},
+            self.event(5, UserID='ghost'), 'not an object', self.event(6)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json['accepted'], response.json['duplicates'], response.json['rejected']),
+                         (2, 1, 3))
+        results = response.json['results']
+        self.assertEqual([result['index'] for result in results], list(range(6)))
+        self.assertEqual([result['status'] for result in results],
+                         ['accepted', 'duplicate', 'rejected', 'rejected', 'rejected', 'accepted'])
+        self.assertEqual(results[3]['error'], 'User not registered')
+        self.assertTrue(results[2]['error'].startswith('Missing field'))
+        self.assertEqual(self.count_logs(), 3)
+
+
+class LogPagingTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        # Document Opened の直後（2秒以内）と少し後のレイヤー操作を、ページの境目をまたぐように並べる
+        events = []
+        for minute in range(12):
+            pattern = [(0, 'Document Opened'), (1, 'Layer Created'), (2, 'Layer Modified'),
+                       (2, 'Layer Created'), (5, 'Layer Modified'), (7, 'Command')]
+            for second, action in pattern[:3 + minute % 4]:
+                events.append(self.event(0, Timestamp=f'2025-11-13 10:{minute:02d}:{second:02d}',
+                                         Action=action, Detail=f'{action} {minute}'))
+        response = self.client.post('/api/log/upload/batch', json=events)
+        self.assertEqual(response.json['accepted'], len(events))
+
+    def fetch_pages(self, limit, ndjson=False):
+        entries = []
+        cursor = None
+        while True:
+            query = {'username': 'alice', 'limit': limit}
+            if ndjson:
+                query['format'] = 'ndjson'
+            if cursor:
+                query['cursor'] = cursor
+            response = self.client.get('/api/logs', query_string=query)
+            self.assertEqual(response.status_code, 200)
+            if ndjson:
+                lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+                cursor = lines.pop()['next_cursor'] if lines and 'next_cursor' in lines[-1] else None
+                entries.extend(lines)
+            else:
+                entries.extend(response.json)
+                cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                return entries
+
+    def test_concatenated_pages_equal_unpaged_result(self):
+        unpaged = self.client.get('/api/logs', query_string={'username': 'alice'}).json
+        self.assertLess(len(unpaged), 12 * 4.5)  # 自動生成のレイヤー操作が落ちている
+        for limit in (1, 2, 3, 5, 7, 50):
+            self.assertEqual(self.fetch_pages(limit), unpaged, f'limit={limit}')
+            self.assertEqual(self.fetch_pages(limit, ndjson=True), unpaged, f'ndjson limit={limit}')
+
+    def test_only_layer_actions_within_two_seconds_after_document_opened_are_dropped(self):
+        # 残るのは Document Opened の5秒後の Layer Modified だけ（minute % 4 が 2, 3 の分）
+        expected = [f'2025-11-13 10:{minute:02d}:05' for minute in reversed(range(12)) if minute % 4 >= 2]
+        for limit in (1, 2, 4, 5, 50):
+            for ndjson in (False, True):
+                layers = [entry['timestamp'] for entry in self.fetch_pages(limit, ndjson)
+                          if entry['action'].startswith('Layer')]
+                self.assertEqual(layers, expected, f'limit={limit} ndjson={ndjson}')
+
+        # ダッシュボードの最近のログも同じフィルタ
+        dashboard = self.client.get('/api/dashboard/alice', query_string={'fields': 'logs', 'logs_limit': 5}).json
+        self.assertEqual([(entry['action'], entry['timestamp']) for entry in dashboard['logs']],
+                         [('Command', '2025-11-13 10:11:07'), ('Layer Modified', '2025-11-13 10:11:05'),
+                          ('Document Opened', '2025-11-13 10:11:00'), ('Layer Modified', '2025-11-13 10:10:05'),
+                          ('Document Opened', '2025-11-13 10:10:00')])
+
+
+class ConditionalGetTest(ServerTestCase):
+    def get(self, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get('/api/stats/workflow/alice', headers=headers)
+
+    def test_etag_revalidates_until_logs_or_derived_data_change(self):
+        self.client.post('/api/log/upload', json=self.event(1))
+        first = self.get()
+        self.assertEqual(first.status_code, 200)
+        self.assertIsNone(first.headers.get('Last-Modified'))
+        etag = first.headers['ETag']
+        self.assertEqual(self.get(etag).status_code, 304)
+
+        # 新しいログ
+        self.client.post('/api/log/upload', json=self.event(2, Detail='Line'))
+        second = self.get(etag)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(sum(second.json['workflow_category_counts'].values()), 2)
+        etag = second.headers['ETag']
+        self.assertEqual(self.get(etag).status_code, 304)
+
+        # ログは増えていないが集計を作り直した
+        self.assertEqual(self.client.post('/api/admin/rollups/rebuild').status_code, 200)
+        self.assertEqual(self.get(etag).status_code, 200)
+
+
+
+class UserListTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        for username, group in (('bob', 'B'), ('carol', 'A'), ('dave', 'A')):
+            self.register(username, learning_group=group)
+        with server_v2.db_connection() as conn:
+            conn.execute("UPDATE users SET learning_group = 'A' WHERE username = 'alice'")
+            conn.executemany('UPDATE users SET user_level = ? WHERE username = ?',
+                             [(1, 'alice'), (2, 'bob'), (3, 'carol'), (1, 'dave')])
+            conn.commit()
+        self.client.post('/api/log/upload/batch', json=[self.event(second) for second in range(3)])
+        self.client.post('/api/log/upload', json=self.event(0, UserID='carol', Timestamp='2025-11-20 09:00:00'))
+
+    def get(self, **query):
+        response = self.client.get('/api/users', query_string=query)
+        self.assertEqual(response.status_code, 200, response.json)
+        return [user['username'] for user in response.json], int(response.headers['X-Total-Count'])
+
+    def test_filters(self):
+        self.assertEqual(self.get(group='A'), (['alice', 'carol', 'dave'], 3))
+        self.assertEqual(self.get(level='2,3'), (['bob', 'carol'], 2))
+        self.assertEqual(self.get(group='A', level='1'), (['alice', 'dave'], 2))
+        # 期間内に操作したユーザーだけ。event_count もその期間で数える
+        self.assertEqual(self.get(**{'from': '2025-11-14'}), (['carol'], 1))
+        self.assertEqual(self.get(to='2025-11-13'), (['alice'], 1))
+        users = self.client.get('/api/users', query_string={'from': '2025-11-01', 'to': '2025-11-30'}).json
+        self.assertEqual({user['username']: user['event_count'] for user in users}, {'alice': 3, 'carol': 1})
+
+    def test_sort_and_paging(self):
+        self.assertEqual(self.get(sort='-event_count', limit=2), (['alice', 'carol'], 4))
+        self.assertEqual(self.get(sort='-event_count', limit=2, offset=2), (['bob', 'dave'], 4))
+        self.assertEqual(self.get(sort='username', offset=3), (['dave'], 4))
+        self.assertEqual(self.get(sort='-username', limit=1), (['dave'], 4))
+
+    def test_fields_and_bad_parameters(self):
+        users = self.client.get('/api/users', query_string={'fields': 'email', 'limit': 1}).json
+        self.assertEqual(users, [{'username': 'alice', 'email': 'alice@example.com'}])
+        for query in ({'fields': 'password'}, {'sort': 'password'}, {'level': 'x'},
+                      {'from': '2025/11/01'}, {'limit': 0}, {'offset': -1}):
+            self.assertEqual(self.client.get('/api/users', query_string=query).status_code, 400, query)
+
+
+class RelevelTest(ServerTestCase):
+    def user_level(self):
+        with sqlite3.connect(server_v2.DB_PATH) as conn:
+            return conn.execute("SELECT user_level, scoring_version FROM users WHERE username = 'alice'").fetchone()
+
+    def relevel(self, **body):
+        response = self.client.post('/api/admin/scoring/relevel', json=body)
+        self.assertEqual(response.status_code, 200, response.json)
+        return response.json
+
+    def test_dry_run_reports_changes_without_writing(self):
+        level, version = self.user_level()
+        self.assertEqual(version, server_v2.SCORING_RULES_VERSION)
+        # 古いルールで計算されたままのレベル
+        with server_v2.db_connection() as conn:
+            conn.execute("UPDATE users SET user_level = 99, scoring_version = NULL WHERE username = 'alice'")
+            conn.commit()
+
+        dry_run = self.relevel(dry_run=True)
+        self.assertEqual((dry_run['dry_run'], dry_run['users_updated'], dry_run['level_changes']), (True, 1, 1))
+        self.assertEqual(dry_run['transitions'], {f'99->{level}': 1})
+        self.assertEqual(dry_run['sample'][0]['username'], 'alice')
+        self.assertEqual(self.user_level(), (99, None))
+        self.assertEqual(self.client.get('/api/admin/scoring').json['stale_users'], 1)
+
+        applied = self.relevel()
+        self.assertFalse(applied.pop('dry_run'))
+        dry_run.pop('dry_run')
+        self.assertEqual(applied, dry_run)
+        self.assertEqual(self.user_level(), (level, server_v2.SCORING_RULES_VERSION))
+        self.assertEqual(self.client.get('/api/admin/scoring').json['stale_users'], 0)
+        self.assertEqual(self.relevel(dry_run=True)['users_updated'], 0)
+        self.assertEqual(self.client.post('/api/admin/scoring/relevel', json={'dry_run': 'yes'}).status_code, 400)
+
+
+class ReclassificationTest(ServerTestCase):
+    def wait_for_job(self):
+        deadline = time.monotonic() + 10
+        while server_v2._reclassify_status['running'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_job_runs_in_only_one_process(self):
+        self.wait_for_job()
+        # 別のワーカーがロックを持っている間は始めない
+        other_worker = server_v2.claim_reclassification()
+        self.assertIsNotNone(other_worker)
+        try:
+            self.assertFalse(server_v2.start_reclassification_job(force=True))
+            self.assertIsNone(server_v2.claim_reclassification())
+        finally:
+            other_worker.close()
+
+        self.assertTrue(server_v2.start_reclassification_job(force=True))
+        self.wait_for_job()
+        self.assertFalse(server_v2.start_reclassification_job())  # 指紋が一致したので不要
+
+
+class MigrationTest(ServerTestCase):
+    def test_legacy_database_has_classified_rollups_after_init_db(self):
+        # 分類列も集計テーブルもない頃の DB（logs テーブルだけ）
+        server_v2.DB_PATH = os.path.join(self.tmpdir, 'legacy.db')
+        with sqlite3.connect(server_v2.DB_PATH) as conn:
+            server_v2._create_tables(conn)
+            conn.execute("INSERT INTO users (username, full_name, start_date, end_date, created_at) "
+                         "VALUES ('bob', 'bob', '', '', '2025-01-01T00:00:00')")
+            conn.executemany('INSERT INTO logs (timestamp, username, action, detail, document_name, created_at) '
+                             "VALUES (?, 'bob', ?, ?, 'D', '2025-11-13T10:00:00')",
+                             [('2025-11-13 10:00:00', 'Document Opened', 'a.3dm'),
+                              ('2025-11-13 10:01:00', 'Command', 'Box'),
+                              ('2025-11-13 10:02:00', 'Command', 'Line')])
+
+        server_v2.init_db()
+
+        # 起動時はマイグレーションだけで、分類と集計はバックグラウンドのジョブが行う
+        with sqlite3.connect(server_v2.DB_PATH) as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM user_daily_stats').fetchone()[0], 0)
+        self.assertFalse(server_v2.reclassification_done())
+        self.assertTrue(server_v2.start_reclassification_job())
+        for thread in threading.enumerate():
+            if thread.name == 'reclassify-logs':
+                thread.join()
+
+        with sqlite3.connect(server_v2.DB_PATH) as conn:
+            categories = conn.execute("SELECT SUM(event_count) FROM user_category_stats "
+                                      "WHERE username = 'bob' AND workflow_category != ''").fetchone()[0]
+            self.assertEqual(categories, 2)
+            self.assertEqual(conn.execute("SELECT total_events FROM user_daily_stats").fetchall(), [(3,)])
+            self.assertGreater(conn.execute("SELECT COUNT(*) FROM action_groups").fetchone()[0], 0)
+        stats = self.client.get('/api/stats/bob').json
+        self.assertEqual(stats['total_logs'], 3)
+        self.assertEqual(stats['top_commands'], [{'command': 'Box', 'count': 1}, {'command': 'Line', 'count': 1}])
+        self.assertTrue(server_v2.reclassification_done())
+        self.assertFalse(server_v2.start_reclassification_job())
+
+    def test_log_events_copy_keeps_rows_written_during_the_copy(self):
+        server_v2.DB_PATH = os.path.join(self.tmpdir, 'legacy.db')
+        with sqlite3.connect(server_v2.DB_PATH) as conn:
+            server_v2._create_tables(conn)
+            for _, _, migrate in server_v2.MIGRATIONS[:7]:
+                migrate(conn)
+            conn.execute("INSERT INTO users (username, full_name, start_date, end_date, created_at) "
+                         "VALUES ('bob', 'bob', '2025-01-01', '2025-12-31', '2025-01-01T00:00:00')")
+            conn.executemany('INSERT INTO logs (timestamp, username, action, detail, document_name, created_at, '
+                             "ts_epoch) VALUES (?, 'bob', 'Command', ?, 'D', '2025-11-13T10:00:00', ?)",
+                             [(f'2025-11-13 10:00:{i:02d}', f'C{i % 3}', 1763028000 + i) for i in range(25)])
+
+        # バッチをコミットするたびに、稼働中の旧サーバーが新しいユーザー・アクションの行を書く
+        writes = []
+
+        class WritingServer(sqlite3.Connection):
+            def commit(self):
+                super().commit()
+                if len(writes) < 3:
+                    writes.append(1)
+                    with sqlite3.connect(server_v2.DB_PATH) as other:
+                        other.execute('INSERT INTO logs (timestamp, username, action, detail, document_name, '
+                                      "created_at) VALUES ('2025-11-14 09:00:00', ?, ?, 'late', NULL, "
+                                      "'2025-11-14T09:00:00')", (f'late{len(writes)}', f'Action{len(writes)}'))
+
+        with mock.patch.object(server_v2, 'MIGRATION_BATCH_SIZE', 10):
+            conn = sqlite3.connect(server_v2.DB_PATH, factory=WritingServer)
+            try:
+                server_v2.migration_008_log_events(conn)
+            finally:
+                conn.close()
+
+        with sqlite3.connect(server_v2.DB_PATH) as conn:
+            self.assertEqual(server_v2._schema_object_type(conn, 'logs'), 'view')
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM log_events').fetchone()[0], 28)
+            late = conn.execute("SELECT username, action FROM logs WHERE detail = 'late' ORDER BY id").fetchall()
+            self.assertEqual(late, [('late1', 'Action1'), ('late2', 'Action2'), ('late3', 'Action3')])
+
+
+class MetricsTest(ServerTestCase):
+    def test_exited_workers_keep_counters_but_not_gauges(self):
+        snapshot = {'samples': [['counter', 'requests_total', [], 5], ['gauge', 'queue_depth', [], 7]],
+                    'histograms': []}
+        for pid in (os.getpid(), 99999999):  # このプロセスと、存在しない pid
+            with open(os.path.join(self.tmpdir, f'metrics-{pid}.json'), 'w') as f:
+                json.dump(snapshot, f)
+
+        with mock.patch.object(server_v2, 'METRICS_DIR', self.tmpdir):
+            samples, _ = server_v2._merge_snapshots(server_v2.read_worker_snapshots())
+        self.assertEqual(samples[('counter', 'requests_total', ())], 10)
+        self.assertEqual(samples[('gauge', 'queue_depth', ())], 7)
+
+    def test_lookup_cache_counters_survive_a_rules_reload(self):
+        server_v2.classify_command('Box')
+        server_v2.classify_command('Box')
+        before = dict((name, value) for _, name, _, value in server_v2.collect_runtime_metrics())
+        self.assertGreater(before['rhinolog_command_lookup_cache_hits_total'], 0)
+        server_v2.load_command_classification()
+        after = dict((name, value) for _, name, _, value in server_v2.collect_runtime_metrics())
+        for name in ('rhinolog_command_lookup_cache_hits_total', 'rhinolog_command_lookup_cache_misses_total'):
+            self.assertGreaterEqual(after[name], before[name])
+
+
+class IngestWriterTest(ServerTestCase):
+    def rows(self, username, *seconds):
+        return [server_v2.build_log_row(self.event(second, UserID=username), '2025-11-13T10:00:00')
+                for second in seconds]
+
+    def test_bad_request_batch_is_spooled_without_dropping_the_group(self):
+        writer = server_v2.IngestWriter(capacity=100, group_events=100, group_ms=60000)
+        self.assertTrue(writer.submit(self.rows('alice', 1, 2)))
+        self.assertTrue(writer.submit(self.rows('ghost', 3)))
+        self.assertTrue(writer.submit(self.rows('alice', 4)))
+        writer.stop()
+
+        self.assertEqual(writer.stats['events_committed'], 3)
+        self.assertEqual(writer.stats['spooled_events'], 1)
+        self.assertEqual(writer.health()['queue_depth'], 0)
+        self.assertEqual(self.count_logs(), 3)
+
+        self.register('ghost')
+        with server_v2.db_connection() as conn:
+            result = server_v2.replay_ingest_spool(conn)
+        self.assertEqual((result['files'], result['events'], result['failed_files']), (1, 1, []))
+        self.assertEqual(os.listdir(server_v2.get_ingest_spool_dir()), [])
+        self.assertEqual(self.count_logs(), 4)
+
+    def test_transient_errors_are_retried(self):
+        insert_log_rows = server_v2.insert_log_rows
+        failures = []
+
+        def locked_twice(c, rows, sessionize=True):
+            if len(failures) < 2:
+                failures.append(1)
+                raise sqlite3.OperationalError('database is locked')
+            return insert_log_rows(c, rows, sessionize)
+
+        with mock.patch.object(server_v2, 'INGEST_RETRY_INITIAL_SECONDS', 0.01), \
+                mock.patch.object(server_v2, 'insert_log_rows', locked_twice):
+            writer = server_v2.IngestWriter(capacity=100, group_events=1, group_ms=10)
+            self.assertTrue(writer.submit(self.rows('alice', 1, 2)))
+            deadline = time.monotonic() + 5
+            while writer.stats['commits'] == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            writer.stop()
+
+        self.assertEqual(writer.stats['commit_retries'], 2)
+        self.assertEqual((writer.stats['events_committed'], writer.stats['spooled_events']), (2, 0))
+        self.assertEqual(self.count_logs(), 2)
+
+    def test_other_operational_errors_are_spooled_without_retrying(self):
+        def disk_error(c, rows, sessionize=True):
+            raise sqlite3.OperationalError('disk I/O error')
+
+        with mock.patch.object(server_v2, 'insert_log_rows', disk_error):
+            writer = server_v2.IngestWriter(capacity=100, group_events=100, group_ms=60000)
+            self.assertTrue(writer.submit(self.rows('alice', 1, 2)))
+            writer.stop()
+
+        self.assertEqual(writer.stats['commit_retries'], 0)
+        self.assertEqual((writer.stats['isolated_commits'], writer.stats['spooled_events']), (1, 2))
+
+    def test_async_batch_reports_queued_events(self):
+        with mock.patch.object(server_v2, 'INGEST_ASYNC', True), mock.patch.object(server_v2, '_ingest_writers', {}):
+            response = self.client.post('/api/log/upload/batch', json=[
+                self.event(1, EventId='a'), self.event(2, EventId='a'), self.event(3, UserID='ghost')])
+            server_v2.get_ingest_writer().stop()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((response.json['status'], response.json['queued'], response.json['rejected']),
+                         ('queued', 2, 1))
+        self.assertNotIn('accepted', response.json)
+        self.assertEqual([result['status'] for result in response.json['results']], ['queued', 'queued', 'rejected'])
+        self.assertEqual(self.count_logs(), 1)  # 重複は書き込みスレッドが落とす
+
+
+if __name__ == '__main__':
+    unittest.main()